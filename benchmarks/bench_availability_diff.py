@@ -0,0 +1,123 @@
+"""
+Benchmark del confronto delle disponibilità.
+
+Confronta il ciclo annidato originale (is_similar_datetime su ogni coppia di
+date dello stesso ospedale) con modules.availability_diff (sugli Slot), verificando che i
+risultati coincidano, e misura la dimensione dei dati salvati.
+
+Uso (dalla radice del progetto):
+    python benchmarks/bench_availability_diff.py [numero di disponibilità ...]
+"""
+import os
+import json
+import sys
+import random
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.availability_diff import diff_availabilities
+from modules.slots import slots_from_api, encode_slots
+from modules.time_utils import parse_epoch
+
+NUM_HOSPITALS = 20
+
+def make_availabilities(count, seed):
+    """Genera disponibilità casuali, a orari di 5 minuti nei prossimi 6 mesi."""
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1, 7, 0)
+    availabilities = []
+    for _ in range(count):
+        slot = start + timedelta(days=rng.randrange(180), minutes=5 * rng.randrange(150))
+        hospital_id = rng.randrange(NUM_HOSPITALS)
+        availabilities.append({
+            "date": slot.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "price": rng.choice([0, 25, 36.15]),
+            "hospital": {"id": hospital_id, "name": f"Ospedale {hospital_id}"},
+            "site": {"id": hospital_id, "address": f"Via {hospital_id}"}
+        })
+    return availabilities
+
+def is_similar_datetime(date1_str, date2_str, minutes_threshold=30):
+    """La versione originale, con strptime a ogni chiamata."""
+    try:
+        dt1 = datetime.strptime(date1_str, "%Y-%m-%dT%H:%M:%SZ")
+        dt2 = datetime.strptime(date2_str, "%Y-%m-%dT%H:%M:%SZ")
+        diff_minutes = abs((dt2 - dt1).total_seconds() / 60)
+        same_day = (dt1.year == dt2.year and dt1.month == dt2.month and dt1.day == dt2.day)
+        return same_day and diff_minutes <= minutes_threshold
+    except Exception:
+        return False
+
+def legacy_diff(previous, current, time_threshold, notify_removed, only_new_dates):
+    """Il confronto originale di compare_availabilities, con il ciclo annidato."""
+    changes = {"new": [], "removed": [], "changed": []}
+    prev_by_hospital = {}
+    curr_by_hospital = {}
+    for a in previous:
+        prev_by_hospital.setdefault(a['hospital'].get('id', 'unknown'), []).append(a)
+    for a in current:
+        curr_by_hospital.setdefault(a['hospital'].get('id', 'unknown'), []).append(a)
+
+    for hospital_id in set(list(prev_by_hospital.keys()) + list(curr_by_hospital.keys())):
+        prev_dates = {a['date']: a for a in prev_by_hospital.get(hospital_id, [])}
+        curr_dates = {a['date']: a for a in curr_by_hospital.get(hospital_id, [])}
+
+        for date, avail in curr_dates.items():
+            if date not in prev_dates:
+                if not any(is_similar_datetime(p, date, time_threshold) for p in prev_dates):
+                    changes["new"].append(avail)
+
+        if notify_removed:
+            for date, avail in prev_dates.items():
+                if date not in curr_dates:
+                    if not any(is_similar_datetime(date, c, time_threshold) for c in curr_dates):
+                        changes["removed"].append(avail)
+
+        if not only_new_dates:
+            for date, curr_avail in curr_dates.items():
+                if date in prev_dates and prev_dates[date]['price'] != curr_avail['price']:
+                    changes["changed"].append({"previous": prev_dates[date], "current": curr_avail})
+    return changes
+
+def same_changes(legacy, fast):
+    """Confronta i risultati (dizionari e Slot) ignorando l'ordine."""
+    def legacy_keys(avails):
+        return sorted((a['hospital']['id'], parse_epoch(a['date'])) for a in avails)
+    def fast_keys(slots):
+        return sorted((s.hospital_id, s.epoch) for s in slots)
+    return (legacy_keys(legacy["new"]) == fast_keys(fast["new"]) and
+            legacy_keys(legacy["removed"]) == fast_keys(fast["removed"]) and
+            legacy_keys(c["current"] for c in legacy["changed"]) ==
+            fast_keys(c["current"] for c in fast["changed"]))
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000]
+
+    print(f"{'disponibilità':>14} {'originale (s)':>14} {'nuovo (s)':>10} {'speedup':>8} "
+          f"{'JSON (byte)':>12} {'compatto':>10}")
+    for size in sizes:
+        previous = make_availabilities(size, seed=1)
+        current = make_availabilities(size, seed=2)
+        legacy, legacy_time = timed(legacy_diff, previous, current, 60, True, False)
+        # La conversione in Slot avviene una volta sola, alla ricezione dal servizio
+        prev_slots, curr_slots = slots_from_api(previous), slots_from_api(current)
+        fast, fast_time = timed(diff_availabilities, prev_slots, curr_slots, 60, True, False)
+
+        if not same_changes(legacy, fast):
+            print(f"ERRORE: risultati diversi con {size} disponibilità")
+            sys.exit(1)
+
+        legacy_bytes = len(json.dumps(current, indent=2))
+        compact_bytes = len(json.dumps(encode_slots(curr_slots), separators=(",", ":")))
+        print(f"{size:>14} {legacy_time:>14.3f} {fast_time:>10.4f} {legacy_time / fast_time:>7.0f}x "
+              f"{legacy_bytes:>12} {compact_bytes:>10}")
+
+if __name__ == "__main__":
+    main()
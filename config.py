@@ -25,20 +25,149 @@ AUTH_HEADER = "Basic QVBQTU9CSUxFX1NQRUNJQUw6UGs3alVTcDgzbUh4VDU4NA=="
 # Configurazione Telegram
 TELEGRAM_TOKEN = "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
 
+# Archivio di prescrizioni, utenti e dati precedenti: "json" (i file qui sotto)
+# oppure "sqlite" (un unico database SQLITE_FILE in modalità WAL).
+# Per passare da un archivio all'altro: python -m modules.sqlite_storage --from json --to sqlite
+STORAGE_BACKEND = "json"
+SQLITE_FILE = "recup.db"
+
 # Percorso del file di input e dati precedenti
 INPUT_FILE = "input_prescriptions.json"
 PREVIOUS_DATA_FILE = "previous_data.json"
 USERS_FILE = "authorized_users.json"
+HOSPITALS_FILE = "hospitals.json"
+
+# Coordinate (approssimate, del centro) dei comuni del Lazio, incluse nel
+# repository: usate per calcolare le distanze senza servizi di geocodifica
+TOWNS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "lazio_towns.json")
+
+# I file vengono sempre scritti in un file temporaneo poi rinominato, conservando
+# l'ultima versione completa come copia di riserva (.bak). FSYNC_MODE indica
+# quando sincronizzarli su disco: "always" (a ogni salvataggio), "batch" (una
+# volta per file alla fine di ogni ciclo di monitoraggio) o "never"
+FSYNC_MODE = "batch"
+
+# Gli utenti autorizzati sono tenuti in memoria (vedi modules.user_registry):
+# ogni USERS_RELOAD_INTERVAL secondi un thread controlla se sono stati
+# modificati nell'archivio (es. da un altro processo) e li ricarica
+USERS_RELOAD_INTERVAL = 5
+
+# Il bot tiene le prescrizioni in memoria e salva le modifiche in gruppo,
+# al più PRESCRIPTION_FLUSH_DELAY secondi dopo la prima modifica non salvata
+PRESCRIPTION_FLUSH_DELAY = 2
+
+# Formato dello snapshot dei dati precedenti (archivio JSON): "json" (in
+# PREVIOUS_DATA_FILE) oppure "binary" (in PREVIOUS_DATA_SNAPSHOT_FILE, con un
+# indice delle chiavi letto tramite mmap: si possono leggere le disponibilità
+# di una sola prescrizione senza decodificare le altre). Il formato viene
+# convertito alla compattazione successiva (all'avvio del monitoraggio).
+# Esportazione in JSON: python -m modules.snapshot_file previous_data.snap
+PREVIOUS_DATA_FORMAT = "json"
+PREVIOUS_DATA_SNAPSHOT_FILE = "previous_data.snap"
+
+# Journal append-only con gli aggiornamenti dei dati precedenti, compattato
+# in PREVIOUS_DATA_FILE quando supera la dimensione indicata (in byte)
+PREVIOUS_DATA_JOURNAL = "previous_data.journal"
+PREVIOUS_DATA_JOURNAL_MAX_BYTES = 1024 * 1024
+
+# Pulizia dei dati precedenti, ogni PREVIOUS_DATA_RETENTION_INTERVAL secondi
+# (e con il comando /pulizia dell'amministratore): vengono rimosse le chiavi
+# delle prescrizioni non più monitorate e per ogni prescrizione si conservano
+# solo le PREVIOUS_DATA_MAX_SLOTS disponibilità più vicine (None = tutte).
+# Dopo un riavvio, le disponibilità successive all'ultima salvata non
+# vengono notificate come nuove.
+PREVIOUS_DATA_RETENTION_INTERVAL = 6 * 3600
+PREVIOUS_DATA_MAX_SLOTS = 300
+
+# Storico delle disponibilità osservate (prima e ultima osservazione di ogni
+# disponibilità), salvato a blocchi compressi in HISTORY_DIR. Un blocco viene
+# scritto quando raccoglie HISTORY_CHUNK_ROWS righe o al più dopo
+# HISTORY_FLUSH_INTERVAL secondi
+HISTORY_DIR = "history"
+HISTORY_CHUNK_ROWS = 5000
+HISTORY_FLUSH_INTERVAL = 3600
+
+# Intervallo del ciclo di monitoraggio (in secondi)
+MONITORING_INTERVAL = 300
+
+# Prescrizioni controllate in parallelo dal monitoraggio: il numero viene
+# adattato tra il minimo e il massimo per completare il ciclo entro la
+# frazione indicata di MONITORING_INTERVAL
+MONITORING_MIN_WORKERS = 1
+MONITORING_MAX_WORKERS = 4
+MONITORING_TARGET_UTILIZATION = 0.8
+
+# Pausa tra due prescrizioni controllate dallo stesso worker (in secondi)
+PRESCRIPTION_REQUEST_DELAY = 1
+
+# Ogni quanti secondi il monitoraggio controlla se il file delle prescrizioni è cambiato
+# (solo se avviato senza le notifiche di modifica di recup_monitor.main)
+INPUT_FILE_CHECK_INTERVAL = 5
+
+# Finestre di attività del monitoraggio
+# - windows: giorni della settimana (0 = lunedì) e fascia oraria "HH:MM"; senza
+#   "end" (o con "24:00") la finestra dura fino alla fine della giornata.
+#   Nessuna finestra = controllo sempre ogni MONITORING_INTERVAL secondi
+# - holidays: festività nel formato "MM-DD" (Pasquetta calcolata automaticamente),
+#   considerate solo se ci sono finestre
+# - off_hours_interval: secondi tra due controlli fuori finestra (None = nessun controllo)
+# Ogni prescrizione può sovrascrivere questi valori con config["schedule"], es. per
+# ridurre il polling la notte e la domenica:
+#   {"windows": [{"days": [0, 1, 2, 3, 4, 5], "start": "06:30", "end": "22:00"}],
+#    "off_hours_interval": 1800}
+POLLING_SCHEDULE = {
+    "windows": [],
+    "holidays": ["01-01", "01-06", "04-25", "05-01", "06-02", "06-29",
+                 "08-15", "11-01", "12-08", "12-25", "12-26"],
+    "easter_monday": True,
+    "off_hours_interval": None
+}
+
+# Lunghezza massima di un messaggio Telegram: le notifiche più lunghe vengono divise
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Disponibilità mostrate per ospedale quando una prescrizione ha
+# config["collapse_long_lists"] attivo (le altre vengono riassunte)
+COLLAPSED_SLOTS_PER_HOSPITAL = 5
+
+# Con config["notify_mode"] = "earliest" si notifica solo quando la prima
+# disponibilità anticipa di più di queste ore (config["earliest_delta_hours"])
+EARLIEST_DELTA_HOURS = 24
+
+# Smorzamento delle disponibilità che scompaiono e ricompaiono tra un controllo
+# e l'altro: una disponibilità vista negli ultimi FLAP_DAMPING_WINDOW secondi
+# non viene notificata di nuovo come nuova (config["flap_window_minutes"],
+# 0 = disattivato). Per ogni prescrizione si ricordano al massimo
+# RECENTLY_SEEN_MAX_SLOTS disponibilità per RECENTLY_SEEN_TTL secondi.
+FLAP_DAMPING_WINDOW = 3 * 3600
+RECENTLY_SEEN_TTL = 24 * 3600
+RECENTLY_SEEN_MAX_SLOTS = 2000
 
 # Stati per la conversazione
 (WAITING_FOR_FISCAL_CODE, WAITING_FOR_NRE, CONFIRM_ADD, 
  WAITING_FOR_PRESCRIPTION_TO_DELETE, WAITING_FOR_PRESCRIPTION_TO_TOGGLE,
  WAITING_FOR_DATE_FILTER, WAITING_FOR_MONTHS_LIMIT, CONFIRM_DATE_FILTER,
  WAITING_FOR_BOOKING_CHOICE, WAITING_FOR_BOOKING_CONFIRMATION, WAITING_FOR_PHONE,
- WAITING_FOR_EMAIL, WAITING_FOR_SLOT_CHOICE, WAITING_FOR_BOOKING_TO_CANCEL) = range(14)
+ WAITING_FOR_EMAIL, WAITING_FOR_SLOT_CHOICE, WAITING_FOR_BOOKING_TO_CANCEL,
+ WAITING_FOR_PRESCRIPTION_TO_PAUSE) = range(15)
+
+# Stati del ciclo di vita di una prescrizione
+STATE_PENDING = "pending_validation"  # In attesa della prima verifica
+STATE_ACTIVE = "active"               # Monitorata
+STATE_BOOKED = "booked"               # Già prenotata
+STATE_EXPIRED = "expired"             # Scaduta o non più prenotabile
+STATE_INVALID = "invalid"             # Codice fiscale o NRE non validi
+STATE_PAUSED = "paused"               # Sospesa dall'utente
+
+# Fallimenti permanenti consecutivi dopo i quali una prescrizione attiva non viene più monitorata
+MAX_CONSECUTIVE_FAILURES = 3
+
+# Fallimenti permanenti consecutivi dopo i quali avvisare il proprietario della prescrizione
+PERMANENT_FAILURES_TO_NOTIFY = 3
 
-# Lista di utenti autorizzati
-authorized_users = []
+# Backoff esponenziale dopo fallimenti consecutivi (in secondi)
+FAILURE_BACKOFF_BASE = 300
+FAILURE_BACKOFF_MAX = 6 * 3600
 
 # Dizionario per tenere traccia delle conversazioni in corso
 user_data = {}
\ No newline at end of file
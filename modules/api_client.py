@@ -1,12 +1,30 @@
 import requests
 import logging
+import threading
 
 from config import (
     logger, BASE_URL, AUTH_HEADER
 )
 
+# Codice HTTP dell'ultimo errore, per thread (usato per classificare i fallimenti)
+_last_error = threading.local()
+
+def _record_error(e):
+    """Memorizza il codice HTTP dell'errore appena avvenuto (None se errore di rete)."""
+    response = getattr(e, "response", None)
+    _last_error.status_code = getattr(response, "status_code", None)
+
+def _clear_error():
+    """Azzera l'errore del thread corrente all'inizio di una nuova chiamata."""
+    _last_error.status_code = None
+
+def get_last_error_status():
+    """Restituisce il codice HTTP dell'ultima chiamata fallita nel thread corrente."""
+    return getattr(_last_error, "status_code", None)
+
 def get_access_token():
     """Obtain access token from the authentication endpoint."""
+    _clear_error()
     token_url = "https://gwapi-az.servicelazio.it/token"
     headers = {
         "Accept": "application/json",
@@ -26,6 +44,7 @@ def get_access_token():
         return response.json()['access_token']
     except Exception as e:
         logger.error(f"Errore nell'ottenere il token di accesso: {str(e)}")
+        _record_error(e)
         return None
 
 def update_device_token(access_token):
@@ -57,6 +76,7 @@ def update_device_token(access_token):
 
 def get_patient_info(fiscal_code):
     """Retrieve patient information."""
+    _clear_error()
     url = f"{BASE_URL}/api/v3/system-apis/patients"
     
     headers = {
@@ -79,10 +99,12 @@ def get_patient_info(fiscal_code):
         return response.json()
     except Exception as e:
         logger.error(f"Errore nell'ottenere informazioni sul paziente {fiscal_code}: {str(e)}")
+        _record_error(e)
         return None
 
 def get_doctor_info(fiscal_code):
     """Get doctor information."""
+    _clear_error()
     url = f"{BASE_URL}/api/v4/experience-apis/doctors/bpx"
     
     headers = {
@@ -106,6 +128,7 @@ def get_doctor_info(fiscal_code):
         return response.json()
     except Exception as e:
         logger.error(f"Errore nell'ottenere le informazioni del medico per {fiscal_code}: {str(e)}")
+        _record_error(e)
         return None
 
 def book_appointment(process_id, data_prenotazione, diary_id, service_cur, nre, fiscal_code):
@@ -304,6 +327,7 @@ def cancel_booking(booking_id):
 
 def check_prescription(patient_id, nre):
     """Check prescription details."""
+    _clear_error()
     url = f"{BASE_URL}/api/v3/experience-apis/citizens/prescriptions/check-prescription"
     
     headers = {
@@ -327,10 +351,12 @@ def check_prescription(patient_id, nre):
         return response.json()
     except Exception as e:
         logger.error(f"Errore nel controllare la prescrizione {nre}: {str(e)}")
+        _record_error(e)
         return None
 
 def get_prescription_details(patient_id, nre):
     """Get full prescription details."""
+    _clear_error()
     url = f"{BASE_URL}/api/v3/system-apis/prescriptions/{nre}"
     
     headers = {
@@ -353,10 +379,12 @@ def get_prescription_details(patient_id, nre):
         return response.json()
     except Exception as e:
         logger.error(f"Errore nell'ottenere i dettagli della prescrizione {nre}: {str(e)}")
+        _record_error(e)
         return None
 
 def get_availabilities(patient_id, process_id, nre, order_ids):
     """Get medical service availabilities."""
+    _clear_error()
     url = f"{BASE_URL}/api/v3/experience-apis/citizens/availabilities"
     
     headers = {
@@ -384,4 +412,5 @@ def get_availabilities(patient_id, process_id, nre, order_ids):
         return response.json()
     except Exception as e:
         logger.error(f"Errore nell'ottenere le disponibilità per {nre}: {str(e)}")
+        _record_error(e)
         return None
\ No newline at end of file
@@ -0,0 +1,103 @@
+import logging
+from bisect import bisect_left, bisect_right
+
+def group_by_hospital(slots):
+    """
+    Raggruppa le disponibilità per ospedale e per orario.
+
+    Come nel confronto originale, a parità di orario prevale l'ultima disponibilità.
+
+    Returns:
+        dict: id ospedale -> {epoch: Slot}, nell'ordine di apparizione
+    """
+    by_hospital = {}
+    for slot in slots:
+        by_hospital.setdefault(slot.hospital_id, {})[slot.epoch] = slot
+    return by_hospital
+
+def has_near_match(epoch, sorted_epochs, threshold_seconds):
+    """
+    Verifica se un orario ha un corrispondente nello stesso giorno entro la soglia.
+
+    Equivale a confrontare l'orario con tutte le date, ma esamina solo quelle
+    nella finestra [epoch - soglia, epoch + soglia], trovata con una ricerca binaria.
+    """
+    day = epoch // 86400
+    start = bisect_left(sorted_epochs, epoch - threshold_seconds)
+    end = bisect_right(sorted_epochs, epoch + threshold_seconds)
+    for i in range(start, end):
+        if sorted_epochs[i] // 86400 == day:
+            return True
+    return False
+
+def diff_availabilities(previous, current, time_threshold=60, notify_removed=False, only_new_dates=True,
+                        horizon=None):
+    """
+    Calcola le differenze tra le disponibilità precedenti e quelle attuali.
+
+    Gli orari sono già convertiti in secondi dall'epoca negli Slot; le
+    corrispondenze vicine (piccoli spostamenti di orario nello stesso giorno)
+    sono cercate per ospedale con una ricerca binaria, quindi il costo è
+    O((n + m) log m).
+
+    Args:
+        previous: Le disponibilità precedenti (lista di Slot)
+        current: Le disponibilità attuali (lista di Slot)
+        time_threshold: Minuti entro cui uno spostamento di orario non è un cambiamento
+        notify_removed: Calcola anche le disponibilità rimosse
+        only_new_dates: Se False, calcola anche i cambiamenti di prezzo
+        horizon: Le disponibilità attuali successive a questo epoch non sono
+            considerate nuove (lo snapshot precedente non le conservava)
+
+    Returns:
+        dict: {"new": [...], "removed": [...], "changed": [{"previous", "current"}, ...]}
+    """
+    changes = {
+        "new": [],
+        "removed": [],
+        "changed": []
+    }
+    threshold_seconds = time_threshold * 60
+
+    prev_by_hospital = group_by_hospital(previous)
+    curr_by_hospital = group_by_hospital(current)
+
+    # Ospedali nell'ordine di apparizione, prima gli attuali poi quelli scomparsi
+    all_hospitals = list(curr_by_hospital) + [h for h in prev_by_hospital if h not in curr_by_hospital]
+
+    for hospital_id in all_hospitals:
+        prev_dates = prev_by_hospital.get(hospital_id, {})
+        curr_dates = curr_by_hospital.get(hospital_id, {})
+
+        # Verifica nuove date
+        prev_index = None
+        for epoch, slot in curr_dates.items():
+            if epoch in prev_dates or (horizon is not None and epoch > horizon):
+                continue
+            if prev_index is None:
+                prev_index = sorted(prev_dates)
+            if not has_near_match(epoch, prev_index, threshold_seconds):
+                changes["new"].append(slot)
+
+        # Verifica date rimosse (solo se notify_removed è True)
+        if notify_removed:
+            curr_index = None
+            for epoch, slot in prev_dates.items():
+                if epoch in curr_dates:
+                    continue
+                if curr_index is None:
+                    curr_index = sorted(curr_dates)
+                if not has_near_match(epoch, curr_index, threshold_seconds):
+                    changes["removed"].append(slot)
+
+        # Verifica cambiamenti di prezzo (solo se only_new_dates è False)
+        if not only_new_dates:
+            for epoch, curr_avail in curr_dates.items():
+                prev_avail = prev_dates.get(epoch)
+                if prev_avail is not None and prev_avail.price != curr_avail.price:
+                    changes["changed"].append({
+                        "previous": prev_avail,
+                        "current": curr_avail
+                    })
+
+    return changes
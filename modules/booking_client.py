@@ -206,7 +206,8 @@ def cancel_booking(booking_id):
     
     return result
 
-def booking_workflow(fiscal_code, nre, phone_number, email, patient_id=None, process_id=None, slot_choice=0):
+def booking_workflow(fiscal_code, nre, phone_number, email, patient_id=None, process_id=None, slot_choice=0,
+                     slot_config=None, slot_origin=None):
     """
     Complete booking workflow - from checking availability to booking and downloading confirmation.
     
@@ -218,6 +219,10 @@ def booking_workflow(fiscal_code, nre, phone_number, email, patient_id=None, pro
     patient_id (str, optional): If already known, patient ID to skip a step
     process_id (str, optional): If already known, process ID to skip a step
     slot_choice (int, optional): Index of the slot to choose (0 = first available)
+    slot_config (dict, optional): Prescription config whose filters are applied to the slots;
+        pass the same value when listing and when booking so the indexes match
+    slot_origin (tuple, optional): Patient coordinates used by the max_distance_km filter
+        (see modules.geo.get_patient_origin)
     
     Returns:
     dict: Result of the booking operation with details
@@ -226,6 +231,7 @@ def booking_workflow(fiscal_code, nre, phone_number, email, patient_id=None, pro
         get_patient_info, get_doctor_info, check_prescription,
         get_prescription_details, get_availabilities
     )
+    from modules.slot_filters import filter_availabilities
     
     try:
         # Step 1: Get patient information if not provided
@@ -271,8 +277,16 @@ def booking_workflow(fiscal_code, nre, phone_number, email, patient_id=None, pro
         if not availabilities['content']:
             return {"success": False, "message": "Nessuna disponibilità trovata per questa prescrizione"}
         
+        # Applichiamo gli stessi filtri usati per le notifiche
+        slots = availabilities['content']
+        if slot_config:
+            slots = filter_availabilities(slots, slot_config, origin=slot_origin)
+            logger.info(f"Slots matching the prescription filters: {len(slots)}")
+            if not slots:
+                return {"success": False, "message": "Nessuna disponibilità corrisponde ai filtri della prescrizione"}
+        
         # Sort slots by date to prioritize earlier dates
-        sorted_slots = sorted(availabilities['content'], key=lambda x: x['date'])
+        sorted_slots = sorted(slots, key=lambda x: x['date'])
         
         # If slot_choice is out of range, use the first slot
         if slot_choice >= len(sorted_slots):
@@ -11,26 +11,30 @@ from modules.booking_client import (
     booking_workflow, cancel_booking, get_booking_document, 
     get_user_bookings
 )
-from datetime import datetime
 from io import BytesIO
 
 # Importiamo le variabili globali dal modulo principale
 from config import (
-    logger, user_data, authorized_users,
+    logger, user_data,
     WAITING_FOR_FISCAL_CODE, WAITING_FOR_NRE, CONFIRM_ADD,
     WAITING_FOR_PRESCRIPTION_TO_DELETE, WAITING_FOR_PRESCRIPTION_TO_TOGGLE,
     WAITING_FOR_DATE_FILTER, WAITING_FOR_MONTHS_LIMIT, CONFIRM_DATE_FILTER,
     WAITING_FOR_BOOKING_CHOICE, WAITING_FOR_BOOKING_CONFIRMATION, WAITING_FOR_PHONE,
-    WAITING_FOR_EMAIL, WAITING_FOR_SLOT_CHOICE, WAITING_FOR_BOOKING_TO_CANCEL
+    WAITING_FOR_EMAIL, WAITING_FOR_SLOT_CHOICE, WAITING_FOR_BOOKING_TO_CANCEL,
+    WAITING_FOR_PRESCRIPTION_TO_PAUSE,
+    STATE_PENDING, STATE_BOOKED, STATE_PAUSED, MONITORING_INTERVAL, POLLING_SCHEDULE
 )
 
 # Importiamo le funzioni da altri moduli
-from modules.data_utils import (
-    load_authorized_users, save_authorized_users, 
-    load_input_data, save_input_data,
-    load_previous_data, save_previous_data
-)
+from modules.data_utils import load_previous_data, run_previous_data_retention
+from modules.prescription_repository import get_repository
+from modules.user_registry import get_user_registry
 from modules.prescription_processor import process_prescription
+from modules.time_utils import format_short
+from modules.geo import get_patient_origin
+from modules.prescription_state import (
+    get_state, get_state_label, is_monitored, set_entry_state
+)
 
 # =============================================================================
 # FUNZIONI DI UTILITY PER IL BOT
@@ -81,12 +85,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestore del comando /start."""
     user_id = update.effective_user.id
 
-    # Carica gli utenti autorizzati per assicurarsi che i dati siano aggiornati
-    load_authorized_users()
-
-    if not authorized_users:
-        authorized_users.append(str(user_id))
-        save_authorized_users()
+    # Il primo utente diventa l'amministratore (gli utenti sono già in memoria, vedi modules.user_registry)
+    if get_user_registry().claim_admin(user_id):
         logger.info(f"Primo utente {user_id} aggiunto come amministratore")
         
         # Creiamo una tastiera personalizzata con tutte le funzionalità
@@ -96,7 +96,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ["🔔 Gestisci Notifiche", "⏱ Imposta Filtro Date"],
             ["🏥 Prenota", "🤖 Prenota Automaticamente"],
             ["📝 Le mie Prenotazioni", "ℹ️ Informazioni"],
-            ["🔑 Autorizza Utente"]
+            ["⏯ Sospendi/Riattiva", "🔑 Autorizza Utente"]
         ]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         
@@ -109,7 +109,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Controlliamo se l'utente è autorizzato (per gli utenti successivi)
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text(
             "🔒 Non sei autorizzato ad utilizzare questo bot. Contatta l'amministratore per ottenere l'accesso."
         )
@@ -123,7 +123,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ["🔔 Gestisci Notifiche", "⏱ Imposta Filtro Date"],
         ["🏥 Prenota", "🤖 Prenota Automaticamente"],
         ["📝 Le mie Prenotazioni", "ℹ️ Informazioni"],
-        ["🔑 Autorizza Utente"]
+        ["⏯ Sospendi/Riattiva", "🔑 Autorizza Utente"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
@@ -143,7 +143,7 @@ async def add_prescription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
@@ -183,7 +183,7 @@ async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ["🔔 Gestisci Notifiche", "⏱ Imposta Filtro Date"],
                 ["🏥 Prenota", "🤖 Prenota Automaticamente"],
                 ["📝 Le mie Prenotazioni", "ℹ️ Informazioni"],
-                ["🔑 Autorizza Utente"]
+                ["⏯ Sospendi/Riattiva", "🔑 Autorizza Utente"]
             ], resize_keyboard=True)
             
             await update.message.reply_text(
@@ -258,19 +258,15 @@ async def handle_nre(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Salviamo il codice NRE
     user_data[user_id]["nre"] = nre
     
-    # Carichiamo le prescrizioni esistenti per verificare se è già presente
-    prescriptions = load_input_data()
-    
     # Controlliamo se la prescrizione esiste già
     fiscal_code = user_data[user_id]["fiscal_code"]
-    for prescription in prescriptions:
-        if prescription["fiscal_code"] == fiscal_code and prescription["nre"] == nre:
-            await update.message.reply_text(
-                "⚠️ Questa prescrizione è già presente nel sistema. Non è possibile aggiungerla di nuovo."
-            )
-            # Puliamo i dati dell'utente
-            user_data.pop(user_id, None)
-            return ConversationHandler.END
+    if get_repository().for_key(fiscal_code, nre):
+        await update.message.reply_text(
+            "⚠️ Questa prescrizione è già presente nel sistema. Non è possibile aggiungerla di nuovo."
+        )
+        # Puliamo i dati dell'utente
+        user_data.pop(user_id, None)
+        return ConversationHandler.END
     
     # Prepariamo la conferma
     await update.message.reply_text(
@@ -305,27 +301,27 @@ async def confirm_add_prescription(update: Update, context: ContextTypes.DEFAULT
     fiscal_code = user_data[user_id]["fiscal_code"]
     nre = user_data[user_id]["nre"]
     
-    # Carichiamo le prescrizioni esistenti
-    prescriptions = load_input_data()
-    
     # Creiamo la nuova prescrizione con notifiche abilitate e configurazione di base
     new_prescription = {
         "fiscal_code": fiscal_code,
         "nre": nre,
         "telegram_chat_id": user_id,
         "notifications_enabled": True,  # Inizializziamo le notifiche come abilitate
+        "state": STATE_PENDING,         # Diventa attiva dopo la prima verifica
         "config": {
             "only_new_dates": True,
             "notify_removed": False,
             "min_changes_to_notify": 1,
             "time_threshold_minutes": 60,
             "show_all_current": True,
-            "months_limit": None  # Nessun limite di mesi predefinito
+            "months_limit": None,  # Nessun limite di mesi predefinito
+            "collapse_long_lists": False,  # Riassume gli ospedali con molte disponibilità
+            "max_distance_km": None  # Nessun limite di distanza predefinito
         }
     }
     
-    # Verifichiamo che la prescrizione sia valida
-    previous_data = load_previous_data()
+    # Verifichiamo che la prescrizione sia valida (serve solo il suo snapshot, se esiste)
+    previous_data = load_previous_data(keys=[f"{fiscal_code}_{nre}"])
     success, message = process_prescription(new_prescription, previous_data, user_id)
     
     if not success:
@@ -334,12 +330,8 @@ async def confirm_add_prescription(update: Update, context: ContextTypes.DEFAULT
         return ConversationHandler.END
     
     # Aggiungiamo la prescrizione
-    prescriptions.append(new_prescription)
+    get_repository().add(new_prescription)
     logger.info(f"Prescrizione aggiunta: {new_prescription.get('description', 'Non disponibile')} per {fiscal_code}")
-    logger.info(f"Totale prescrizioni: {len(prescriptions)}")
-    
-    save_input_data(prescriptions)
-    save_previous_data(previous_data)
     
     # Aggiorniamo il messaggio
     await query.edit_message_text(
@@ -379,23 +371,20 @@ async def remove_prescription(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     if not user_prescriptions:
         await update.message.reply_text("⚠️ Non hai prescrizioni da rimuovere.")
@@ -460,24 +449,10 @@ async def handle_prescription_to_delete(update: Update, context: ContextTypes.DE
     # Otteniamo la prescrizione
     prescription_to_remove = user_prescriptions[idx]
     
-    # Carichiamo tutte le prescrizioni
-    all_prescriptions = load_input_data()
-    
-    # Rimuoviamo la prescrizione
-    new_prescriptions = []
-    removed = False
-    
-    for prescription in all_prescriptions:
-        if (prescription["fiscal_code"] == prescription_to_remove["fiscal_code"] and 
-            prescription["nre"] == prescription_to_remove["nre"]):
-            removed = True
-        else:
-            new_prescriptions.append(prescription)
+    # Rimuoviamo la prescrizione (tutte le sue voci)
+    removed = get_repository().remove_key(prescription_to_remove["fiscal_code"], prescription_to_remove["nre"])
     
     if removed:
-        # Salviamo le prescrizioni aggiornate
-        save_input_data(new_prescriptions)
-        
         # Aggiorniamo il messaggio
         await query.edit_message_text(
             f"✅ Prescrizione rimossa con successo!\n\n"
@@ -502,22 +477,20 @@ async def list_prescriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
+    is_admin = get_user_registry().is_admin(user_id)
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
+        prescriptions = get_repository().all()
         message = "📋 <b>Tutte le prescrizioni monitorate:</b>\n\n"
     else:
         # Gli utenti normali vedono solo le proprie
-        prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        prescriptions = get_repository().for_chat(user_id)
         message = "📋 <b>Le tue prescrizioni monitorate:</b>\n\n"
     
     if not prescriptions:
@@ -540,6 +513,11 @@ async def list_prescriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
         months_limit = prescription.get("config", {}).get("months_limit")
         date_filter = f"⏱ entro {months_limit} mesi" if months_limit else "⏱ nessun filtro date"
         
+        # Mostriamo lo stato del monitoraggio e, se presente, il motivo
+        state_info = get_state_label(prescription)
+        if not is_monitored(prescription) and prescription.get("state_reason"):
+            state_info += f" ({prescription['state_reason']})"
+        
         # Aggiungiamo informazioni sull'utente se l'admin sta visualizzando
         user_info = ""
         if is_admin and "telegram_chat_id" in prescription:
@@ -548,6 +526,7 @@ async def list_prescriptions(update: Update, context: ContextTypes.DEFAULT_TYPE)
         message += f"{idx+1}. <b>{desc}</b>{user_info}\n"
         message += f"   Codice Fiscale: <code>{fiscal_code}</code>\n"
         message += f"   NRE: <code>{nre}</code>\n"
+        message += f"   Stato: {state_info}\n"
         message += f"   Notifiche: {notification_status} | {date_filter}\n\n"
     
     await update.message.reply_text(message, parse_mode="HTML")
@@ -557,22 +536,26 @@ async def check_availability(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
     # Notifichiamo all'utente che stiamo iniziando la verifica
     await update.message.reply_text("🔍 Sto verificando le disponibilità... Potrebbe richiedere alcuni minuti.")
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
+    is_admin = get_user_registry().is_admin(user_id)
     
-    if not is_admin:
+    if is_admin:
+        prescriptions = get_repository().all()
+    else:
         # Gli utenti normali verificano solo le proprie prescrizioni
-        prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        prescriptions = get_repository().for_chat(user_id)
+    
+    # Ignoriamo le prescrizioni prenotate, scadute, non valide o sospese
+    num_inactive = len(prescriptions)
+    prescriptions = [p for p in prescriptions if is_monitored(p)]
+    num_inactive -= len(prescriptions)
     
     if not prescriptions:
         await update.message.reply_text(
@@ -580,25 +563,25 @@ async def check_availability(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
     
-    # Carichiamo i dati precedenti
-    previous_data = load_previous_data()
+    # Carichiamo i dati precedenti delle sole prescrizioni da verificare
+    previous_data = load_previous_data(strict=True, keys={f"{p['fiscal_code']}_{p['nre']}" for p in prescriptions})
+    if previous_data is None:
+        await update.message.reply_text("⚠️ Dati precedenti non disponibili, riprova più tardi.")
+        return
     
     # Processiamo ogni prescrizione
     num_processed = 0
     for prescription in prescriptions:
-        # Forziamo l'aggiornamento per inviare anche se non ci sono cambiamenti
-        old_config = prescription.get("config", {}).copy()
-        
-        # Modifichiamo temporaneamente la configurazione per forzare la notifica
-        temp_config = old_config.copy()
+        # Forziamo l'aggiornamento per inviare anche se non ci sono cambiamenti,
+        # con una configurazione temporanea su una copia della voce: la voce del
+        # repository si modifica solo con update
+        temp_config = dict(prescription.get("config") or {})
         temp_config["min_changes_to_notify"] = 0
-        prescription["config"] = temp_config
+        # Anche in modalità "earliest" la verifica manuale mostra i cambiamenti
+        temp_config.pop("notify_mode", None)
         
         # Processiamo la prescrizione
-        success, _ = process_prescription(prescription, previous_data, user_id)
-        
-        # Ripristiniamo la configurazione originale
-        prescription["config"] = old_config
+        success, _ = process_prescription(dict(prescription, config=temp_config), previous_data, user_id)
         
         if success:
             num_processed += 1
@@ -606,12 +589,10 @@ async def check_availability(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Piccolo ritardo tra le richieste
         await asyncio.sleep(1)
     
-    # Salviamo i dati aggiornati
-    save_previous_data(previous_data)
-    
     # Notifichiamo il completamento
+    inactive_text = f" ({num_inactive} non attive ignorate)" if num_inactive else ""
     await update.message.reply_text(
-        f"✅ Verifica completata! {num_processed}/{len(prescriptions)} prescrizioni processate.\n\n"
+        f"✅ Verifica completata! {num_processed}/{len(prescriptions)} prescrizioni processate{inactive_text}.\n\n"
         "Se sono state trovate disponibilità, riceverai dei messaggi separati con i dettagli."
     )
 
@@ -624,23 +605,20 @@ async def toggle_notifications(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     if not user_prescriptions:
         await update.message.reply_text("⚠️ Non hai prescrizioni da gestire.")
@@ -708,26 +686,15 @@ async def handle_prescription_toggle(update: Update, context: ContextTypes.DEFAU
     # Otteniamo la prescrizione
     prescription_to_toggle = user_prescriptions[idx]
     
-    # Carichiamo tutte le prescrizioni
-    all_prescriptions = load_input_data()
-    
-    # Cerchiamo la prescrizione nel dataset completo
-    toggled = False
-    for prescription in all_prescriptions:
-        if (prescription["fiscal_code"] == prescription_to_toggle["fiscal_code"] and 
-            prescription["nre"] == prescription_to_toggle["nre"]):
-            
-            # Otteniamo lo stato attuale e lo invertiamo
-            current_state = prescription.get("notifications_enabled", True)
-            prescription["notifications_enabled"] = not current_state
-            
-            toggled = True
-            new_state = prescription["notifications_enabled"]
-            break
+    # Cerchiamo la prescrizione tra quelle monitorate
+    repository = get_repository()
+    prescription = repository.get(prescription_to_toggle["fiscal_code"], prescription_to_toggle["nre"],
+                                  prescription_to_toggle.get("telegram_chat_id"))
     
-    if toggled:
-        # Salviamo le prescrizioni aggiornate
-        save_input_data(all_prescriptions)
+    if prescription is not None:
+        # Otteniamo lo stato attuale e lo invertiamo
+        new_state = not prescription.get("notifications_enabled", True)
+        repository.update(prescription, {"notifications_enabled": new_state})
         
         # Stato da visualizzare nel messaggio
         status_text = "attivate ✅" if new_state else "disattivate ❌"
@@ -748,6 +715,109 @@ async def handle_prescription_toggle(update: Update, context: ContextTypes.DEFAU
     return ConversationHandler.END
 
 
+async def pause_prescription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sospende o riattiva il monitoraggio di una prescrizione."""
+    user_id = update.effective_user.id
+    
+    # Controlliamo se l'utente è autorizzato
+    if not get_user_registry().is_authorized(user_id):
+        await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
+        return
+    
+    # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
+    
+    if is_admin:
+        # L'admin vede tutte le prescrizioni
+        user_prescriptions = repository.all()
+    else:
+        # Gli utenti normali vedono solo le proprie
+        user_prescriptions = repository.for_chat(user_id)
+    
+    if not user_prescriptions:
+        await update.message.reply_text("⚠️ Non hai prescrizioni da gestire.")
+        return ConversationHandler.END
+    
+    # Creiamo i pulsanti per le prescrizioni
+    keyboard = []
+    
+    for idx, prescription in enumerate(user_prescriptions):
+        desc = prescription.get("description", "Prescrizione")
+        
+        # Mostriamo lo stato attuale del monitoraggio
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{idx+1}. {desc[:25]}... ({get_state_label(prescription)})",
+                callback_data=f"pause_{idx}"
+            )
+        ])
+    
+    keyboard.append([InlineKeyboardButton("❌ Annulla", callback_data="cancel_pause")])
+    
+    # Salviamo le prescrizioni nei dati dell'utente
+    user_data[user_id] = {
+        "action": "pause_prescription",
+        "prescriptions": user_prescriptions
+    }
+    
+    await update.message.reply_text(
+        "Seleziona la prescrizione da sospendere o riattivare.\n\n"
+        "Le prescrizioni attive vengono sospese; quelle sospese, prenotate, scadute "
+        "o non valide vengono verificate di nuovo al prossimo ciclo:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    
+    return WAITING_FOR_PRESCRIPTION_TO_PAUSE
+
+async def handle_prescription_pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Gestisce la selezione della prescrizione da sospendere o riattivare."""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    callback_data = query.data
+    
+    if callback_data == "cancel_pause":
+        await query.edit_message_text("❌ Operazione annullata.")
+        # Puliamo i dati dell'utente
+        user_data.pop(user_id, None)
+        return ConversationHandler.END
+    
+    # Estraiamo l'indice della prescrizione
+    idx = int(callback_data.split("_")[1])
+    user_prescriptions = user_data[user_id]["prescriptions"]
+    
+    # Controlliamo che l'indice sia valido
+    if idx < 0 or idx >= len(user_prescriptions):
+        await query.edit_message_text("⚠️ Prescrizione non valida.")
+        user_data.pop(user_id, None)
+        return ConversationHandler.END
+    
+    prescription = user_prescriptions[idx]
+    
+    if is_monitored(prescription):
+        # Sospendiamo il monitoraggio
+        set_entry_state(prescription, STATE_PAUSED, "sospesa dall'utente")
+        status_text = "sospeso ⏸"
+    else:
+        # Riattiviamo: la prescrizione viene verificata di nuovo al prossimo ciclo
+        set_entry_state(prescription, STATE_PENDING, "riattivata dall'utente")
+        status_text = "riattivato ▶️"
+    
+    await query.edit_message_text(
+        f"✅ Monitoraggio {status_text} per:\n\n"
+        f"Descrizione: {prescription.get('description', 'Non disponibile')}\n"
+        f"Codice Fiscale: {prescription['fiscal_code']}\n"
+        f"NRE: {prescription['nre']}"
+    )
+    
+    # Puliamo i dati dell'utente
+    user_data.pop(user_id, None)
+    
+    return ConversationHandler.END
+
+
 # =============================================================================
 # GESTORI PRENOTAZIONI
 # =============================================================================
@@ -757,23 +827,20 @@ async def book_prescription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     if not user_prescriptions:
         await update.message.reply_text("⚠️ Non hai prescrizioni da prenotare.")
@@ -918,7 +985,9 @@ async def handle_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         nre=nre,
         phone_number=user_data[user_id]["phone"],
         email=email,
-        slot_choice=-1  # Chiediamo la lista delle disponibilità
+        slot_choice=-1,  # Chiediamo la lista delle disponibilità
+        slot_config=prescription.get("config"),  # Stessi filtri delle notifiche
+        slot_origin=get_patient_origin(prescription)
     )
     
     if not result["success"]:
@@ -952,11 +1021,7 @@ async def handle_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         for slot in slots:
             # Formattiamo la data
-            try:
-                date_obj = datetime.strptime(slot["date"], "%Y-%m-%dT%H:%M:%SZ")
-                formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-            except:
-                formatted_date = slot["date"]
+            formatted_date = format_short(slot["date"])
             
             # Creiamo un pulsante per ogni disponibilità
             keyboard.append([
@@ -1022,11 +1087,7 @@ async def handle_slot_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     selected_slot = slots[slot_idx]
     
     # Formattiamo la data
-    try:
-        date_obj = datetime.strptime(selected_slot["date"], "%Y-%m-%dT%H:%M:%SZ")
-        formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-    except:
-        formatted_date = selected_slot["date"]
+    formatted_date = format_short(selected_slot["date"])
     
     # Chiediamo conferma all'utente
     await query.edit_message_text(
@@ -1083,7 +1144,9 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         email=email,
         patient_id=booking_details.get("patient_id"),
         process_id=booking_details.get("process_id"),
-        slot_choice=slot_idx
+        slot_choice=slot_idx,
+        slot_config=prescription.get("config"),  # Gli indici si riferiscono alla lista filtrata
+        slot_origin=get_patient_origin(prescription)
     )
     
     if not result["success"]:
@@ -1097,11 +1160,7 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Se la prenotazione è andata a buon fine
     if result["action"] == "booked":
         # Formattiamo la data
-        try:
-            date_obj = datetime.strptime(result["appointment_date"], "%Y-%m-%dT%H:%M:%SZ")
-            formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-        except:
-            formatted_date = result["appointment_date"]
+        formatted_date = format_short(result["appointment_date"])
         
         # Inviamo il messaggio di conferma
         await query.edit_message_text(
@@ -1127,21 +1186,21 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
             caption=f"Documento di prenotazione per {result['service']} del {formatted_date}"
         )
         
-        # Salvare la prenotazione nei dati della prescrizione
-        prescriptions = load_input_data()
-        for p in prescriptions:
-            if p["fiscal_code"] == prescription["fiscal_code"] and p["nre"] == prescription["nre"]:
-                if "bookings" not in p:
-                    p["bookings"] = []
-                p["bookings"].append({
+        # Salviamo la prenotazione nella voce della chat che l'ha effettuata: la
+        # prescrizione è prenotata e la voce non va più monitorata (le altre chat
+        # che monitorano la stessa prescrizione non vengono toccate)
+        p = get_repository().get(prescription["fiscal_code"], prescription["nre"],
+                                 prescription.get("telegram_chat_id", ""))
+        if p is not None:
+            set_entry_state(p, STATE_BOOKED, f"prenotazione {result['booking_id']}", {
+                "bookings": (p.get("bookings") or []) + [{
                     "booking_id": result["booking_id"],
                     "date": result["appointment_date"],
                     "hospital": result["hospital"],
                     "address": result["address"],
                     "service": result["service"]
-                })
-                break
-        save_input_data(prescriptions)
+                }]
+            })
     else:
         await query.edit_message_text(
             f"⚠️ Errore imprevisto nella prenotazione."
@@ -1156,23 +1215,20 @@ async def list_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     # Raccogliamo le prenotazioni da tutte le prescrizioni
     all_bookings = []
@@ -1233,11 +1289,7 @@ async def list_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     for idx, booking in enumerate(all_bookings):
         # Formattiamo la data
-        try:
-            date_obj = datetime.strptime(booking["date"], "%Y-%m-%dT%H:%M:%SZ")
-            formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-        except:
-            formatted_date = booking["date"]
+        formatted_date = format_short(booking["date"])
         
         message += f"{idx+1}. <b>{booking['service']}</b>\n"
         message += f"   📅 Data: {formatted_date}\n"
@@ -1261,19 +1313,16 @@ async def start_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user_id = query.from_user.id
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     # Raccogliamo le prenotazioni da tutte le prescrizioni
     all_bookings = []
@@ -1337,11 +1386,7 @@ async def start_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYP
     
     for idx, booking in enumerate(all_bookings):
         # Formattiamo la data
-        try:
-            date_obj = datetime.strptime(booking["date"], "%Y-%m-%dT%H:%M:%SZ")
-            formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-        except:
-            formatted_date = booking["date"]
+        formatted_date = format_short(booking["date"])
         
         keyboard.append([
             InlineKeyboardButton(
@@ -1388,11 +1433,7 @@ async def handle_booking_to_cancel(update: Update, context: ContextTypes.DEFAULT
     booking_to_cancel = user_bookings[idx]
     
     # Formattiamo la data
-    try:
-        date_obj = datetime.strptime(booking_to_cancel["date"], "%Y-%m-%dT%H:%M:%SZ")
-        formatted_date = date_obj.strftime("%d/%m/%Y %H:%M")
-    except:
-        formatted_date = booking_to_cancel["date"]
+    formatted_date = format_short(booking_to_cancel["date"])
     
     # Chiediamo conferma all'utente
     await query.edit_message_text(
@@ -1443,11 +1484,16 @@ async def confirm_cancel_booking(update: Update, context: ContextTypes.DEFAULT_T
         result = cancel_booking(booking_id)
         
         # Rimuoviamo la prenotazione dalle prescrizioni
-        prescriptions = load_input_data()
-        for p in prescriptions:
-            if "bookings" in p:
-                p["bookings"] = [b for b in p["bookings"] if b["booking_id"] != booking_id]
-        save_input_data(prescriptions)
+        repository = get_repository()
+        p, _ = repository.find_booking(booking_id)
+        if p is not None:
+            remaining = [b for b in p["bookings"] if b["booking_id"] != booking_id]
+            
+            # Disdetta l'ultima prenotazione, la prescrizione torna prenotabile
+            if not remaining and get_state(p) == STATE_BOOKED:
+                set_entry_state(p, STATE_PENDING, "prenotazione disdetta", {"bookings": remaining})
+            else:
+                repository.update(p, {"bookings": remaining})
         
         # Inviamo il messaggio di conferma
         await query.edit_message_text(
@@ -1469,23 +1515,20 @@ async def autobook_prescription(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     if not user_prescriptions:
         await update.message.reply_text("⚠️ Non hai prescrizioni da prenotare automaticamente.")
@@ -1585,23 +1628,20 @@ async def set_date_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
-    # Carichiamo le prescrizioni
-    prescriptions = load_input_data()
-    
     # Filtriamo solo le prescrizioni dell'utente o tutte se è admin
-    is_admin = user_id == int(authorized_users[0]) if authorized_users else False
-    user_prescriptions = []
+    is_admin = get_user_registry().is_admin(user_id)
+    repository = get_repository()
     
     if is_admin:
         # L'admin vede tutte le prescrizioni
-        user_prescriptions = prescriptions
+        user_prescriptions = repository.all()
     else:
         # Gli utenti normali vedono solo le proprie
-        user_prescriptions = [p for p in prescriptions if p.get("telegram_chat_id") == user_id]
+        user_prescriptions = repository.for_chat(user_id)
     
     if not user_prescriptions:
         await update.message.reply_text("⚠️ Non hai prescrizioni da gestire.")
@@ -1805,28 +1845,13 @@ async def confirm_date_filter(update: Update, context: ContextTypes.DEFAULT_TYPE
     prescription = user_data[user_id]["selected_prescription"]
     months_limit = user_data[user_id]["months_limit"]
     
-    # Carichiamo tutte le prescrizioni
-    all_prescriptions = load_input_data()
-    
-    # Cerchiamo la prescrizione nel dataset completo
-    updated = False
-    for p in all_prescriptions:
-        if (p["fiscal_code"] == prescription["fiscal_code"] and 
-            p["nre"] == prescription["nre"]):
-            
-            # Assicuriamo che esista la configurazione
-            if "config" not in p:
-                p["config"] = {}
-            
-            # Aggiorniamo il filtro date
-            p["config"]["months_limit"] = months_limit
-            
-            updated = True
-            break
+    # Cerchiamo la prescrizione tra quelle monitorate
+    repository = get_repository()
+    p = repository.get(prescription["fiscal_code"], prescription["nre"], prescription.get("telegram_chat_id"))
     
-    if updated:
-        # Salviamo le prescrizioni aggiornate
-        save_input_data(all_prescriptions)
+    if p is not None:
+        # Aggiorniamo il filtro date
+        repository.update(p, {"config": dict(p.get("config") or {}, months_limit=months_limit)})
         
         # Testo da visualizzare nel messaggio
         filter_text = f"{months_limit} mesi" if months_limit is not None else "nessun limite"
@@ -1856,10 +1881,18 @@ async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         await update.message.reply_text("🔒 Non sei autorizzato ad utilizzare questa funzione.")
         return
     
+    # Frequenza di controllo dalla configurazione del monitoraggio
+    if MONITORING_INTERVAL % 60 == 0:
+        frequency = f"Ogni {MONITORING_INTERVAL // 60} minuti"
+    else:
+        frequency = f"Ogni {MONITORING_INTERVAL} secondi"
+    if POLLING_SCHEDULE.get("windows"):
+        frequency += " (ridotta fuori dalle fasce orarie attive e nei giorni festivi)"
+    
     await update.message.reply_text(
         "ℹ️ <b>Informazioni sul Bot</b>\n\n"
         "Questo bot monitora le disponibilità del Servizio Sanitario Nazionale (SSN) per le prescrizioni mediche e ti notifica quando ci sono nuove disponibilità.\n\n"
@@ -1869,11 +1902,12 @@ async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📋 <b>Lista Prescrizioni</b> - Visualizza le prescrizioni monitorate\n"
         "🔄 <b>Verifica Disponibilità</b> - Controlla subito le disponibilità\n"
         "🔔 <b>Gestisci Notifiche</b> - Attiva/disattiva notifiche per una prescrizione\n"
+        "⏯ <b>Sospendi/Riattiva</b> - Sospendi o riprendi il monitoraggio di una prescrizione\n"
         "⏱ <b>Imposta Filtro Date</b> - Filtra le notifiche entro un periodo di mesi\n"
         "🏥 <b>Prenota</b> - Prenota un appuntamento per una prescrizione\n"
         "🤖 <b>Prenota Automaticamente</b> - Prenota automaticamente il primo slot disponibile\n"
         "📝 <b>Le mie Prenotazioni</b> - Visualizza e gestisci le prenotazioni attive\n\n"
-        "<b>Frequenza di controllo:</b> Ogni 5 minuti\n\n"
+        f"<b>Frequenza di controllo:</b> {frequency}\n\n"
         "<b>Note:</b>\n"
         "• Il bot notifica solo quando ci sono cambiamenti significativi\n"
         "• Le disponibilità possono variare rapidamente, è consigliabile prenotare il prima possibile\n"
@@ -1887,7 +1921,7 @@ async def authorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Solo l'amministratore può autorizzare nuovi utenti
     # L'amministratore è il primo utente nella lista degli autorizzati
-    if not authorized_users or str(user_id) != authorized_users[0]:
+    if not get_user_registry().is_admin(user_id):
         await update.message.reply_text("🔒 Solo l'amministratore può autorizzare nuovi utenti.")
         return
     
@@ -1917,20 +1951,46 @@ async def handle_auth_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     # Controlliamo se è già autorizzato
-    if new_user_id in authorized_users:
+    users = get_user_registry()
+    if users.is_authorized(new_user_id):
         await update.message.reply_text(f"⚠️ L'utente {new_user_id} è già autorizzato.")
         user_data.pop(user_id, None)  # Puliamo i dati dell'utente
         return
     
-    # Aggiungiamo l'utente alla lista degli autorizzati
-    authorized_users.append(new_user_id)
-    save_authorized_users()
+    # Aggiungiamo l'utente agli autorizzati
+    if not users.add(new_user_id) and not users.is_authorized(new_user_id):
+        await update.message.reply_text("❌ Errore nel salvare l'utente autorizzato. Riprova più tardi.")
+        user_data.pop(user_id, None)
+        return
     
     await update.message.reply_text(f"✅ Utente {new_user_id} autorizzato con successo!")
     
     # Puliamo i dati dell'utente
     user_data.pop(user_id, None)
 
+async def cleanup_previous_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Gestore del comando /pulizia: pulizia immediata dei dati precedenti (solo amministratore)."""
+    user_id = update.effective_user.id
+    
+    if not get_user_registry().is_admin(user_id):
+        await update.message.reply_text("🔒 Solo l'amministratore può eseguire la pulizia dei dati.")
+        return
+    
+    # Le prescrizioni appena aggiunte devono essere salvate, altrimenti i loro dati risulterebbero orfani
+    get_repository().flush()
+    result = run_previous_data_retention(grace=False)
+    if result is None:
+        await update.message.reply_text("❌ Errore durante la pulizia dei dati precedenti. Controlla i log.")
+        return
+    
+    await update.message.reply_text(
+        "🧹 <b>Pulizia dei dati precedenti completata</b>\n\n"
+        f"Prescrizioni non più monitorate rimosse: {len(result['removed'])}\n"
+        f"Prescrizioni con disponibilità ridotte: {len(result['trimmed'])}\n"
+        f"Spazio recuperato: {result['bytes'] / 1024:.1f} KB",
+        parse_mode="HTML"
+    )
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce i messaggi di testo e i comandi dai pulsanti."""
     user_id = update.effective_user.id
@@ -1954,11 +2014,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return await handle_email(update, context)
     
     # Controlliamo se l'utente è autorizzato
-    if str(user_id) not in authorized_users:
+    if not get_user_registry().is_authorized(user_id):
         # Se non ci sono utenti autorizzati, il primo utente diventa automaticamente amministratore
-        if not authorized_users:
-            authorized_users.append(str(user_id))
-            save_authorized_users()
+        if get_user_registry().claim_admin(user_id):
             logger.info(f"Primo utente {user_id} aggiunto come amministratore")
             
             # Inviamo un messaggio di benvenuto come amministratore
@@ -1968,7 +2026,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ["🔔 Gestisci Notifiche", "⏱ Imposta Filtro Date"],
                 ["🏥 Prenota", "🤖 Prenota Automaticamente"],
                 ["📝 Le mie Prenotazioni", "ℹ️ Informazioni"],
-                ["🔑 Autorizza Utente"]
+                ["⏯ Sospendi/Riattiva", "🔑 Autorizza Utente"]
             ]
             reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
             
@@ -2006,6 +2064,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await list_bookings(update, context)
     elif text == "ℹ️ Informazioni":
         return await show_info(update, context)
+    elif text == "⏯ Sospendi/Riattiva":
+        return await pause_prescription(update, context)
     elif text == "🔑 Autorizza Utente":
         return await authorize_user(update, context)
     else:
@@ -2018,7 +2078,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ["🔔 Gestisci Notifiche", "⏱ Imposta Filtro Date"],
                 ["🏥 Prenota", "🤖 Prenota Automaticamente"],
                 ["📝 Le mie Prenotazioni", "ℹ️ Informazioni"],
-                ["🔑 Autorizza Utente"]
+                ["⏯ Sospendi/Riattiva", "🔑 Autorizza Utente"]
             ], resize_keyboard=True)
         )
 
@@ -2066,6 +2126,9 @@ def setup_handlers(application):
             WAITING_FOR_PRESCRIPTION_TO_TOGGLE: [
                 CallbackQueryHandler(handle_prescription_toggle)
             ],
+            WAITING_FOR_PRESCRIPTION_TO_PAUSE: [
+                CallbackQueryHandler(handle_prescription_pause)
+            ],
             WAITING_FOR_DATE_FILTER: [
                 CallbackQueryHandler(handle_prescription_date_filter)
             ],
@@ -2112,6 +2175,9 @@ def setup_handlers(application):
     # Gestore per la cancellazione di prenotazioni
     application.add_handler(CallbackQueryHandler(start_cancel_booking, pattern="^cancel_appointment$"))
     
+    # Comando dell'amministratore per la pulizia dei dati precedenti
+    application.add_handler(CommandHandler("pulizia", cleanup_previous_data))
+    
     # Gestore errori
     application.add_error_handler(error_handler)
     
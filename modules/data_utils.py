@@ -1,182 +1,826 @@
 import os
 import json
+import fcntl
+import shutil
+import threading
 import logging
-from datetime import datetime, timedelta
+from contextlib import contextmanager
 
 # Importa costanti e configurazioni dal modulo config
 from config import (
     logger, INPUT_FILE, PREVIOUS_DATA_FILE, USERS_FILE,
-    authorized_users
+    PREVIOUS_DATA_JOURNAL, PREVIOUS_DATA_JOURNAL_MAX_BYTES, STORAGE_BACKEND, FSYNC_MODE,
+    PREVIOUS_DATA_FORMAT, PREVIOUS_DATA_SNAPSHOT_FILE, PREVIOUS_DATA_MAX_SLOTS
 )
+from modules.slots import encode_slots, decode_slots, is_legacy_format, trim_encoded_slots
+from modules.hospital_registry import save_registry
+from modules.snapshot_file import pack_snapshot, read_snapshot
+from modules.state_events import publish, TOPIC_PRESCRIPTIONS, TOPIC_PREVIOUS_DATA
 
-def load_authorized_users():
-    """Carica gli utenti autorizzati dal file."""
-    global authorized_users
-    try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                authorized_users.clear()
-                authorized_users.extend(json.load(f))
-            logger.info(f"Caricati {len(authorized_users)} utenti autorizzati")
-        else:
-            # Se il file non esiste, lo creiamo con un array vuoto
-            with open(USERS_FILE, 'w') as f:
-                json.dump([], f)
-            logger.info("Creato nuovo file di utenti autorizzati")
-    except Exception as e:
-        logger.error(f"Errore nel caricare gli utenti autorizzati: {str(e)}")
+@contextmanager
+def file_lock(path):
+    """Lock esclusivo tra processi (e tra thread), ottenuto su un file di lock accanto a path."""
+    with open(f"{path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Salvataggi in corso in un gruppo (vedi fsync_batch) e file ancora da sincronizzare
+_fsync_lock = threading.Lock()
+_batch_depth = 0
+_unsynced = set()
 
-def save_authorized_users():
-    """Salva gli utenti autorizzati su file."""
+def _fsync_path(path):
+    """Sincronizza su disco un file o una directory già chiusi."""
+    fd = os.open(path, os.O_RDONLY)
     try:
-        with open(USERS_FILE, 'w') as f:
-            json.dump(authorized_users, f, indent=2)
-        logger.info("Utenti autorizzati salvati con successo")
-    except Exception as e:
-        logger.error(f"Errore nel salvare gli utenti autorizzati: {str(e)}")
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_file(f, path, durable=False):
+    """
+    Sincronizza su disco un file aperto, secondo FSYNC_MODE.
+
+    In un gruppo di salvataggi (vedi fsync_batch) la sincronizzazione viene
+    rimandata alla fine del gruppo, salvo con durable.
+    """
+    if FSYNC_MODE == "never":
+        return
+    f.flush()
+    if not durable and FSYNC_MODE == "batch":
+        with _fsync_lock:
+            if _batch_depth:
+                _unsynced.add(os.path.abspath(path))
+                return
+    os.fsync(f.fileno())
+
+def _sync_directory(path, durable=False):
+    """Sincronizza la directory di path, perché la rinomina sia persistente."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if FSYNC_MODE == "never":
+        return
+    if not durable and FSYNC_MODE == "batch":
+        with _fsync_lock:
+            if _batch_depth:
+                _unsynced.add(directory)
+                return
+    _fsync_path(directory)
 
-def format_date(date_string):
-    """Formatta la data ISO in un formato più leggibile."""
+@contextmanager
+def fsync_batch():
+    """
+    Raggruppa i salvataggi di un ciclo: ogni file viene sincronizzato una sola volta, alla fine.
+
+    Vale per tutti i thread del processo. Se il processo si interrompe prima
+    della fine del gruppo, i file scritti nel gruppo possono risultare
+    incompleti: la loro copia di riserva (.bak) è l'ultima versione sincronizzata.
+    """
+    global _batch_depth
+    with _fsync_lock:
+        _batch_depth += 1
     try:
-        # Parse della data ISO
-        dt = datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ")
-        # Formatta la data in italiano
-        weekdays = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
-        months = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", 
-                  "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
-        
-        weekday = weekdays[dt.weekday()]
-        day = dt.day
-        month = months[dt.month - 1]
-        year = dt.year
-        time = dt.strftime("%H:%M")
-        
-        return f"{weekday} {day} {month} {year}, ore {time}"
-    except Exception as e:
-        logger.warning(f"Errore nella formattazione della data {date_string}: {str(e)}")
-        return date_string
+        yield
+    finally:
+        with _fsync_lock:
+            _batch_depth -= 1
+            paths = set()
+            if not _batch_depth:
+                paths = set(_unsynced)
+                _unsynced.clear()
+        # Prima i file, poi le directory con le rinomine
+        for path in sorted(paths, key=os.path.isdir):
+            try:
+                _fsync_path(path)
+            except OSError as e:
+                logger.error(f"Errore nel sincronizzare {path} su disco: {str(e)}")
 
-def is_date_within_range(date_str, months_limit=None):
+def write_file_atomic(path, write, mode='w', backup=True, durable=False):
     """
-    Verifica se una data è compresa nell'intervallo di oggi fino a X mesi.
-    
+    Scrive un file in modo atomico: file temporaneo, fsync e rinomina.
+
+    Chi legge il file trova sempre la versione precedente o quella nuova,
+    completa. Con backup, la versione precedente resta disponibile come
+    path.bak (vedi read_json_file), purché sia già sincronizzata su disco.
+
+    Args:
+        path: Il file da scrivere
+        write: Funzione che riceve il file temporaneo aperto e ne scrive il contenuto
+        mode: Modalità di apertura del file temporaneo ('w' o 'wb')
+        backup: Conserva la versione precedente come copia di riserva
+        durable: Sincronizza subito anche in un gruppo di salvataggi (vedi fsync_batch)
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+        sync_file(f, path, durable)
+
+    if backup and os.path.exists(path):
+        with _fsync_lock:
+            synced = os.path.abspath(path) not in _unsynced
+        # Una versione non ancora sincronizzata non sostituisce la copia di riserva
+        if synced:
+            backup_tmp = f"{path}.bak.tmp"
+            try:
+                if os.path.exists(backup_tmp):
+                    os.remove(backup_tmp)
+                os.link(path, backup_tmp)
+            except OSError:
+                shutil.copyfile(path, backup_tmp)
+            os.replace(backup_tmp, f"{path}.bak")
+
+    os.replace(tmp_path, path)
+    _sync_directory(path, durable)
+
+def read_file_with_backup(path, read, default=None):
+    """
+    Legge un file, usando la copia di riserva (path.bak) se il file è danneggiato.
+
+    Un file troncato o vuoto non viene mai scambiato per un insieme vuoto:
+    se anche la copia di riserva non è leggibile viene sollevata l'eccezione.
+    La copia di riserva usata viene ripristinata al posto del file danneggiato.
+
     Args:
-        date_str: La data in formato ISO da verificare
-        months_limit: Il numero di mesi limite. Se None, non c'è limite
-    
+        read: Funzione che riceve il percorso e restituisce il contenuto
+            (solleva ValueError o OSError se il file non è valido)
+        default: Il valore da restituire se il file non esiste
+
     Returns:
-        bool: True se la data è nell'intervallo, False altrimenti
+        Il contenuto del file (o della copia di riserva)
     """
-    if months_limit is None:
-        return True  # Nessun limite impostato
-    
+    if not os.path.exists(path):
+        return default
     try:
-        # Convertiamo la data da verificare
-        date = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
-        
-        # Data di oggi e limite
-        today = datetime.now()
-        limit_date = today + timedelta(days=30 * months_limit)
-        
-        # Verifichiamo che la data sia successiva a oggi e entro il limite
-        return today <= date <= limit_date
-    except Exception as e:
-        logger.warning(f"Errore nel verificare l'intervallo di date: {str(e)}")
-        return True  # In caso di errore, non filtriamo la data
+        return read(path)
+    except (OSError, ValueError) as e:
+        backup_path = f"{path}.bak"
+        if not os.path.exists(backup_path):
+            raise
+        logger.error(f"File {path} non leggibile ({str(e)}): uso la copia di riserva {backup_path}")
 
-def load_input_data():
-    """Load prescription data from input file."""
+    data = read(backup_path)
+    # Ripristiniamo il file, lasciando intatta la copia di riserva
+    with open(backup_path, 'rb') as backup:
+        write_file_atomic(path, lambda f: shutil.copyfileobj(backup, f), mode='wb', backup=False, durable=True)
+    return data
+
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def read_json_file(path, default=None):
+    """Legge un file JSON, con la copia di riserva (vedi read_file_with_backup)."""
+    return read_file_with_backup(path, _load_json, default)
+
+def get_file_signature(path):
+    """
+    Restituisce la firma di un file (data di modifica e dimensione).
+
+    Returns:
+        tuple: (mtime in nanosecondi, dimensione), None se il file non esiste
+    """
     try:
-        if os.path.exists(INPUT_FILE):
-            with open(INPUT_FILE, 'r') as f:
-                return json.load(f)
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def matches_prescription(prescription, fiscal_code=None, nre=None, chat_id=None):
+    """Verifica se una voce corrisponde ai criteri indicati (None = qualsiasi valore)."""
+    return ((fiscal_code is None or prescription.get("fiscal_code") == fiscal_code) and
+            (nre is None or prescription.get("nre") == nre) and
+            (chat_id is None or str(prescription.get("telegram_chat_id")) == str(chat_id)))
+
+def get_entry_id(prescription):
+    """Identificativo di una singola voce del file (prescrizione + chat)."""
+    return (prescription["fiscal_code"], prescription["nre"], str(prescription.get("telegram_chat_id", "")))
+
+def apply_entry_changes(prescriptions, inserted=(), updated=(), deleted=()):
+    """
+    Applica a una lista di voci le modifiche raccolte per identificativo (vedi get_entry_id).
+
+    Args:
+        prescriptions: Le voci da modificare (la lista viene modificata)
+        inserted: Voci complete da aggiungere (o da sostituire, se già presenti)
+        updated: Coppie (identificativo, campi) con i soli campi modificati
+        deleted: Identificativi delle voci da rimuovere
+
+    Returns:
+        int: Il numero di voci aggiunte, modificate o rimosse
+    """
+    positions = {get_entry_id(p): i for i, p in enumerate(prescriptions)}
+    changed = 0
+    for prescription in inserted:
+        position = positions.get(get_entry_id(prescription))
+        if position is None:
+            positions[get_entry_id(prescription)] = len(prescriptions)
+            prescriptions.append(prescription)
+        else:
+            prescriptions[position] = prescription
+        changed += 1
+    for entry_id, fields in updated:
+        position = positions.get(entry_id)
+        # Una voce rimossa nel frattempo da un altro processo non viene ricreata
+        if position is not None:
+            prescriptions[position].update(fields)
+            changed += 1
+    removed = {entry_id for entry_id in deleted if entry_id in positions}
+    if removed:
+        prescriptions[:] = [p for p in prescriptions if get_entry_id(p) not in removed]
+        changed += len(removed)
+    return changed
+
+def convert_legacy_previous_data(stored):
+    """
+    Converte nel formato compatto le voci dei dati precedenti ancora nel formato precedente.
+
+    Returns:
+        int: Il numero di voci convertite
+    """
+    legacy_keys = [key for key, value in stored.items() if is_legacy_format(value)]
+    for key in legacy_keys:
+        stored[key] = encode_slots(decode_slots(stored[key]))
+    # Le voci convertite fanno riferimento a ospedali e sedi del registro
+    if legacy_keys:
+        save_registry()
+    return len(legacy_keys)
+
+class JsonStorage:
+    """
+    Archivio su file JSON: un file per prescrizioni, utenti e dati precedenti.
+
+    I dati precedenti sono uno snapshot più un journal append-only (vedi
+    checkpoint_previous_data). Le ricerche leggono l'intero file. Ogni file
+    viene scritto con write_file_atomic e letto con read_json_file.
+    Stessi metodi di modules.sqlite_storage.SqliteStorage; i dati precedenti
+    sono già nel formato da salvare (vedi modules.slots.encode_slots).
+    """
+    name = "json"
+
+    # --- Utenti autorizzati ---
+
+    def load_users(self):
+        """Restituisce gli utenti autorizzati (None in caso di errore)."""
+        try:
+            users = read_json_file(USERS_FILE)
+            if users is not None:
+                return users
+            # Se il file non esiste, lo creiamo con un array vuoto
+            write_file_atomic(USERS_FILE, lambda f: json.dump([], f))
+            logger.info("Creato nuovo file di utenti autorizzati")
+            return []
+        except Exception as e:
+            logger.error(f"Errore nel caricare gli utenti autorizzati: {str(e)}")
+            return None
+
+    def save_users(self, users):
+        """Salva gli utenti autorizzati (True se il salvataggio è riuscito)."""
+        try:
+            write_file_atomic(USERS_FILE, lambda f: json.dump(users, f, indent=2))
+            logger.info("Utenti autorizzati salvati con successo")
+            return True
+        except Exception as e:
+            logger.error(f"Errore nel salvare gli utenti autorizzati: {str(e)}")
+            return False
+
+    def users_signature(self):
+        """La firma degli utenti autorizzati salvati, che cambia a ogni modifica."""
+        return get_file_signature(USERS_FILE)
+
+    # --- Prescrizioni ---
+
+    def _read_prescriptions(self):
+        """Legge le prescrizioni, sollevando un'eccezione se il file non è leggibile."""
+        prescriptions = read_json_file(INPUT_FILE)
+        if prescriptions is not None:
+            return prescriptions
         # Se il file non esiste, lo creiamo con un array vuoto
-        with open(INPUT_FILE, 'w') as f:
-            json.dump([], f)
+        write_file_atomic(INPUT_FILE, lambda f: json.dump([], f))
         logger.info("Creato nuovo file di prescrizioni")
         return []
-    except Exception as e:
-        logger.error(f"Errore nel caricare i dati di input: {str(e)}")
-        return []
+
+    def load_prescriptions(self):
+        """Load prescription data from input file (None se il file non è leggibile)."""
+        try:
+            return self._read_prescriptions()
+        except Exception as e:
+            logger.error(f"Errore nel caricare i dati di input: {str(e)}")
+            return None
+
+    def prescriptions_signature(self):
+        """La firma delle prescrizioni salvate, che cambia a ogni modifica."""
+        return get_file_signature(INPUT_FILE)
+
+    def save_prescriptions(self, data):
+        """Salva i dati delle prescrizioni su file (True se il salvataggio è riuscito)."""
+        with file_lock(INPUT_FILE):
+            return self._write_prescriptions(data)
+
+    def _write_prescriptions(self, data):
+        """
+        Scrive i dati delle prescrizioni (il chiamante deve avere il lock del file).
+
+        Il file viene scritto con write_file_atomic: chi lo legge trova
+        sempre la versione precedente o quella nuova, completa.
+        """
+        try:
+            file_path = os.path.abspath(INPUT_FILE)
+
+            # Verifica se la directory esiste
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            # Salva con indentazione per leggibilità
+            write_file_atomic(file_path, lambda f: json.dump(data, f, indent=2))
+            logger.info(f"Dati delle prescrizioni salvati con successo ({len(data)} prescrizioni)")
+            return True
+        except Exception as e:
+            logger.error(f"Errore nel salvare i dati delle prescrizioni: {str(e)}")
+
+            # Tentativo di recupero
+            try:
+                # Prova a salvare in una posizione alternativa
+                alt_path = os.path.join(os.path.expanduser("~"), "recup_prescriptions.json")
+                logger.info(f"Tentativo di salvare in posizione alternativa: {alt_path}")
+
+                with open(alt_path, 'w') as f:
+                    json.dump(data, f, indent=2)
+
+                logger.info(f"Dati salvati nella posizione alternativa: {alt_path}")
+                logger.info(f"Modifica la variabile INPUT_FILE nel codice: {alt_path}")
+            except Exception as alt_e:
+                logger.error(f"Anche il salvataggio alternativo è fallito: {str(alt_e)}")
+            return False
+
+    def find_prescriptions(self, fiscal_code=None, nre=None, chat_id=None):
+        """Restituisce le voci che corrispondono ai criteri (None = qualsiasi valore)."""
+        return [p for p in self.load_prescriptions() or [] if matches_prescription(p, fiscal_code, nre, chat_id)]
+
+    def apply_prescription_changes(self, inserted=(), updated=(), deleted=()):
+        """
+        Applica un gruppo di modifiche per voce (vedi apply_entry_changes) con una sola scrittura.
+
+        Returns:
+            tuple: (firma prima delle modifiche, firma dopo), None se la scrittura non è riuscita
+        """
+        with file_lock(INPUT_FILE):
+            before = self.prescriptions_signature()
+            # Se il file non è leggibile l'eccezione annulla la scrittura
+            prescriptions = self._read_prescriptions()
+            if apply_entry_changes(prescriptions, inserted, updated, deleted):
+                if not self._write_prescriptions(prescriptions):
+                    return None
+            return before, self.prescriptions_signature()
+
+    def update_prescription_fields(self, fiscal_code, nre, fields, skip_states=()):
+        """Aggiorna alcuni campi delle voci con lo stesso codice fiscale e NRE (tranne quelle negli stati skip_states)."""
+        # Il monitoraggio aggiorna le prescrizioni da più thread: lettura e
+        # scrittura devono avvenire senza modifiche intermedie
+        with file_lock(INPUT_FILE):
+            prescriptions = self._read_prescriptions()
+            updated = False
+
+            for p in prescriptions:
+                if p["fiscal_code"] == fiscal_code and p["nre"] == nre and p.get("state") not in skip_states:
+                    for key, value in fields.items():
+                        if p.get(key) != value:
+                            p[key] = value
+                            updated = True
+
+            # Salviamo solo se qualcosa è effettivamente cambiato
+            if updated:
+                self._write_prescriptions(prescriptions)
+        return updated
+
+    def find_booking(self, booking_id):
+        """Restituisce (voce, prenotazione) con l'id indicato, (None, None) se non esiste."""
+        for p in self.load_prescriptions() or []:
+            for booking in p.get("bookings") or []:
+                if str(booking.get("booking_id")) == str(booking_id):
+                    return p, booking
+        return None, None
+
+    # --- Dati precedenti ---
+
+    def _replay_previous_data_journal(self, data, keys=None):
+        """Applica al dizionario le voci del journal dei dati precedenti (solo di keys, se indicate)."""
+        if not os.path.exists(PREVIOUS_DATA_JOURNAL):
+            return 0
+
+        applied = 0
+        with open(PREVIOUS_DATA_JOURNAL, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Tipicamente l'ultima riga, troncata da un'interruzione durante la scrittura
+                    logger.warning("Ignorata una voce non valida nel journal dei dati precedenti")
+                    continue
+
+                if keys is not None and entry["key"] not in keys:
+                    continue
+                if entry.get("deleted"):
+                    data.pop(entry["key"], None)
+                else:
+                    data[entry["key"]] = entry["value"]
+                applied += 1
+        return applied
+
+    @staticmethod
+    def _snapshot_files():
+        """I file dello snapshot: prima quello del formato configurato, poi l'altro."""
+        if PREVIOUS_DATA_FORMAT == "binary":
+            return PREVIOUS_DATA_SNAPSHOT_FILE, PREVIOUS_DATA_FILE
+        return PREVIOUS_DATA_FILE, PREVIOUS_DATA_SNAPSHOT_FILE
+
+    def _read_snapshot(self, keys=None):
+        """
+        Legge lo snapshot dei dati precedenti (solo le chiavi keys, se indicate).
+
+        Dopo un cambio di PREVIOUS_DATA_FORMAT viene letto lo snapshot nel
+        formato precedente, finché la compattazione non lo converte.
+        """
+        for path in self._snapshot_files():
+            if not os.path.exists(path):
+                continue
+            if path == PREVIOUS_DATA_SNAPSHOT_FILE:
+                # Con il formato binario vengono decodificate solo le chiavi richieste
+                return read_file_with_backup(path, lambda p: read_snapshot(p, keys))
+            data = read_json_file(path)
+            return data if keys is None else {key: data[key] for key in keys if key in data}
+        return {}
+
+    def _read_previous_data(self, keys=None):
+        """Legge lo snapshot dei dati precedenti e applica il journal."""
+        data = self._read_snapshot(keys)
+        self._replay_previous_data_journal(data, keys)
+        return data
+
+    def _write_previous_data(self, data):
+        """Scrive lo snapshot completo dei dati precedenti e svuota il journal."""
+        path, other_path = self._snapshot_files()
+        # Lo snapshot va sincronizzato prima di svuotare il journal, anche in un gruppo
+        if path == PREVIOUS_DATA_SNAPSHOT_FILE:
+            content = pack_snapshot(data)
+            write_file_atomic(path, lambda f: f.write(content), mode='wb', durable=True)
+        else:
+            write_file_atomic(path, lambda f: json.dump(data, f, separators=(",", ":")), durable=True)
+
+        # Lo snapshot nell'altro formato è ormai superato
+        for stale_path in (other_path, f"{other_path}.bak"):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        # Lo snapshot contiene ormai tutte le voci del journal
+        open(PREVIOUS_DATA_JOURNAL, 'w').close()
+
+    def load_previous_data(self):
+        """Load previous availability data (snapshot + journal)."""
+        with file_lock(PREVIOUS_DATA_FILE):
+            if any(os.path.exists(path) for path in self._snapshot_files() + (PREVIOUS_DATA_JOURNAL,)):
+                return self._read_previous_data()
+            # Se il file non esiste, lo creiamo vuoto
+            self._write_previous_data({})
+            logger.info("Creato nuovo file di dati precedenti")
+            return {}
+
+    def load_previous_entries(self, keys):
+        """Restituisce gli snapshot delle sole chiavi indicate (quelle presenti)."""
+        with file_lock(PREVIOUS_DATA_FILE):
+            return self._read_previous_data(set(keys))
+
+    def save_previous_data(self, data):
+        """Save a full snapshot of the availability data and reset the journal."""
+        with file_lock(PREVIOUS_DATA_FILE):
+            self._write_previous_data(data)
+
+    def checkpoint_previous_data(self, key, value=None, deleted=False):
+        """Aggiunge in coda al journal lo snapshot di una sola prescrizione."""
+        entry = {"key": key, "deleted": True} if deleted else {"key": key, "value": value}
+        with file_lock(PREVIOUS_DATA_FILE):
+            with open(PREVIOUS_DATA_JOURNAL, 'a+') as f:
+                line = json.dumps(entry, separators=(",", ":")) + "\n"
+                # Se l'ultima scrittura è stata interrotta, iniziamo comunque una nuova riga
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != "\n":
+                        line = "\n" + line
+                f.write(line)
+                sync_file(f, PREVIOUS_DATA_JOURNAL)
+
+    def compact_previous_data(self, force=False):
+        """
+        Compatta il journal nello snapshot dei dati precedenti.
+
+        Lo snapshot viene ricostruito dal disco (e non dai dati in memoria), così
+        da includere anche le voci scritte da altri processi. Le voci ancora nel
+        formato precedente (disponibilità complete) vengono convertite in quello compatto.
+        """
+        with file_lock(PREVIOUS_DATA_FILE):
+            journal_size = os.path.getsize(PREVIOUS_DATA_JOURNAL) if os.path.exists(PREVIOUS_DATA_JOURNAL) else 0
+            if not force and journal_size < PREVIOUS_DATA_JOURNAL_MAX_BYTES:
+                return False
+
+            stored = self._read_previous_data()
+            converted = convert_legacy_previous_data(stored)
+            # Anche uno snapshot nel formato non configurato va convertito
+            if journal_size == 0 and not converted and os.path.exists(self._snapshot_files()[0]):
+                return False
+            self._write_previous_data(stored)
+        logger.info(f"Journal dei dati precedenti compattato ({journal_size} bytes, "
+                    f"{converted} voci convertite nel formato compatto)")
+        return True
+
+    def _previous_data_size(self):
+        """La dimensione complessiva di snapshot e journal dei dati precedenti (in byte)."""
+        return sum(os.path.getsize(path) for path in self._snapshot_files() + (PREVIOUS_DATA_JOURNAL,)
+                   if os.path.exists(path))
+
+    def prune_previous_data(self, live_keys, max_slots=None, removable=None):
+        """
+        Rimuove le chiavi orfane e riduce le disponibilità di ogni prescrizione (vedi prune_stored_previous_data).
+
+        Lo snapshot viene riscritto (compattando anche il journal) solo se qualcosa è cambiato.
+        """
+        with file_lock(PREVIOUS_DATA_FILE):
+            size_before = self._previous_data_size()
+            stored = self._read_previous_data()
+            result = prune_stored_previous_data(stored, live_keys, max_slots, removable)
+            if result["removed"] or result["trimmed"]:
+                self._write_previous_data(stored)
+            result["bytes"] = size_before - self._previous_data_size()
+        return result
+
+def prune_stored_previous_data(stored, live_keys, max_slots=None, removable=None):
+    """
+    Applica la conservazione ai dati precedenti salvati (il dizionario viene modificato).
+
+    Args:
+        stored: Chiave -> dati salvati
+        live_keys: Le chiavi delle prescrizioni ancora presenti
+        max_slots: Le disponibilità da conservare per prescrizione (None = tutte)
+        removable: Le sole chiavi orfane da rimuovere (None = tutte)
+
+    Returns:
+        dict: {"orphans": chiavi orfane trovate, "removed": rimosse, "trimmed": ridotte}
+    """
+    convert_legacy_previous_data(stored)
+    orphans = sorted(key for key in stored if key not in live_keys)
+    removed = [key for key in orphans if removable is None or key in removable]
+    for key in removed:
+        del stored[key]
+
+    trimmed = []
+    for key, value in stored.items():
+        trimmed_value = trim_encoded_slots(value, max_slots)
+        if trimmed_value is not None:
+            stored[key] = trimmed_value
+            trimmed.append(key)
+    return {"orphans": orphans, "removed": removed, "trimmed": trimmed}
+
+_storage = None
+
+def get_storage(backend=None):
+    """
+    Restituisce l'archivio configurato in STORAGE_BACKEND ("json" o "sqlite").
+
+    Args:
+        backend: Un archivio diverso da quello configurato (es. per la migrazione)
+    """
+    global _storage
+    if backend is not None and backend != STORAGE_BACKEND:
+        return _create_storage(backend)
+    if _storage is None:
+        _storage = _create_storage(STORAGE_BACKEND)
+    return _storage
+
+def _create_storage(backend):
+    if backend == "sqlite":
+        from modules.sqlite_storage import SqliteStorage
+        return SqliteStorage()
+    if backend != "json":
+        logger.error(f"Archivio {backend} sconosciuto, uso i file JSON")
+    return JsonStorage()
+
+def load_input_data():
+    """Load prescription data from the storage (lista vuota se non leggibili)."""
+    return get_storage().load_prescriptions() or []
+
+def load_input_data_if_changed(signature=None):
+    """
+    Ricarica le prescrizioni solo se sono cambiate dall'ultima lettura.
+
+    Args:
+        signature: La firma delle prescrizioni all'ultima lettura (None per forzare la lettura)
+
+    Se l'archivio non è leggibile le prescrizioni risultano non cambiate:
+    chi le ha in memoria continua a usarle, invece di trovarle tutte rimosse.
+
+    Returns:
+        tuple: (prescrizioni o None se non sono cambiate, nuova firma)
+    """
+    storage = get_storage()
+    # La firma va letta prima del contenuto: una modifica successiva
+    # verrà rilevata al controllo seguente
+    current_signature = storage.prescriptions_signature()
+    if signature is not None and current_signature == signature:
+        return None, signature
+
+    data = storage.load_prescriptions()
+    if data is None:
+        return None, signature
+    if current_signature is None:
+        current_signature = storage.prescriptions_signature()
+    return data, current_signature
 
 def save_input_data(data):
-    """Salva i dati delle prescrizioni su file con diagnostica migliorata."""
+    """Salva tutte le prescrizioni nell'archivio."""
+    get_storage().save_prescriptions(data)
+    publish(TOPIC_PRESCRIPTIONS)
+
+def find_prescriptions(fiscal_code=None, nre=None, chat_id=None):
+    """
+    Cerca le voci per codice fiscale, NRE e chat (None = qualsiasi valore).
+
+    Con l'archivio SQLite la ricerca usa gli indici invece di leggere tutte le prescrizioni.
+
+    Returns:
+        list: Le voci trovate, nell'ordine dell'archivio
+    """
+    return get_storage().find_prescriptions(fiscal_code, nre, chat_id)
+
+def get_changed_keys(inserted=(), updated=(), deleted=()):
+    """Le chiavi delle prescrizioni (codice fiscale_NRE) toccate da un gruppo di modifiche."""
+    entry_ids = [get_entry_id(p) for p in inserted] + [entry_id for entry_id, _ in updated] + list(deleted)
+    return sorted({f"{fiscal_code}_{nre}" for fiscal_code, nre, _ in entry_ids})
+
+def apply_prescription_changes(inserted=(), updated=(), deleted=()):
+    """
+    Salva in un'unica scrittura le modifiche a più voci (vedi apply_entry_changes).
+
+    Le voci non toccate restano come sono nell'archivio, comprese le modifiche
+    fatte nel frattempo da altri processi.
+
+    Returns:
+        tuple: (firma prima delle modifiche, firma dopo), None in caso di errore
+    """
     try:
-        file_path = os.path.abspath(INPUT_FILE)
-        logger.info(f"Tentativo di salvare i dati delle prescrizioni in: {file_path}")
-        
-        # Verifica se la directory esiste
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # Salva con indentazione per leggibilità
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=2)
-        
-        # Verifica che il file esista dopo il salvataggio
-        if os.path.exists(file_path):
-            file_size = os.path.getsize(file_path)
-            logger.info(f"Dati delle prescrizioni salvati con successo ({file_size} bytes)")
-            
-            # Leggi il file per verificare il contenuto
-            with open(file_path, 'r') as f:
-                content = json.load(f)
-                logger.info(f"Verificato il contenuto: {len(content)} prescrizioni")
-        else:
-            logger.error(f"Il file {file_path} non esiste dopo il salvataggio")
+        result = get_storage().apply_prescription_changes(inserted, updated, deleted)
     except Exception as e:
-        logger.error(f"Errore nel salvare i dati delle prescrizioni: {str(e)}")
-        
-        # Tentativo di recupero
-        try:
-            # Prova a salvare in una posizione alternativa
-            alt_path = os.path.join(os.path.expanduser("~"), "recup_prescriptions.json")
-            logger.info(f"Tentativo di salvare in posizione alternativa: {alt_path}")
-            
-            with open(alt_path, 'w') as f:
-                json.dump(data, f, indent=2)
-                
-            logger.info(f"Dati salvati nella posizione alternativa: {alt_path}")
-            logger.info(f"Modifica la variabile INPUT_FILE nel codice: {alt_path}")
-        except Exception as alt_e:
-            logger.error(f"Anche il salvataggio alternativo è fallito: {str(alt_e)}")
-
-def load_previous_data():
-    """Load previous availability data."""
+        logger.error(f"Errore nel salvare le modifiche alle prescrizioni: {str(e)}")
+        return None
+    if result is not None:
+        publish(TOPIC_PRESCRIPTIONS, get_changed_keys(inserted, updated, deleted))
+    return result
+
+def find_booking(booking_id):
+    """
+    Cerca una prenotazione registrata dal bot.
+
+    Returns:
+        tuple: (voce della prescrizione, prenotazione), (None, None) se non esiste
+    """
+    return get_storage().find_booking(booking_id)
+
+def update_prescription_fields(fiscal_code, nre, fields, skip_states=()):
+    """
+    Aggiorna alcuni campi di tutte le voci con lo stesso codice fiscale e NRE.
+
+    Args:
+        fiscal_code: Il codice fiscale della prescrizione
+        nre: Il codice NRE della prescrizione
+        fields: Dizionario con i campi da aggiornare
+        skip_states: Le voci in questi stati non vengono modificate
+
+    Returns:
+        bool: True se almeno una voce è stata aggiornata, False altrimenti
+    """
     try:
-        if os.path.exists(PREVIOUS_DATA_FILE):
-            with open(PREVIOUS_DATA_FILE, 'r') as f:
-                return json.load(f)
-        # Se il file non esiste, lo creiamo con un dizionario vuoto
-        with open(PREVIOUS_DATA_FILE, 'w') as f:
-            json.dump({}, f)
-        logger.info("Creato nuovo file di dati precedenti")
-        return {}
+        updated = get_storage().update_prescription_fields(fiscal_code, nre, fields, skip_states)
+    except Exception as e:
+        logger.error(f"Errore nell'aggiornare la prescrizione {fiscal_code}_{nre}: {str(e)}")
+        return False
+    if updated:
+        publish(TOPIC_PRESCRIPTIONS, [f"{fiscal_code}_{nre}"])
+    return updated
+
+def load_previous_data(strict=False, keys=None):
+    """
+    Load previous availability data as lists of Slot.
+
+    Args:
+        strict: Restituisce None (invece di un dizionario vuoto) se i dati non sono leggibili.
+            Senza i dati precedenti ogni disponibilità risulterebbe nuova
+        keys: Solo le prescrizioni indicate (None = tutte). Con lo snapshot binario
+            o con SQLite le altre prescrizioni non vengono lette
+
+    Returns:
+        dict: Chiave della prescrizione -> disponibilità
+    """
+    try:
+        storage = get_storage()
+        stored = storage.load_previous_data() if keys is None else storage.load_previous_entries(keys)
+        return {key: decode_slots(value) for key, value in stored.items()}
     except Exception as e:
         logger.error(f"Errore nel caricare i dati precedenti: {str(e)}")
-        return {}
+        return None if strict else {}
 
 def save_previous_data(data):
-    """Save current availability data for future comparison."""
+    """Save a full snapshot of the availability data."""
     try:
-        with open(PREVIOUS_DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        get_storage().save_previous_data({key: encode_slots(slots) for key, slots in data.items()})
         logger.info("Dati precedenti salvati con successo")
+        publish(TOPIC_PREVIOUS_DATA)
     except Exception as e:
         logger.error(f"Errore nel salvare i dati precedenti: {str(e)}")
 
-def is_similar_datetime(date1_str, date2_str, minutes_threshold=30):
-    """Controlla se due date sono simili entro un certo numero di minuti."""
+def checkpoint_previous_data(key, value=None, deleted=False):
+    """
+    Rende subito persistente lo snapshot di una sola prescrizione.
+
+    Con l'archivio JSON la voce viene aggiunta in coda al journal, con SQLite
+    viene aggiornata la sola riga: il costo della scrittura dipende solo dai
+    dati della prescrizione e non dall'intero archivio.
+
+    Args:
+        key: La chiave della prescrizione (codice fiscale_NRE)
+        value: Le disponibilità da memorizzare (lista di Slot)
+        deleted: True per rimuovere la chiave
+    """
     try:
-        dt1 = datetime.strptime(date1_str, "%Y-%m-%dT%H:%M:%SZ")
-        dt2 = datetime.strptime(date2_str, "%Y-%m-%dT%H:%M:%SZ")
-        
-        # Calcoliamo la differenza in minuti
-        diff_minutes = abs((dt2 - dt1).total_seconds() / 60)
-        
-        # Stessa data (giorno, mese, anno)?
-        same_day = (dt1.year == dt2.year and dt1.month == dt2.month and dt1.day == dt2.day)
-        
-        # Se è lo stesso giorno e la differenza è entro la soglia
-        return same_day and diff_minutes <= minutes_threshold
-    except Exception:
-        return False
\ No newline at end of file
+        get_storage().checkpoint_previous_data(key, None if deleted else encode_slots(value), deleted)
+        publish(TOPIC_PREVIOUS_DATA, [key])
+    except Exception as e:
+        logger.error(f"Errore nel salvare i dati precedenti per {key}: {str(e)}")
+
+def compact_previous_data(force=False):
+    """
+    Compatta i dati precedenti salvati (il journal JSON o il WAL di SQLite).
+
+    Args:
+        force: Compatta anche se il journal non ha raggiunto la dimensione massima
+
+    Returns:
+        bool: True se i dati sono stati compattati
+    """
+    try:
+        return get_storage().compact_previous_data(force)
+    except Exception as e:
+        logger.error(f"Errore nel compattare i dati precedenti: {str(e)}")
+        return False
+
+def prune_previous_data(live_keys, max_slots=PREVIOUS_DATA_MAX_SLOTS, removable=None):
+    """
+    Pulizia dei dati precedenti: rimuove le chiavi delle prescrizioni non più
+    presenti e conserva per ogni prescrizione solo le disponibilità più vicine.
+
+    Args:
+        live_keys: Le chiavi delle prescrizioni ancora presenti
+        max_slots: Le disponibilità da conservare per prescrizione (None = tutte)
+        removable: Le sole chiavi orfane da rimuovere (None = tutte)
+
+    Returns:
+        dict: {"orphans", "removed", "trimmed": liste di chiavi, "bytes": byte recuperati},
+            None in caso di errore
+    """
+    try:
+        result = get_storage().prune_previous_data(set(live_keys), max_slots, removable)
+    except Exception as e:
+        logger.error(f"Errore nella pulizia dei dati precedenti: {str(e)}")
+        return None
+
+    changed = result["removed"] + result["trimmed"]
+    if changed:
+        publish(TOPIC_PREVIOUS_DATA, changed)
+    logger.info(f"Pulizia dei dati precedenti: {len(result['removed'])} chiavi orfane rimosse "
+                f"({len(result['orphans']) - len(result['removed'])} in attesa), "
+                f"{len(result['trimmed'])} prescrizioni ridotte, {result['bytes']} bytes recuperati")
+    return result
+
+# Chiavi orfane trovate dall'ultima pulizia del processo, non ancora rimosse
+_pending_orphans = set()
+
+def run_previous_data_retention(grace=True):
+    """
+    Esegue la pulizia dei dati precedenti rispetto alle prescrizioni salvate.
+
+    Con grace una chiave orfana viene rimossa solo se lo era già alla pulizia
+    precedente: il bot salva lo snapshot di una prescrizione appena aggiunta
+    prima che la voce sia salvata (vedi PRESCRIPTION_FLUSH_DELAY).
+
+    Returns:
+        dict: Il risultato di prune_previous_data, None se la pulizia non è stata eseguita
+    """
+    global _pending_orphans
+    # Con le prescrizioni non leggibili ogni chiave risulterebbe orfana
+    prescriptions = get_storage().load_prescriptions()
+    if prescriptions is None:
+        logger.error("Pulizia dei dati precedenti rinviata: prescrizioni non leggibili")
+        return None
+
+    live_keys = {f"{p['fiscal_code']}_{p['nre']}" for p in prescriptions}
+    result = prune_previous_data(live_keys, removable=_pending_orphans if grace else None)
+    if result is not None:
+        _pending_orphans = set(result["orphans"]) - set(result["removed"])
+    return result
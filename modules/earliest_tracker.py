@@ -0,0 +1,93 @@
+import logging
+
+# Indice della prima disponibilità per ogni voce monitorata (prescrizione + chat),
+# aggiornato a ogni controllo: chiave -> EarliestIndex.
+# Non viene salvato: dopo un riavvio viene ricostruito dallo snapshot precedente.
+# Le voci di una prescrizione non più monitorata vengono eliminate con drop.
+_indexes = {}
+
+class EarliestIndex:
+    """La prima disponibilità di una voce, in assoluto e per ospedale."""
+    __slots__ = ("earliest", "hospitals")
+
+    def __init__(self, earliest=None, hospitals=None):
+        self.earliest = earliest
+        self.hospitals = hospitals if hospitals is not None else {}
+
+    @property
+    def epoch(self):
+        """L'orario della prima disponibilità, None se non ce ne sono."""
+        return self.earliest.epoch if self.earliest is not None else None
+
+def build_index(slots):
+    """
+    Costruisce l'indice con un solo passaggio sulle disponibilità.
+
+    Returns:
+        EarliestIndex: La prima disponibilità e la prima di ogni ospedale
+    """
+    earliest = None
+    hospitals = {}
+    for slot in slots:
+        first = hospitals.get(slot.hospital_id)
+        if first is None or slot.epoch < first.epoch:
+            hospitals[slot.hospital_id] = slot
+            if earliest is None or slot.epoch < earliest.epoch:
+                earliest = slot
+    return EarliestIndex(earliest, hospitals)
+
+def has_index(key):
+    """Verifica se la voce ha già un indice (se no, serve lo snapshot precedente)."""
+    return key in _indexes
+
+def update_index(key, current, previous=None):
+    """
+    Sostituisce l'indice di una voce con quello delle disponibilità attuali.
+
+    L'indice viene ricostruito a ogni controllo con un passaggio sulle
+    disponibilità attuali (O(n)): le stesse disponibilità sono appena state
+    filtrate, quindi il costo del controllo non cambia. Mantenerlo a partire
+    dalle disponibilità nuove e rimosse richiederebbe comunque di cercare la
+    nuova prima disponibilità quando viene rimossa quella attuale.
+
+    Args:
+        key: La voce (es. "CF_NRE_chat")
+        current: Le disponibilità attuali, già filtrate
+        previous: Le disponibilità precedenti, già filtrate: usate solo se
+            l'indice non esiste ancora (primo controllo dopo un riavvio)
+
+    Returns:
+        tuple: (indice precedente o None, indice attuale)
+    """
+    old_index = _indexes.get(key)
+    if old_index is None and previous is not None:
+        old_index = build_index(previous)
+    new_index = _indexes[key] = build_index(current)
+    return old_index, new_index
+
+def drop(prescription_key):
+    """Elimina gli indici di tutte le voci (chat) di una prescrizione non più monitorata."""
+    prefix = f"{prescription_key}_"
+    for key in [key for key in _indexes if key.startswith(prefix)]:
+        _indexes.pop(key, None)
+
+def find_improvements(old_index, new_index, delta_seconds):
+    """
+    Verifica se la prima disponibilità è stata anticipata di più di delta_seconds.
+
+    Il confronto tra le due prime disponibilità ha costo costante; solo se
+    c'è un anticipo vengono cercati gli ospedali che lo offrono.
+
+    Returns:
+        list: La prima disponibilità di ogni ospedale che anticipa la
+        precedente di più di delta_seconds (vuota se non c'è anticipo)
+    """
+    if new_index.earliest is None:
+        return []
+    if old_index is None or old_index.earliest is None:
+        threshold = None
+    else:
+        threshold = old_index.epoch - delta_seconds
+        if new_index.epoch >= threshold:
+            return []
+    return [slot for slot in new_index.hospitals.values() if threshold is None or slot.epoch < threshold]
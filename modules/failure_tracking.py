@@ -0,0 +1,77 @@
+import time
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import (
+    FAILURE_BACKOFF_BASE, FAILURE_BACKOFF_MAX
+)
+
+# Codici HTTP che indicano un problema temporaneo del servizio
+TRANSIENT_STATUS_CODES = (408, 425, 429)
+
+# Codici HTTP con cui il servizio rifiuta le credenziali dell'app (AUTH_HEADER):
+# il problema riguarda tutte le prescrizioni, non quella controllata
+AUTH_STATUS_CODES = (401, 403)
+
+# Cache dei risultati negativi: chiave -> (scadenza, messaggio di errore)
+_negative_cache = {}
+
+def classify_failure(response, status_code=None):
+    """
+    Classifica un fallimento come permanente o transitorio.
+
+    Args:
+        response: La risposta (già decodificata) del servizio, None se la chiamata è fallita
+        status_code: Il codice HTTP dell'errore, None se errore di rete
+
+    Returns:
+        bool: True se il fallimento è permanente, False se transitorio
+    """
+    # Il servizio ha risposto, ma senza i dati attesi: è la richiesta ad essere rifiutata
+    if response is not None:
+        return True
+
+    # Errori 4xx: la richiesta non è valida (tranne timeout, limiti di frequenza
+    # e credenziali rifiutate)
+    if status_code is not None and 400 <= status_code < 500:
+        return status_code not in TRANSIENT_STATUS_CODES and status_code not in AUTH_STATUS_CODES
+
+    # Errori di rete o 5xx: il servizio potrebbe tornare disponibile
+    return False
+
+def is_auth_failure(response, status_code=None):
+    """Verifica se la chiamata è fallita perché il servizio ha rifiutato le credenziali dell'app."""
+    return response is None and status_code in AUTH_STATUS_CODES
+
+def compute_backoff(failure_count):
+    """Calcola l'attesa (in secondi) dopo un numero di fallimenti consecutivi."""
+    if failure_count <= 0:
+        return 0
+    return min(FAILURE_BACKOFF_BASE * 2 ** (failure_count - 1), FAILURE_BACKOFF_MAX)
+
+def cache_failure(key, error_msg, ttl):
+    """Memorizza un risultato negativo per la durata indicata (il backoff della prescrizione)."""
+    _negative_cache[key] = (time.time() + ttl, error_msg)
+
+def get_cached_failure(key):
+    """
+    Restituisce il messaggio di errore memorizzato per la chiave.
+
+    Returns:
+        str: Il messaggio di errore, None se assente o scaduto
+    """
+    entry = _negative_cache.get(key)
+    if entry is None:
+        return None
+
+    expires_at, error_msg = entry
+    if expires_at <= time.time():
+        # Voce scaduta: la rimuoviamo
+        _negative_cache.pop(key, None)
+        return None
+    return error_msg
+
+def clear_cached_failures(*keys):
+    """Rimuove dalla cache i risultati negativi delle chiavi indicate."""
+    for key in keys:
+        _negative_cache.pop(key, None)
@@ -0,0 +1,150 @@
+import re
+import json
+import math
+import logging
+import unicodedata
+from functools import lru_cache
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, TOWNS_FILE
+
+# Raggio medio terrestre (in km)
+EARTH_RADIUS_KM = 6371.0
+
+# Capoluogo usato quando un indirizzo contiene solo il CAP (prime due cifre)
+CAP_PROVINCES = {"00": "ROMA", "01": "VITERBO", "02": "RIETI", "03": "FROSINONE", "04": "LATINA"}
+_CAP_PATTERN = re.compile(r"\b(0[0-4])\d{3}\b")
+
+# Comuni (nome normalizzato -> (lat, lon)) ed espressione regolare che li
+# cerca tutti in un solo passaggio, caricati alla prima geocodifica
+_towns = None
+_towns_pattern = None
+
+def normalize_text(text):
+    """Maiuscolo, senza accenti né punteggiatura (es. "Sant'Elia" -> "SANT ELIA")."""
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^A-Za-z0-9]+", " ", text).upper().split())
+
+def _load_towns():
+    """Carica le coordinate dei comuni da TOWNS_FILE."""
+    global _towns, _towns_pattern
+    if _towns is not None:
+        return _towns
+
+    try:
+        with open(TOWNS_FILE, 'r') as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.error(f"Errore nel caricare le coordinate dei comuni: {str(e)}")
+        data = {}
+
+    _towns = {normalize_text(name): (lat, lon) for name, (lat, lon) in data.items()}
+    # I nomi più lunghi per primi: "GENZANO DI ROMA" prevale su "ROMA"
+    names = sorted(_towns, key=len, reverse=True)
+    _towns_pattern = re.compile(r"\b(" + "|".join(map(re.escape, names)) + r")\b") if names else None
+    return _towns
+
+# Sigla della provincia in fondo all'indirizzo (es. "LATINA LT")
+_PROVINCE_SUFFIX = re.compile(r"(?: [A-Z]{2})+$")
+
+def _town_segment(normalized):
+    """
+    La parte dell'indirizzo che indica il comune: il testo dopo l'ultimo CAP
+    o, se il CAP manca, l'intero testo; senza la sigla della provincia.
+    """
+    caps = list(_CAP_PATTERN.finditer(normalized))
+    segment = normalized[caps[-1].end():] if caps else normalized
+    return _PROVINCE_SUFFIX.sub("", " " + segment.strip()).strip()
+
+@lru_cache(maxsize=1024)
+def geocode_address(text):
+    """
+    Restituisce le coordinate del comune indicato in un indirizzo.
+
+    Si cerca il comune solo dove gli indirizzi lo riportano: dopo il CAP
+    ("Via Roma 1 04100 Latina LT") o, senza CAP, in fondo al testo; un comune
+    nominato nella via ("Via Tivoli") non viene considerato. Se il comune non
+    è riconosciuto si usa il capoluogo della provincia del CAP.
+
+    Returns:
+        tuple: (latitudine, longitudine), None se il comune non è riconosciuto
+    """
+    if not text or text == "N/A":
+        return None
+    towns = _load_towns()
+    normalized = normalize_text(text)
+    segment = _town_segment(normalized)
+
+    if segment in towns:
+        return towns[segment]
+    if _towns_pattern is not None and segment:
+        if _CAP_PATTERN.search(normalized):
+            # Dopo il CAP c'è solo il comune (eventualmente con la frazione)
+            matches = _towns_pattern.findall(segment)
+            if matches:
+                return towns[matches[-1]]
+        else:
+            # Senza CAP il comune è l'ultima parte dell'indirizzo
+            match = re.search(_towns_pattern.pattern + r"$", segment)
+            if match:
+                return towns[match.group(1)]
+
+    caps = _CAP_PATTERN.findall(normalized)
+    if caps:
+        return towns.get(CAP_PROVINCES[caps[-1]])
+    return None
+
+def haversine_km(origin, destination):
+    """Distanza in km tra due punti (lat, lon) sulla superficie terrestre."""
+    lat1, lon1 = map(math.radians, origin)
+    lat2, lon2 = map(math.radians, destination)
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def get_patient_origin(prescription):
+    """
+    Restituisce il punto da cui misurare le distanze per una prescrizione.
+
+    Si usa il domicilio salvato in patient_info e, se non riconosciuto, la
+    residenza; config["distance_from"] = "residence" inverte l'ordine.
+
+    Returns:
+        tuple: (latitudine, longitudine), None se non disponibile
+    """
+    patient_info = prescription.get("patient_info") or {}
+    order = ["domicile", "residence"]
+    if (prescription.get("config") or {}).get("distance_from") == "residence":
+        order.reverse()
+
+    for field in order:
+        origin = geocode_address(patient_info.get(field))
+        if origin is not None:
+            return origin
+    return None
+
+def make_distance_fn(origin):
+    """
+    Restituisce una funzione che calcola la distanza di uno Slot da origin.
+
+    Le coordinate delle sedi vengono dall'indice del registro degli ospedali
+    e ogni distanza viene calcolata una sola volta per sede.
+
+    Returns:
+        function: Riceve uno Slot e restituisce i km (None se la sede non è
+        localizzata), oppure None se origin non è disponibile
+    """
+    if origin is None:
+        return None
+    from modules.hospital_registry import get_site_location
+
+    cache = {}
+
+    def distance(slot):
+        if slot.site_id in cache:
+            return cache[slot.site_id]
+        location = get_site_location(slot.site_id, slot.hospital_name)
+        result = cache[slot.site_id] = haversine_km(origin, location) if location is not None else None
+        return result
+
+    return distance
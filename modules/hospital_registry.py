@@ -0,0 +1,159 @@
+import json
+import threading
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, HOSPITALS_FILE
+from modules.geo import geocode_address
+
+# Registro condiviso di ospedali e sedi, salvato in HOSPITALS_FILE:
+# - hospitals: id ospedale -> nome
+# - sites: id sede -> indirizzo
+# - locations: id sede -> [lat, lon] (null se il comune non è riconosciuto),
+#   calcolate una sola volta dall'indirizzo con modules.geo
+# Gli id sono memorizzati come stringhe, come le chiavi JSON.
+SECTIONS = ("hospitals", "sites", "locations")
+
+_registry = {section: {} for section in SECTIONS}
+_signature = None
+_loaded = False
+_dirty = False
+_lock = threading.Lock()
+
+def _read_file():
+    """Legge il registro dal file o dalla sua copia di riserva (vuoto se non esiste o non è valido)."""
+    from modules.data_utils import read_json_file
+
+    try:
+        data = read_json_file(HOSPITALS_FILE, {})
+        return {section: data.get(section, {}) for section in SECTIONS}
+    except Exception as e:
+        logger.error(f"Errore nel caricare il registro degli ospedali: {str(e)}")
+        return {section: {} for section in SECTIONS}
+
+def load_registry(force=False):
+    """
+    Carica il registro dal file, se cambiato dall'ultima lettura.
+
+    Le voci registrate in memoria e non ancora salvate vengono mantenute.
+
+    Args:
+        force: Rilegge il file anche se non risulta cambiato
+    """
+    global _signature, _loaded
+    from modules.data_utils import get_file_signature
+
+    with _lock:
+        signature = get_file_signature(HOSPITALS_FILE)
+        if _loaded and not force and signature == _signature:
+            return
+
+        stored = _read_file()
+        if _dirty:
+            # Le voci non ancora salvate prevalgono su quelle del file
+            for section in SECTIONS:
+                stored[section].update(_registry[section])
+        _registry.update(stored)
+        _signature = signature
+        _loaded = True
+
+def _ensure_loaded():
+    if not _loaded:
+        load_registry()
+
+def register(hospital_id, hospital_name, site_id, site_address):
+    """
+    Registra (o aggiorna) il nome di un ospedale e l'indirizzo di una sede.
+
+    Returns:
+        str: L'id della sede da memorizzare nelle disponibilità
+    """
+    global _dirty
+    _ensure_loaded()
+
+    hospital_key = str(hospital_id)
+    # Se il servizio non fornisce l'id della sede, usiamo l'indirizzo
+    site_key = str(site_id) if site_id is not None else f"{hospital_key}:{site_address}"
+
+    with _lock:
+        if hospital_name is not None and _registry["hospitals"].get(hospital_key) != hospital_name:
+            _registry["hospitals"][hospital_key] = hospital_name
+            _dirty = True
+        if site_address is not None and _registry["sites"].get(site_key) != site_address:
+            _registry["sites"][site_key] = site_address
+            # L'indirizzo è cambiato: ricalcoliamo la posizione della sede
+            location = geocode_address(site_address) or geocode_address(hospital_name)
+            _registry["locations"][site_key] = list(location) if location is not None else None
+            _dirty = True
+    return site_key
+
+def _lookup(section, key):
+    """Cerca una voce, ricaricando il file se è stata registrata da un altro processo."""
+    _ensure_loaded()
+    value = _registry[section].get(str(key))
+    if value is None:
+        load_registry()
+        value = _registry[section].get(str(key))
+    return value
+
+def get_hospital_name(hospital_id):
+    """Restituisce il nome dell'ospedale ("N/A" se sconosciuto)."""
+    return _lookup("hospitals", hospital_id) or "N/A"
+
+def get_site_address(site_id):
+    """Restituisce l'indirizzo della sede ("N/A" se sconosciuto)."""
+    return _lookup("sites", site_id) or "N/A"
+
+def get_site_location(site_id, hospital_name=None):
+    """
+    Restituisce le coordinate della sede, dall'indice delle posizioni.
+
+    La prima volta la posizione viene calcolata dall'indirizzo (o, se non
+    basta, dal nome dell'ospedale) con i dati dei comuni inclusi nel
+    repository, e salvata nel registro con save_registry.
+
+    Returns:
+        tuple: (latitudine, longitudine), None se la sede non è localizzabile
+    """
+    global _dirty
+    key = str(site_id)
+    _ensure_loaded()
+    if key not in _registry["locations"]:
+        location = geocode_address(get_site_address(key))
+        if location is None and hospital_name:
+            location = geocode_address(hospital_name)
+        with _lock:
+            _registry["locations"][key] = list(location) if location is not None else None
+            _dirty = True
+
+    location = _registry["locations"].get(key)
+    return tuple(location) if location is not None else None
+
+def save_registry():
+    """
+    Salva il registro se contiene voci nuove o modificate.
+
+    Il file viene riletto e unito alle voci in memoria, così da non perdere
+    quelle registrate nel frattempo da un altro processo.
+    """
+    global _dirty, _signature
+    if not _dirty:
+        return
+    from modules.data_utils import file_lock, get_file_signature, write_file_atomic
+
+    try:
+        with file_lock(HOSPITALS_FILE), _lock:
+            stored = _read_file()
+            # Le voci in memoria sono le più recenti
+            for section in SECTIONS:
+                stored[section].update(_registry[section])
+
+            write_file_atomic(HOSPITALS_FILE, lambda f: json.dump(stored, f, indent=2, ensure_ascii=False))
+
+            _registry.update(stored)
+            _signature = get_file_signature(HOSPITALS_FILE)
+            _dirty = False
+        logger.info(f"Registro degli ospedali salvato ({len(stored['hospitals'])} ospedali, "
+                    f"{len(stored['sites'])} sedi, {len(stored['locations'])} posizioni)")
+    except Exception as e:
+        logger.error(f"Errore nel salvare il registro degli ospedali: {str(e)}")
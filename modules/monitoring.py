@@ -1,44 +1,379 @@
 import asyncio
+import math
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Importiamo le variabili globali dal modulo principale
 from recup_monitor import logger
+from config import (
+    MONITORING_INTERVAL, INPUT_FILE_CHECK_INTERVAL, MONITORING_MIN_WORKERS,
+    MONITORING_MAX_WORKERS, MONITORING_TARGET_UTILIZATION, PRESCRIPTION_REQUEST_DELAY,
+    PREVIOUS_DATA_RETENTION_INTERVAL
+)
 
 # Importiamo le funzioni da altri moduli
-from modules.data_utils import load_input_data, load_previous_data, save_previous_data
-from modules.prescription_processor import process_prescription
+from modules.data_utils import (
+    get_entry_id, load_input_data_if_changed, load_previous_data, compact_previous_data, fsync_batch,
+    run_previous_data_retention
+)
+from modules.prescription_processor import process_subscribers, notify_admin
+from modules.scheduling import get_schedule, get_poll_delay
+from modules.prescription_state import is_monitored, get_retry_delay
+from modules.slot_history import (
+    record_observations, close_observations, close_all_observations, flush_history
+)
+from modules import earliest_tracker, recently_seen
+from modules.state_events import is_connected, get_events, TOPIC_PRESCRIPTIONS, TOPIC_PREVIOUS_DATA
+
+def get_prescription_key(prescription):
+    """Chiave della prescrizione, condivisa da tutte le chat che la monitorano."""
+    return f"{prescription['fiscal_code']}_{prescription['nre']}"
+
+def reload_prescriptions(current, signature):
+    """
+    Ricarica le prescrizioni solo se il file è cambiato e calcola le differenze.
+
+    Args:
+        current: Le prescrizioni attualmente in memoria
+        signature: La firma del file all'ultima lettura
+
+    Returns:
+        tuple: (prescrizioni, nuova firma, chiavi delle prescrizioni da controllare subito)
+    """
+    data, new_signature = load_input_data_if_changed(signature)
+    if data is None:
+        return current, signature, set()
+
+    old_entries = {get_entry_id(p): p for p in current}
+    new_entries = {get_entry_id(p): p for p in data}
+
+    added = [entry_id for entry_id in new_entries if entry_id not in old_entries]
+    removed = [entry_id for entry_id in old_entries if entry_id not in new_entries]
+
+    # Da controllare subito: le prescrizioni nuove e quelle tornate monitorabili
+    wake_keys = {get_prescription_key(new_entries[entry_id]) for entry_id in added
+                 if is_monitored(new_entries[entry_id])}
+    for entry_id, prescription in new_entries.items():
+        old = old_entries.get(entry_id)
+        if old is not None and is_monitored(prescription) and not is_monitored(old):
+            wake_keys.add(get_prescription_key(prescription))
+
+    if signature is not None and (added or removed):
+        logger.info(f"File delle prescrizioni aggiornato: {len(added)} aggiunte, {len(removed)} rimosse")
+
+    return data, new_signature, wake_keys
+
+def refresh_previous_data(previous_data, keys=None):
+    """
+    Aggiorna in memoria i dati precedenti scritti da un altro processo.
+
+    Il bot salva lo snapshot delle prescrizioni che verifica (aggiunta, verifica
+    manuale): senza questo aggiornamento il monitoraggio le confronterebbe con
+    uno snapshot superato e notificherebbe di nuovo le stesse disponibilità.
+
+    Args:
+        previous_data: I dati precedenti in memoria (il dizionario viene modificato)
+        keys: Le chiavi modificate (None = tutte)
+    """
+    stored = load_previous_data(strict=True, keys=keys)
+    if stored is None:
+        return
+    # Le chiavi rimosse dall'archivio (es. dalla pulizia) vanno rimosse anche in memoria
+    if keys is None:
+        previous_data.clear()
+    else:
+        for key in keys:
+            if key not in stored:
+                previous_data.pop(key, None)
+    previous_data.update(stored)
+
+async def wait_for_next_cycle(sleep_time, prescriptions, signature, last_poll, previous_data):
+    """
+    Attende il prossimo ciclo, ricaricando le prescrizioni quando cambiano.
+
+    Se il processo riceve le notifiche di modifica (vedi modules.state_events)
+    le attende senza leggere i file, altrimenti controlla periodicamente la
+    firma delle prescrizioni. L'attesa si interrompe subito se vengono aggiunte
+    (o riattivate) prescrizioni, così che siano controllate senza aspettare
+    la fine dell'intervallo.
+
+    Returns:
+        tuple: (prescrizioni aggiornate, nuova firma del file, chiavi da controllare subito)
+    """
+    deadline = time.time() + sleep_time
+    loop = asyncio.get_running_loop()
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return prescriptions, signature, set()
+
+        if is_connected():
+            changes = await loop.run_in_executor(None, get_events, remaining)
+            if TOPIC_PREVIOUS_DATA in changes:
+                refresh_previous_data(previous_data, changes[TOPIC_PREVIOUS_DATA])
+            if TOPIC_PRESCRIPTIONS not in changes:
+                continue
+        else:
+            await asyncio.sleep(min(remaining, INPUT_FILE_CHECK_INTERVAL))
+
+        prescriptions, signature, wake_keys = reload_prescriptions(prescriptions, signature)
+        if wake_keys:
+            logger.info(f"Nuove prescrizioni da controllare subito: {', '.join(sorted(wake_keys))}")
+            for key in wake_keys:
+                last_poll.pop(key, None)
+            return prescriptions, signature, wake_keys
+
+def process_prescription_group(group, previous_data):
+    """
+    Controlla una prescrizione e avvisa tutte le sue voci (eseguita in un thread).
+
+    Le voci con la stessa chiave condividono un'unica interrogazione del
+    servizio, ognuna con i propri filtri.
+
+    Returns:
+        float: I secondi impiegati
+    """
+    group_start = time.time()
+    success, _ = process_subscribers(group, previous_data, use_negative_cache=True)
+    if success:
+        # Aggiorniamo lo storico con le disponibilità appena lette
+        prescription_key = get_prescription_key(group[0])
+        record_observations(prescription_key, previous_data.get(prescription_key, []))
+    # Small delay between processing different prescriptions
+    time.sleep(PRESCRIPTION_REQUEST_DELAY)
+    return time.time() - group_start
+
+async def process_due_prescriptions(groups, previous_data, executor, workers):
+    """
+    Controlla le prescrizioni dovute con al più `workers` controlli in parallelo.
+
+    Args:
+        groups: Liste di voci, una per chiave di prescrizione
+        previous_data: Gli snapshot delle disponibilità
+        executor: Il pool di thread del monitoraggio
+        workers: Il numero di controlli contemporanei
+
+    Returns:
+        tuple: (numero di prescrizioni controllate, secondi di lavoro complessivi)
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run_group(group):
+        async with semaphore:
+            return await loop.run_in_executor(executor, process_prescription_group, group, previous_data)
+
+    results = await asyncio.gather(*(run_group(group) for group in groups), return_exceptions=True)
+
+    num_processed = 0
+    busy_time = 0.0
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Errore nel controllo di una prescrizione: {str(result)}")
+            continue
+        num_processed += 1
+        busy_time += result
+    return num_processed, busy_time
+
+def tune_concurrency(num_prescriptions, avg_check_time):
+    """
+    Calcola i worker necessari a controllare tutte le prescrizioni entro l'intervallo.
+
+    Args:
+        num_prescriptions: Il numero di prescrizioni distinte monitorate
+        avg_check_time: Il tempo medio di controllo di una prescrizione (in secondi)
+
+    Returns:
+        tuple: (worker da usare, obiettivo raggiungibile, numero massimo di voci gestibili)
+    """
+    target_time = MONITORING_INTERVAL * MONITORING_TARGET_UTILIZATION
+    avg_check_time = max(avg_check_time, 0.001)
+    needed = math.ceil(num_prescriptions * avg_check_time / target_time) if num_prescriptions else 0
+    workers = min(max(needed, MONITORING_MIN_WORKERS), MONITORING_MAX_WORKERS)
+    projected_max = int(target_time * MONITORING_MAX_WORKERS / avg_check_time)
+    return workers, needed <= MONITORING_MAX_WORKERS, projected_max
+
+def shutdown_monitoring():
+    """
+    Salva lo storico prima della chiusura del processo di monitoraggio.
+
+    Le disponibilità ancora presenti vengono chiuse all'ultima osservazione e
+    tutte le righe in attesa vengono scritte subito, anche se sono poche.
+    """
+    close_all_observations()
+    flush_history(force=True)
 
 async def run_monitoring_loop():
     """Funzione dedicata al loop di monitoraggio da eseguire in un processo separato."""
-    # Load previous data
-    previous_data = load_previous_data()
-    
+    # Compattiamo i dati salvati (convertendo quelli nel formato precedente) e li carichiamo
+    compact_previous_data(force=True)
+    run_previous_data_retention()
+    last_retention = time.time()
+    previous_data = load_previous_data(strict=True)
+    if previous_data is None:
+        # Senza i dati precedenti ogni disponibilità risulterebbe nuova: meglio
+        # non notificare nulla finché i dati non tornano leggibili
+        notify_admin("⛔ <b>Monitoraggio sospeso</b>\n\nI dati precedenti non sono leggibili "
+                     "(neanche dalla copia di riserva). Il monitoraggio riprenderà quando saranno ripristinati.")
+        while previous_data is None:
+            await asyncio.sleep(60)
+            previous_data = load_previous_data(strict=True)
+        logger.info("Dati precedenti di nuovo leggibili: il monitoraggio riprende")
+
+    # Prescrizioni in memoria, ricaricate solo quando il file cambia
+    all_prescriptions = []
+    signature = None
+
+    # Stato della pianificazione per prescrizione: ultimo controllo e finestra attiva
+    last_poll = {}
+    window_active = {}
+
+    # Parallelismo adattivo: worker correnti, tempo medio di controllo e stato dell'obiettivo
+    executor = ThreadPoolExecutor(max_workers=MONITORING_MAX_WORKERS, thread_name_prefix="monitor")
+    workers = MONITORING_MIN_WORKERS
+    avg_check_time = None
+    target_reachable = True
+
     while True:
         try:
             start_time = time.time()
             logger.info(f"Inizio ciclo di monitoraggio: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Load input data
-            prescriptions = load_input_data()
-            
-            # Process each prescription
+
+            # Ricarichiamo le prescrizioni se sono cambiate, escludendo quelle prenotate, scadute, non valide e sospese
+            all_prescriptions, signature, _ = reload_prescriptions(all_prescriptions, signature)
+            prescriptions = [p for p in all_prescriptions if is_monitored(p)]
+            num_inactive = len(all_prescriptions) - len(prescriptions)
+
+            # Dimentichiamo la pianificazione e lo stato in memoria delle prescrizioni rimosse
+            current_keys = {get_prescription_key(p) for p in prescriptions}
+            for key in list(last_poll):
+                if key not in current_keys:
+                    last_poll.pop(key, None)
+                    window_active.pop(key, None)
+                    close_observations(key)
+                    earliest_tracker.drop(key)
+                    recently_seen.drop(key)
+
+            # Scegliamo le prescrizioni dovute secondo la loro pianificazione.
+            # Più chat possono monitorare la stessa prescrizione: decidiamo una volta per chiave
+            due_keys = set()
+            checked_keys = set()
+            num_skipped = 0
             for prescription in prescriptions:
-                process_prescription(prescription, previous_data)
-                # Small delay between processing different prescriptions
-                await asyncio.sleep(1)
-            
-            # Save updated previous data
-            save_previous_data(previous_data)
-            
-            # Calculate time to sleep to maintain 5-minute cycles
+                prescription_key = get_prescription_key(prescription)
+                if prescription_key in checked_keys:
+                    continue
+                checked_keys.add(prescription_key)
+
+                delay, active = get_poll_delay(
+                    get_schedule(prescription),
+                    last_poll.get(prescription_key),
+                    window_active.get(prescription_key, True)
+                )
+
+                if delay is None or delay > 0 or get_retry_delay(prescription) > 0:
+                    # Fuori dalla finestra di attività, non ancora dovuta o in backoff
+                    num_skipped += 1
+                    continue
+
+                # Usiamo l'inizio del ciclo, così le prescrizioni controllate
+                # insieme tornano dovute insieme al ciclo successivo
+                window_active[prescription_key] = active
+                last_poll[prescription_key] = start_time
+                due_keys.add(prescription_key)
+
+            # Controlliamo le prescrizioni dovute, raggruppate per chiave
+            groups = {}
+            for prescription in prescriptions:
+                prescription_key = get_prescription_key(prescription)
+                if prescription_key in due_keys:
+                    groups.setdefault(prescription_key, []).append(prescription)
+
+            # I salvataggi del ciclo vengono sincronizzati su disco insieme, alla fine
+            with fsync_batch():
+                num_processed, busy_time = await process_due_prescriptions(
+                    list(groups.values()), previous_data, executor, workers
+                )
+
+                # Ogni prescrizione è già salvata nel journal: compattiamo solo se è cresciuto troppo
+                if num_processed:
+                    compact_previous_data()
+                flush_history()
+
+            # Pulizia periodica dei dati precedenti (chiavi orfane e disponibilità in eccesso)
+            if time.time() - last_retention >= PREVIOUS_DATA_RETENTION_INTERVAL:
+                last_retention = time.time()
+                retention = run_previous_data_retention()
+                if retention is not None:
+                    refresh_previous_data(previous_data, retention["removed"] + retention["trimmed"])
+
+            # Calcoliamo il tempo di attesa fino alla prossima prescrizione dovuta,
+            # così da effettuare subito un controllo all'apertura di una finestra
             elapsed = time.time() - start_time
-            sleep_time = max(300 - elapsed, 1)  # 300 seconds = 5 minutes
-            
-            logger.info(f"Ciclo completato in {elapsed:.2f} secondi. In attesa del prossimo ciclo tra {sleep_time:.2f} secondi.")
-            await asyncio.sleep(sleep_time)
-            
+            if elapsed > MONITORING_INTERVAL:
+                logger.warning(f"Ciclo in ritardo: {elapsed:.2f} secondi su un intervallo di "
+                               f"{MONITORING_INTERVAL} secondi ({workers} worker)")
+
+            # Adattiamo il parallelismo al tempo medio di controllo (media mobile)
+            if num_processed:
+                cycle_check_time = busy_time / num_processed
+                avg_check_time = cycle_check_time if avg_check_time is None \
+                    else 0.7 * avg_check_time + 0.3 * cycle_check_time
+
+                new_workers, reachable, projected_max = tune_concurrency(len(current_keys), avg_check_time)
+                if new_workers != workers:
+                    logger.info(f"Worker del monitoraggio: {workers} -> {new_workers}")
+                    workers = new_workers
+                logger.info(f"Tempo medio di controllo {avg_check_time:.2f} secondi: gestibili al massimo "
+                            f"{projected_max} prescrizioni ({len(current_keys)} monitorate)")
+
+                if reachable != target_reachable:
+                    target_reachable = reachable
+                    if reachable:
+                        logger.info("Il monitoraggio rientra di nuovo nell'intervallo previsto")
+                        notify_admin("✅ <b>Monitoraggio</b>\n\nIl ciclo di controllo rientra di nuovo "
+                                     f"nell'intervallo di {MONITORING_INTERVAL} secondi.")
+                    else:
+                        logger.warning(f"Impossibile controllare {len(current_keys)} prescrizioni ogni "
+                                       f"{MONITORING_INTERVAL} secondi con {MONITORING_MAX_WORKERS} worker")
+                        notify_admin("⚠️ <b>Monitoraggio in ritardo</b>\n\n"
+                                     f"Con {MONITORING_MAX_WORKERS} worker e un tempo medio di controllo di "
+                                     f"{avg_check_time:.1f} secondi non è possibile controllare "
+                                     f"{len(current_keys)} prescrizioni ogni {MONITORING_INTERVAL} secondi.\n"
+                                     f"Massimo stimato: {projected_max} prescrizioni.")
+
+            sleep_time = MONITORING_INTERVAL
+            for prescription in prescriptions:
+                prescription_key = get_prescription_key(prescription)
+                delay, _ = get_poll_delay(
+                    get_schedule(prescription),
+                    last_poll.get(prescription_key),
+                    window_active.get(prescription_key, True)
+                )
+                if delay is not None:
+                    sleep_time = min(sleep_time, max(delay, get_retry_delay(prescription)))
+            sleep_time = max(sleep_time, 1)
+
+            num_subscribers = sum(len(group) for group in groups.values())
+            logger.info(f"Ciclo completato in {elapsed:.2f} secondi ({num_processed} prescrizioni controllate "
+                        f"per {num_subscribers} voci con {workers} worker, "
+                        f"{num_skipped} rinviate, {num_inactive} non attive). "
+                        f"In attesa del prossimo ciclo tra {sleep_time:.2f} secondi.")
+            all_prescriptions, signature, wake_keys = await wait_for_next_cycle(
+                sleep_time, all_prescriptions, signature, last_poll, previous_data
+            )
+
+            # Le prescrizioni aggiunte dal bot sono già state verificate al momento
+            # dell'aggiunta: recuperiamo il loro snapshot per non notificarle di nuovo
+            if wake_keys:
+                stored_data = load_previous_data(strict=True, keys=wake_keys) or {}
+                for key in wake_keys:
+                    if key not in previous_data and key in stored_data:
+                        previous_data[key] = stored_data[key]
+
         except Exception as e:
             logger.error(f"Errore nel servizio di monitoraggio: {str(e)}")
             # In caso di errore, aspetta 1 minuto e riprova
@@ -46,34 +381,4 @@ async def run_monitoring_loop():
 
 async def start_monitoring():
     """Avvia il thread di monitoraggio delle prescrizioni."""
-    # Load previous data
-    previous_data = load_previous_data()
-    
-    while True:
-        try:
-            start_time = time.time()
-            logger.info(f"Inizio ciclo di monitoraggio: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # Load input data
-            prescriptions = load_input_data()
-            
-            # Process each prescription
-            for prescription in prescriptions:
-                process_prescription(prescription, previous_data)
-                # Small delay between processing different prescriptions
-                await asyncio.sleep(1)
-            
-            # Save updated previous data
-            save_previous_data(previous_data)
-            
-            # Calculate time to sleep to maintain 5-minute cycles
-            elapsed = time.time() - start_time
-            sleep_time = max(300 - elapsed, 1)  # 300 seconds = 5 minutes
-            
-            logger.info(f"Ciclo completato in {elapsed:.2f} secondi. In attesa del prossimo ciclo tra {sleep_time:.2f} secondi.")
-            await asyncio.sleep(sleep_time)
-            
-        except Exception as e:
-            logger.error(f"Errore nel servizio di monitoraggio: {str(e)}")
-            # In caso di errore, aspetta 1 minuto e riprova
-            await asyncio.sleep(60)
\ No newline at end of file
+    await run_monitoring_loop()
@@ -0,0 +1,260 @@
+import re
+import logging
+from operator import attrgetter
+
+# Importa costanti e configurazioni dal modulo config
+from config import TELEGRAM_MESSAGE_LIMIT
+from modules.time_utils import format_epoch
+
+# Template dei messaggi di notifica (HTML di Telegram)
+HEADER_TEMPLATE = (
+    "\n<b>{title}</b>\n\n"
+    "<b>Codice Fiscale:</b> <code>{fiscal_code}</code>\n"
+    "<b>ID Tessera Sanitaria:</b> <code>{cf_code}</code>\n"
+    "<b>NRE:</b> <code>{nre}</code>\n"
+    "<b>Descrizione:</b> <code>{prescription_name}</code>\n"
+).format
+FILTER_TEMPLATE = "<b>Filtro:</b> Solo appuntamenti entro {} mesi\n".format
+EARLIEST_TEMPLATE = "⏩ <b>Prima Disponibilità:</b> {}\n<b>Precedente:</b> {}\n".format
+HOSPITAL_TEMPLATE = "\n<b>{}</b>\n📍 {}\n".format
+HOSPITAL_CONTINUED_TEMPLATE = "\n<b>{}</b> <i>(continua)</i>\n📍 {}\n".format
+DISTANCE_TEMPLATE = "{} ({:.0f} km)".format
+SLOT_TEMPLATE = "📅 {} - {} €\n".format
+SLOT_NO_PRICE_TEMPLATE = "📅 {}\n".format
+COLLAPSED_TEMPLATE = "<i>… altre {} disponibilità, fino a {}</i>\n".format
+PART_TEMPLATE = "\n<i>(parte {} di {})</i>".format
+
+# Intestazione di un ospedale (HOSPITAL_TEMPLATE) all'interno di un blocco
+_HOSPITAL_PATTERN = re.compile(r"\n<b>(.*)</b>\n📍 (.*)\n")
+
+# Spazio riservato all'indicazione "(parte X di Y)" in ogni messaggio
+PART_RESERVED_LENGTH = 32
+
+TITLE_NEW = "🔍 Nuova Prescrizione"
+TITLE_UPDATE = "🔍 Aggiornamento Prescrizione"
+TITLE_EARLIEST = "⏩ Disponibilità Anticipata"
+
+_by_epoch = attrgetter("epoch")
+
+def group_by_hospital(slots, distance_fn=None):
+    """
+    Ordina le disponibilità una sola volta e le raggruppa per ospedale.
+
+    Args:
+        slots: Le disponibilità da raggruppare
+        distance_fn: Se indicata (vedi modules.geo.make_distance_fn), gli
+            ospedali sono ordinati per distanza, mostrata accanto all'indirizzo
+
+    Returns:
+        list: (nome ospedale, indirizzo, disponibilità ordinate), con gli
+        ospedali nell'ordine della loro prima disponibilità
+    """
+    groups = {}
+    for slot in sorted(slots, key=_by_epoch):
+        group = groups.get(slot.hospital_id)
+        if group is None:
+            group = groups[slot.hospital_id] = []
+        group.append(slot)
+
+    if distance_fn is None:
+        return [(group[0].hospital_name, group[0].site_address, group) for group in groups.values()]
+
+    located = []
+    for group in groups.values():
+        distance = distance_fn(group[0])
+        address = group[0].site_address
+        if distance is not None:
+            address = DISTANCE_TEMPLATE(address, distance)
+        located.append((distance, group[0].hospital_name, address, group))
+    # Gli ospedali non localizzati in fondo; a pari distanza resta l'ordine per data
+    located.sort(key=lambda item: (item[0] is None, item[0] or 0))
+    return [(hospital_name, address, group) for _, hospital_name, address, group in located]
+
+def render_hospitals(groups, show_price=True, separator="", max_slots=None):
+    """
+    Restituisce un blocco di testo per ogni ospedale.
+
+    Args:
+        groups: Il risultato di group_by_hospital
+        show_price: Mostra il prezzo accanto alla data
+        separator: Testo aggiunto in fondo a ogni blocco
+        max_slots: Disponibilità mostrate per ospedale, le altre vengono riassunte (None = tutte)
+    """
+    blocks = []
+    for hospital_name, address, slots in groups:
+        parts = [HOSPITAL_TEMPLATE(hospital_name, address)]
+        hidden = 0
+        if max_slots is not None and len(slots) > max_slots:
+            hidden = len(slots) - max_slots
+            last_epoch = slots[-1].epoch
+            slots = slots[:max_slots]
+        if show_price:
+            parts.extend(SLOT_TEMPLATE(format_epoch(slot.epoch), slot.price) for slot in slots)
+        else:
+            parts.extend(SLOT_NO_PRICE_TEMPLATE(format_epoch(slot.epoch)) for slot in slots)
+        if hidden:
+            parts.append(COLLAPSED_TEMPLATE(hidden, format_epoch(last_epoch)))
+        parts.append(separator)
+        blocks.append("".join(parts))
+    return blocks
+
+def _with_heading(heading, blocks):
+    """Unisce l'intestazione di sezione al primo ospedale, così non restano in messaggi diversi."""
+    if blocks:
+        blocks[0] = heading + blocks[0]
+    return blocks
+
+def render_header(title, fiscal_code, nre, prescription_name, cf_code, months_limit):
+    """Intestazione comune delle notifiche, con l'eventuale filtro sui mesi."""
+    header = HEADER_TEMPLATE(title=title, fiscal_code=fiscal_code, cf_code=cf_code,
+                             nre=nre, prescription_name=prescription_name)
+    if months_limit is not None:
+        header += FILTER_TEMPLATE(months_limit)
+    return header
+
+def render_new_prescription(current, fiscal_code, nre, prescription_name, cf_code, months_limit=None,
+                            max_slots=None, distance_fn=None):
+    """
+    Notifica della prima verifica di una prescrizione.
+
+    Returns:
+        list: I blocchi del messaggio (intestazione, poi uno per ospedale)
+    """
+    blocks = [render_header(TITLE_NEW, fiscal_code, nre, prescription_name, cf_code, months_limit) +
+              f"\n📋 <b>Disponibilità Trovate:</b> {len(current)}\n"]
+    blocks.extend(render_hospitals(group_by_hospital(current, distance_fn), separator="\n", max_slots=max_slots))
+    return blocks
+
+def render_update(changes, current, fiscal_code, nre, prescription_name, cf_code, months_limit=None,
+                  only_new_dates=True, notify_removed=False, show_all_current=True, total_changes=0,
+                  max_slots=None, distance_fn=None):
+    """
+    Notifica dei cambiamenti di una prescrizione.
+
+    Args:
+        changes: Il risultato di diff_availabilities
+        current: Le disponibilità attuali (già filtrate)
+        show_all_current: Aggiunge la sezione "Tutte le Disponibilità"
+        total_changes: Il numero di cambiamenti da mostrare se only_new_dates è False
+        max_slots: Disponibilità mostrate per ospedale, le altre vengono riassunte (None = tutte)
+        distance_fn: Ordina gli ospedali per distanza dal paziente (vedi group_by_hospital)
+
+    Returns:
+        list: I blocchi del messaggio (intestazioni di sezione e un blocco per ospedale)
+    """
+    header = render_header(TITLE_UPDATE, fiscal_code, nre, prescription_name, cf_code, months_limit)
+    if only_new_dates:
+        header += f"🆕 <b>Nuove Disponibilità:</b> {len(changes['new'])}\n"
+    else:
+        header += f"🔄 <b>Cambiamenti:</b> {total_changes}\n"
+    blocks = [header]
+
+    # Nuove disponibilità
+    if changes["new"]:
+        blocks.extend(_with_heading("\n<b>🟢 Nuove Disponibilità:</b>\n", render_hospitals(
+            group_by_hospital(changes["new"], distance_fn), max_slots=max_slots)))
+
+    # Disponibilità rimosse (se configurato)
+    if notify_removed and changes["removed"]:
+        blocks.extend(_with_heading("\n<b>🔴 Disponibilità Rimosse:</b>\n", render_hospitals(
+            group_by_hospital(changes["removed"], distance_fn), show_price=False, max_slots=max_slots)))
+
+    # Tutte le disponibilità attuali
+    if show_all_current and current:
+        blocks.extend(_with_heading(f"\n📋 <b>Tutte le Disponibilità:</b> {len(current)}\n", render_hospitals(
+            group_by_hospital(current, distance_fn), max_slots=max_slots)))
+
+    return blocks
+
+def render_earliest(improved, previous_epoch, fiscal_code, nre, prescription_name, cf_code, months_limit=None,
+                    distance_fn=None):
+    """
+    Notifica dell'anticipo della prima disponibilità (config["notify_mode"] = "earliest").
+
+    Args:
+        improved: La prima disponibilità di ogni ospedale che anticipa la precedente
+        previous_epoch: L'orario della prima disponibilità precedente (None se non c'era)
+        distance_fn: Ordina gli ospedali per distanza dal paziente (vedi group_by_hospital)
+
+    Returns:
+        list: I blocchi del messaggio (intestazione, poi uno per ospedale)
+    """
+    earliest = min(slot.epoch for slot in improved)
+    previous = format_epoch(previous_epoch) if previous_epoch is not None else "nessuna"
+    blocks = [render_header(TITLE_EARLIEST, fiscal_code, nre, prescription_name, cf_code, months_limit) +
+              "\n" + EARLIEST_TEMPLATE(format_epoch(earliest), previous)]
+    blocks.extend(render_hospitals(group_by_hospital(improved, distance_fn)))
+    return blocks
+
+def message_length(text):
+    """Lunghezza del testo come la conta Telegram (unità UTF-16, quindi le emoji valgono 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _split_block(block, limit):
+    """
+    Divide un blocco troppo lungo per un messaggio.
+
+    Il blocco viene diviso tra una riga e l'altra: ogni riga contiene tag HTML
+    completi, quindi le parti restano valide. Se il blocco è un ospedale, ogni
+    parte dopo la prima ripete l'intestazione dell'ospedale con "(continua)".
+    Una singola riga più lunga del limite (caso non previsto nei messaggi
+    generati) viene troncata.
+    """
+    match = _HOSPITAL_PATTERN.search(block)
+    continued = HOSPITAL_CONTINUED_TEMPLATE(*match.groups()) if match else ""
+    continued_length = message_length(continued)
+    if continued_length > limit // 2:
+        continued, continued_length = "", 0
+    line_limit = limit - continued_length
+
+    pieces = []
+    current = []
+    current_length = 0
+    for line in block.splitlines(keepends=True):
+        length = message_length(line)
+        if length > line_limit:
+            line = line[:line_limit - 1] + "\n"
+            length = message_length(line)
+        if current and current_length + length > limit:
+            pieces.append("".join(current))
+            current = [continued]
+            current_length = continued_length
+        current.append(line)
+        current_length += length
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+def split_message(blocks, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Unisce i blocchi in messaggi entro il limite di Telegram.
+
+    I messaggi vengono divisi tra un ospedale e l'altro (i blocchi di
+    render_new_prescription e render_update); solo un ospedale che da solo
+    supera il limite viene diviso tra le righe, ripetendone l'intestazione
+    in ogni parte. Se servono più messaggi, ognuno riporta "(parte X di Y)".
+
+    Returns:
+        list: I testi dei messaggi, da inviare in ordine
+    """
+    available = limit - PART_RESERVED_LENGTH
+    messages = []
+    current = []
+    current_length = 0
+    for block in blocks:
+        length = message_length(block)
+        pieces = [block] if length <= available else _split_block(block, available)
+        for piece in pieces:
+            length = message_length(piece)
+            if current and current_length + length > available:
+                messages.append("".join(current))
+                current = []
+                current_length = 0
+            current.append(piece)
+            current_length += length
+    if current:
+        messages.append("".join(current))
+
+    if len(messages) > 1:
+        messages = [text + PART_TEMPLATE(i, len(messages)) for i, text in enumerate(messages, 1)]
+    return messages
@@ -7,15 +7,174 @@ from recup_monitor import logger, TELEGRAM_TOKEN  # Importa il token Telegram
 from modules.api_client import (
     get_access_token, update_device_token, get_patient_info, 
     get_doctor_info, check_prescription, get_prescription_details,
-    get_availabilities
+    get_availabilities, get_last_error_status
 )
-from modules.data_utils import (
-    load_input_data, save_input_data, is_date_within_range,
-    is_similar_datetime, format_date
+from modules.data_utils import update_prescription_fields, checkpoint_previous_data
+from modules.prescription_state import (
+    record_success, record_failure, get_unavailable_state, get_state_label,
+    is_monitored, get_retry_delay
 )
+from modules.user_registry import get_user_registry
+from modules.availability_diff import diff_availabilities
+from modules.slots import slots_from_api, keep_earliest, snapshot_horizon
+from modules.slot_filters import compile_slot_filter
+from modules.notification_renderer import (
+    render_new_prescription, render_update, render_earliest, split_message
+)
+from modules.earliest_tracker import has_index, update_index, find_improvements
+from modules.recently_seen import get_recently_seen, drop_recently_seen
+from modules.hospital_registry import save_registry
+from modules.geo import get_patient_origin, make_distance_fn
+from modules.failure_tracking import (
+    classify_failure, is_auth_failure, cache_failure, get_cached_failure, clear_cached_failures
+)
+from config import (
+    STATE_INVALID, PERMANENT_FAILURES_TO_NOTIFY, COLLAPSED_SLOTS_PER_HOSPITAL, EARLIEST_DELTA_HOURS,
+    FLAP_DAMPING_WINDOW, PREVIOUS_DATA_MAX_SLOTS
+)
+
+def send_telegram_notification(chat_id, text):
+    """Invia un messaggio Telegram in modo sincrono (usato dal processo di monitoraggio)."""
+    try:
+        # Utilizziamo il metodo normale invece di quello asincrono per evitare problemi
+        import requests
+        
+        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+        data = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "HTML"
+        }
+        
+        response = requests.post(url, data=data, timeout=10)
+        response.raise_for_status()
+        
+        logger.info(f"Notifica inviata al chat ID: {chat_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Errore nell'inviare notifica: {str(e)}")
+        return False
+
+def send_telegram_messages(chat_id, messages):
+    """
+    Invia in ordine i messaggi di una notifica divisa in più parti.
+
+    Returns:
+        bool: True se tutte le parti sono state inviate
+    """
+    for i, text in enumerate(messages, 1):
+        if not send_telegram_notification(chat_id, text):
+            logger.error(f"Notifica al chat ID {chat_id} interrotta alla parte {i} di {len(messages)}")
+            return False
+    return True
+
+def notify_admin(text):
+    """Invia un avviso all'amministratore."""
+    admin_id = get_user_registry().admin_id
+    if admin_id is not None:
+        send_telegram_notification(admin_id, text)
+
+# Se l'amministratore è già stato avvisato delle credenziali rifiutate
+# (di nuovo dopo il primo controllo riuscito)
+_auth_failure_notified = False
+
+def notify_auth_failure(status_code):
+    """Avvisa l'amministratore (una volta) che il servizio rifiuta le credenziali dell'app."""
+    global _auth_failure_notified
+    logger.error(f"Il servizio ha rifiutato le credenziali dell'app (HTTP {status_code})")
+    if _auth_failure_notified:
+        return
+    _auth_failure_notified = True
+    notify_admin("⛔ <b>Credenziali rifiutate</b>\n\n"
+                 f"Il servizio risponde HTTP {status_code} a tutte le richieste: probabilmente "
+                 "AUTH_HEADER è cambiato. Le prescrizioni restano nel loro stato e verranno "
+                 "controllate di nuovo ai prossimi cicli.")
+
+def clear_auth_failure():
+    """Registra che il servizio accetta di nuovo le credenziali dell'app."""
+    global _auth_failure_notified
+    _auth_failure_notified = False
+
+def handle_failure(prescription, failed_state, error_msg, response, cache_key, chat_id=None, subscribers=None):
+    """
+    Gestisce il fallimento di un passo del controllo di una prescrizione.
+    
+    Classifica l'errore come permanente o transitorio, aggiorna stato e backoff
+    della prescrizione, memorizza i fallimenti permanenti nella cache negativa
+    fino al nuovo tentativo e avvisa i proprietari dopo
+    PERMANENT_FAILURES_TO_NOTIFY fallimenti permanenti consecutivi. Se il
+    servizio rifiuta le credenziali dell'app viene avvisato solo l'amministratore.
+    
+    Returns:
+        tuple: (False, messaggio di errore), come process_prescription
+    """
+    status_code = get_last_error_status()
+    if is_auth_failure(response, status_code):
+        # Le credenziali dell'app valgono per tutte le prescrizioni: avvisiamo
+        # l'amministratore senza cambiare stato o backoff della prescrizione
+        notify_auth_failure(status_code)
+        return False, error_msg
+    
+    permanent = classify_failure(response, status_code)
+    permanent_failures = record_failure(prescription, failed_state, error_msg, permanent)
+    
+    # La cache negativa scade insieme al backoff della prescrizione
+    retry_delay = get_retry_delay(prescription)
+    if permanent and retry_delay > 0:
+        cache_failure(cache_key, error_msg, retry_delay)
+    
+    if permanent and permanent_failures == PERMANENT_FAILURES_TO_NOTIFY:
+        if is_monitored(prescription):
+            outcome = "Il monitoraggio continua, con tentativi sempre meno frequenti."
+        else:
+            outcome = "Il monitoraggio è stato interrotto: puoi riattivarlo con ⏯ Sospendi/Riattiva."
+        for owner_chat_id in get_subscriber_chat_ids(subscribers or [prescription], chat_id):
+            send_telegram_notification(
+                owner_chat_id,
+                f"⚠️ <b>Problema con una prescrizione monitorata</b>\n\n"
+                f"<b>NRE:</b> <code>{prescription['nre']}</code>\n"
+                f"<b>Descrizione:</b> {prescription.get('description', 'Non disponibile')}\n"
+                f"<b>Errore:</b> {error_msg}\n"
+                f"<b>Stato:</b> {get_state_label(prescription)}\n\n"
+                f"{permanent_failures} tentativi consecutivi falliti. {outcome}"
+            )
+    
+    return False, error_msg
+
+def get_subscriber_chat_ids(subscribers, chat_id=None):
+    """Restituisce le chat (senza duplicati) delle voci che monitorano una prescrizione."""
+    chat_ids = []
+    for subscriber in subscribers:
+        subscriber_chat_id = subscriber.get("telegram_chat_id", chat_id)
+        if subscriber_chat_id and subscriber_chat_id not in chat_ids:
+            chat_ids.append(subscriber_chat_id)
+    return chat_ids
+
+def get_flap_window(config):
+    """Secondi entro cui una disponibilità già vista non viene notificata di nuovo."""
+    minutes = (config or {}).get("flap_window_minutes")
+    if minutes is None:
+        return FLAP_DAMPING_WINDOW
+    try:
+        return float(minutes) * 60
+    except (TypeError, ValueError):
+        return FLAP_DAMPING_WINDOW
 
-def compare_availabilities(previous, current, fiscal_code, nre, prescription_name="", cf_code="", config=None):
-    """Compare previous and current availabilities with configuration per prescrizione."""
+def compare_availabilities(previous, current, fiscal_code, nre, prescription_name="", cf_code="", config=None,
+                           origin=None, recently_seen=None):
+    """
+    Compare previous and current availabilities with configuration per prescrizione.
+    
+    Le disponibilità sono liste di Slot (vedi modules.slots). origin sono le
+    coordinate del paziente (vedi modules.geo.get_patient_origin), usate per
+    max_distance_km e sort_by_distance. Le disponibilità in recently_seen
+    (vedi modules.recently_seen) viste entro la finestra di smorzamento non
+    vengono notificate come nuove.
+    
+    Returns:
+        list: I messaggi della notifica, già divisi entro il limite di Telegram
+        (None se non ci sono cambiamenti da notificare)
+    """
     # Configurazione predefinita se non specificata
     default_config = {
         "only_new_dates": True,
@@ -23,7 +182,10 @@ def compare_availabilities(previous, current, fiscal_code, nre, prescription_nam
         "min_changes_to_notify": 2,
         "time_threshold_minutes": 60,
         "show_all_current": True,  # Mostra tutte le disponibilità attuali
-        "months_limit": None       # Nessun limite di mesi predefinito
+        "months_limit": None,      # Nessun limite di mesi predefinito
+        "collapse_long_lists": False,  # Riassume gli ospedali con molte disponibilità
+        "max_distance_km": None,   # Nessun limite di distanza predefinito
+        "sort_by_distance": False  # Ospedali in ordine di data, non di distanza
     }
     
     # Usa la configurazione fornita o quella predefinita
@@ -35,59 +197,39 @@ def compare_availabilities(previous, current, fiscal_code, nre, prescription_nam
             if key not in config:
                 config[key] = value
     
+    # Disponibilità mostrate per ospedale (None = tutte)
+    max_slots = COLLAPSED_SLOTS_PER_HOSPITAL if config.get("collapse_long_lists") else None
+    
+    # Compiliamo una sola volta i filtri della prescrizione (date, giorni, orari, prezzo, ospedali)
+    slot_filter = compile_slot_filter(config, origin=origin)
+    
+    # Con un limite di distanza gli ospedali vengono mostrati dal più vicino
+    distance_fn = None
+    if config.get("sort_by_distance") or config.get("max_distance_km") is not None:
+        distance_fn = make_distance_fn(origin)
+    
     # Se è la prima volta che controlliamo questa prescrizione
     if not previous or not current:
         # Se non c'erano dati precedenti, consideriamo tutto come nuovo ma non spammiamo
         if not previous and len(current) > 0:
-            # Filtriamo le disponibilità in base al limite di mesi
+            # Filtriamo le disponibilità in base ai filtri della prescrizione
             months_limit = config.get("months_limit")
-            if months_limit is not None:
-                filtered_current = [
-                    avail for avail in current 
-                    if is_date_within_range(avail['date'], months_limit)
-                ]
-            else:
-                filtered_current = current
+            filtered_current = slot_filter(current)
             
             # Se non ci sono disponibilità nel range, non mostriamo nulla
             if not filtered_current:
                 return None
-                
-            # Preparazione del messaggio con formattazione HTML migliorata
-            message = f"""
-<b>🔍 Nuova Prescrizione</b>
-
-<b>Codice Fiscale:</b> <code>{fiscal_code}</code>
-<b>ID Tessera Sanitaria:</b> <code>{cf_code}</code>
-<b>NRE:</b> <code>{nre}</code>
-<b>Descrizione:</b> <code>{prescription_name}</code>
-"""
-            
-            # Se c'è un limite di mesi, lo mostriamo
-            if months_limit is not None:
-                message += f"<b>Filtro:</b> Solo appuntamenti entro {months_limit} mesi\n"
-            
-            message += f"\n📋 <b>Disponibilità Trovate:</b> {len(filtered_current)}\n"
             
-            # Raggruppiamo per ospedale
-            hospitals = {}
-            for avail in sorted(filtered_current, key=lambda x: x['date']):
-                hospital_name = avail['hospital']['name']
-                if hospital_name not in hospitals:
-                    hospitals[hospital_name] = []
-                hospitals[hospital_name].append(avail)
-            
-            # Mostriamo per ospedale
-            for hospital_name, availabilities in hospitals.items():
-                message += f"\n<b>{hospital_name}</b>\n"
-                message += f"📍 {availabilities[0]['site']['address']}\n"
-                
-                for avail in sorted(availabilities, key=lambda x: x['date']):
-                    message += f"📅 {format_date(avail['date'])} - {avail['price']} €\n"
+            # Se tutte erano già presenti poco fa (il servizio le aveva solo
+            # nascoste per un controllo), non le notifichiamo di nuovo
+            if not drop_recently_seen(filtered_current, recently_seen, get_flap_window(config)):
+                return None
                 
-                message += "\n"  # Spazio tra gli ospedali
-            
-            return message
+            # Preparazione del messaggio con formattazione HTML migliorata
+            return split_message(render_new_prescription(
+                filtered_current, fiscal_code, nre, prescription_name, cf_code, months_limit, max_slots,
+                distance_fn
+            ))
         return None
 
     # Otteniamo i valori di configurazione
@@ -98,102 +240,26 @@ def compare_availabilities(previous, current, fiscal_code, nre, prescription_nam
     show_all_current = config.get("show_all_current", True)
     months_limit = config.get("months_limit", None)
     
-    # Filtriamo le disponibilità attuali in base al limite di mesi
-    if months_limit is not None:
-        filtered_current = [
-            avail for avail in current 
-            if is_date_within_range(avail['date'], months_limit)
-        ]
-    else:
-        filtered_current = current
+    # Filtriamo le disponibilità attuali in base ai filtri della prescrizione
+    filtered_current = slot_filter(current)
         
     # Filtriamo anche le disponibilità precedenti per avere un confronto corretto
-    if months_limit is not None:
-        filtered_previous = [
-            avail for avail in previous 
-            if is_date_within_range(avail['date'], months_limit)
-        ]
-    else:
-        filtered_previous = previous
-    
-    # Prepara una struttura per i cambiamenti
-    changes = {
-        "new": [],
-        "removed": [],
-        "changed": []
-    }
+    filtered_previous = slot_filter(previous)
+    
+    # Calcoliamo nuove disponibilità, rimozioni e cambiamenti di prezzo per ospedale.
+    # Se lo snapshot salvato è stato ridotto, le disponibilità successive alla sua
+    # ultima data non erano conservate: non possono risultare nuove
+    changes = diff_availabilities(
+        filtered_previous,
+        filtered_current,
+        time_threshold,
+        notify_removed,
+        only_new_dates,
+        snapshot_horizon(previous, PREVIOUS_DATA_MAX_SLOTS)
+    )
     
-    # Crea dizionari per un confronto più semplice
-    # Usiamo l'ID dell'ospedale come chiave principale per aggregare meglio
-    prev_by_hospital = {}
-    curr_by_hospital = {}
-    
-    # Organizziamo i dati per ospedale
-    for a in filtered_previous:
-        hospital_id = a['hospital'].get('id', 'unknown')
-        if hospital_id not in prev_by_hospital:
-            prev_by_hospital[hospital_id] = []
-        prev_by_hospital[hospital_id].append(a)
-    
-    for a in filtered_current:
-        hospital_id = a['hospital'].get('id', 'unknown')
-        if hospital_id not in curr_by_hospital:
-            curr_by_hospital[hospital_id] = []
-        curr_by_hospital[hospital_id].append(a)
-    
-    # Lista degli ospedali
-    all_hospitals = set(list(prev_by_hospital.keys()) + list(curr_by_hospital.keys()))
-    
-    # Esaminiamo i cambiamenti per ospedale
-    for hospital_id in all_hospitals:
-        prev_avails = prev_by_hospital.get(hospital_id, [])
-        curr_avails = curr_by_hospital.get(hospital_id, [])
-        
-        # Costruiamo dizionari per date
-        prev_dates = {a['date']: a for a in prev_avails}
-        curr_dates = {a['date']: a for a in curr_avails}
-        
-        # Verifica nuove date
-        for date, avail in curr_dates.items():
-            if date not in prev_dates:
-                # Verifichiamo se si tratta solo di un piccolo cambiamento di orario
-                is_minor_change = False
-                for prev_date in prev_dates.keys():
-                    # Confrontiamo le date ignorando ore e minuti
-                    if is_similar_datetime(prev_date, date, time_threshold):
-                        # È probabilmente solo un aggiustamento di orario, non una nuova disponibilità
-                        is_minor_change = True
-                        break
-                
-                if not is_minor_change:
-                    changes["new"].append(avail)
-        
-        # Verifica date rimosse (solo se notify_removed è True)
-        if notify_removed:
-            for date, avail in prev_dates.items():
-                if date not in curr_dates:
-                    # Verifichiamo se si tratta solo di un piccolo cambiamento di orario
-                    is_minor_change = False
-                    for curr_date in curr_dates.keys():
-                        # Confrontiamo le date ignorando ore e minuti
-                        if is_similar_datetime(date, curr_date, time_threshold):
-                            # È probabilmente solo un aggiustamento di orario, non una rimozione
-                            is_minor_change = True
-                            break
-                    
-                    if not is_minor_change:
-                        changes["removed"].append(avail)
-        
-        # Verifica cambiamenti di prezzo (solo se only_new_dates è False)
-        if not only_new_dates:
-            for date, curr_avail in curr_dates.items():
-                if date in prev_dates:
-                    prev_avail = prev_dates[date]
-                    if prev_avail['price'] != curr_avail['price']:
-                        changes["changed"].append({
-                            "previous": prev_avail,
-                            "current": curr_avail
-                        })
+    # Le disponibilità scomparse e ricomparse entro la finestra non sono nuove
+    changes["new"] = drop_recently_seen(changes["new"], recently_seen, get_flap_window(config))
     
     # Calcoliamo il totale dei cambiamenti in base alla configurazione
     total_changes = len(changes["new"])
@@ -205,103 +271,88 @@ def compare_availabilities(previous, current, fiscal_code, nre, prescription_nam
     # Se ci sono abbastanza cambiamenti, costruisci un messaggio
     if total_changes >= min_changes or (len(changes["new"]) > 0 and only_new_dates):
         # Preparazione del messaggio con formattazione HTML migliorata
-        message = f"""
-<b>🔍 Aggiornamento Prescrizione</b>
-
-<b>Codice Fiscale:</b> <code>{fiscal_code}</code>
-<b>ID Tessera Sanitaria:</b> <code>{cf_code}</code>
-<b>NRE:</b> <code>{nre}</code>
-<b>Descrizione:</b> <code>{prescription_name}</code>
-"""
-        
-        # Se c'è un limite di mesi, lo mostriamo
-        if months_limit is not None:
-            message += f"<b>Filtro:</b> Solo appuntamenti entro {months_limit} mesi\n"
-        
-        # Intestazione del messaggio
-        if only_new_dates:
-            message += f"🆕 <b>Nuove Disponibilità:</b> {len(changes['new'])}\n"
-        else:
-            message += f"🔄 <b>Cambiamenti:</b> {total_changes}\n"
-        
-        # Nuove disponibilità
-        if changes["new"]:
-            message += "\n<b>🟢 Nuove Disponibilità:</b>\n"
-            
-            # Raggruppiamo per ospedale
-            hospitals_new = {}
-            for avail in changes["new"]:
-                hospital_name = avail['hospital']['name']
-                if hospital_name not in hospitals_new:
-                    hospitals_new[hospital_name] = []
-                hospitals_new[hospital_name].append(avail)
-            
-            # Mostriamo per ospedale
-            for hospital_name, availabilities in hospitals_new.items():
-                message += f"\n<b>{hospital_name}</b>\n"
-                message += f"📍 {availabilities[0]['site']['address']}\n"
-                
-                # Ordiniamo le date
-                sorted_availabilities = sorted(availabilities, key=lambda x: x['date'])
-                
-                # Mostriamo tutte le date
-                for avail in sorted_availabilities:
-                    message += f"📅 {format_date(avail['date'])} - {avail['price']} €\n"
-        
-        # Disponibilità rimosse (se configurato)
-        if notify_removed and changes["removed"]:
-            message += "\n<b>🔴 Disponibilità Rimosse:</b>\n"
-            hospitals_removed = {}
-            for avail in changes["removed"]:
-                hospital_name = avail['hospital']['name']
-                if hospital_name not in hospitals_removed:
-                    hospitals_removed[hospital_name] = []
-                hospitals_removed[hospital_name].append(avail)
-            
-            for hospital_name, availabilities in hospitals_removed.items():
-                message += f"\n<b>{hospital_name}</b>\n"
-                message += f"📍 {availabilities[0]['site']['address']}\n"
-                
-                sorted_availabilities = sorted(availabilities, key=lambda x: x['date'])
-                
-                for avail in sorted_availabilities:
-                    message += f"📅 {format_date(avail['date'])}\n"
-        
-        # Tutte le disponibilità attuali
-        if show_all_current and filtered_current:
-            message += f"\n📋 <b>Tutte le Disponibilità:</b> {len(filtered_current)}\n"
-            
-            hospitals = {}
-            for avail in filtered_current:
-                hospital_name = avail['hospital']['name']
-                if hospital_name not in hospitals:
-                    hospitals[hospital_name] = []
-                hospitals[hospital_name].append(avail)
-            
-            for hospital_name, availabilities in hospitals.items():
-                message += f"\n<b>{hospital_name}</b>\n"
-                message += f"📍 {availabilities[0]['site']['address']}\n"
-                
-                sorted_availabilities = sorted(availabilities, key=lambda x: x['date'])
-                
-                for avail in sorted_availabilities:
-                    message += f"📅 {format_date(avail['date'])} - {avail['price']} €\n"
-        
-        return message
+        return split_message(render_update(
+            changes, filtered_current, fiscal_code, nre, prescription_name, cf_code, months_limit,
+            only_new_dates, notify_removed, show_all_current, total_changes, max_slots, distance_fn
+        ))
     
     return None
 
-def process_prescription(prescription, previous_data, chat_id=None):
-    """Process a single prescription and check for availability changes."""
+def compare_earliest(tracker_key, previous, current, fiscal_code, nre, prescription_name="", cf_code="",
+                     config=None, origin=None, recently_seen=None):
+    """
+    Notifica solo l'anticipo della prima disponibilità (config["notify_mode"] = "earliest").
+
+    L'indice della prima disponibilità di ogni voce viene aggiornato a ogni
+    controllo (vedi modules.earliest_tracker), quindi le disponibilità
+    precedenti vengono filtrate solo la prima volta dopo un riavvio.
+
+    Args:
+        tracker_key: La voce (prescrizione + chat) a cui appartiene l'indice
+        config: La configurazione della prescrizione; earliest_delta_hours
+            è l'anticipo minimo da notificare (default EARLIEST_DELTA_HOURS)
+
+    Returns:
+        list: I messaggi della notifica (None se la prima disponibilità non è anticipata)
+    """
+    config = config or {}
+    slot_filter = compile_slot_filter(config, origin=origin)
+    
+    filtered_previous = None if has_index(tracker_key) else slot_filter(previous)
+    old_index, new_index = update_index(tracker_key, slot_filter(current), filtered_previous)
+    
+    try:
+        delta_seconds = float(config.get("earliest_delta_hours", EARLIEST_DELTA_HOURS)) * 3600
+    except (TypeError, ValueError):
+        delta_seconds = EARLIEST_DELTA_HOURS * 3600
+    
+    # Una disponibilità già vista poco fa che ricompare non è un anticipo
+    improved = drop_recently_seen(find_improvements(old_index, new_index, delta_seconds),
+                                  recently_seen, get_flap_window(config))
+    if not improved:
+        return None
+    
+    distance_fn = None
+    if config.get("sort_by_distance") or config.get("max_distance_km") is not None:
+        distance_fn = make_distance_fn(origin)
+    
+    return split_message(render_earliest(
+        improved, old_index.epoch if old_index is not None else None, fiscal_code, nre,
+        prescription_name, cf_code, config.get("months_limit"), distance_fn
+    ))
+
+def fetch_prescription(prescription, chat_id=None, use_negative_cache=False, subscribers=None):
+    """
+    Interroga il servizio per una prescrizione e ne restituisce le disponibilità.
+
+    Il risultato non dipende dalla configurazione delle singole chat, quindi
+    può essere condiviso tra tutte le voci con lo stesso codice fiscale e NRE.
+
+    Args:
+        prescription: La voce usata per interrogare il servizio
+        chat_id: La chat da usare per le voci senza telegram_chat_id
+        use_negative_cache: Salta le prescrizioni fallite di recente in modo permanente
+        subscribers: Tutte le voci della prescrizione, da avvisare in caso di errori
+
+    Returns:
+        tuple: (True, dizionario con name, cf_code e availabilities) oppure (False, messaggio di errore)
+    """
     fiscal_code = prescription["fiscal_code"]
     nre = prescription["nre"]
     prescription_key = f"{fiscal_code}_{nre}"
     
-    # Otteniamo la configurazione specifica per questa prescrizione
-    config = prescription.get("config", {})
+    # Chiavi della cache negativa per i passi che dipendono dalla prescrizione
+    patient_key = ("patient", fiscal_code)
+    doctor_key = ("doctor", fiscal_code)
+    nre_key = ("prescription", fiscal_code, nre)
     
-    # Otteniamo l'ID chat Telegram specifico per questa prescrizione, se presente
-    telegram_chat_id = prescription.get("telegram_chat_id", chat_id)
+    # Se un passo è fallito di recente in modo permanente, evitiamo di ripetere le chiamate
+    if use_negative_cache:
+        for cache_key in (patient_key, doctor_key, nre_key):
+            cached_error = get_cached_failure(cache_key)
+            if cached_error:
+                logger.info(f"Prescrizione {prescription_key} saltata, errore recente: {cached_error}")
+                return False, cached_error
     
     logger.info(f"Elaborazione prescrizione {prescription_key}")
     
@@ -318,82 +369,59 @@ def process_prescription(prescription, previous_data, chat_id=None):
     if not patient_info or 'content' not in patient_info or not patient_info['content']:
         error_msg = f"Impossibile trovare informazioni per il paziente {fiscal_code}"
         logger.error(error_msg)
-        return False, error_msg
+        return handle_failure(prescription, STATE_INVALID, error_msg, patient_info, patient_key, chat_id, subscribers)
         
-    # Carichiamo tutte le prescrizioni
-    all_prescriptions = load_input_data()
     cf_code = ""
     
     try:
-        # Flag per verificare se abbiamo trovato e aggiornato la prescrizione
-        prescription_updated = False
+        patient_details = patient_info['content'][0]
         
-        # Cerchiamo e aggiorniamo la prescrizione specifica
-        for p in all_prescriptions:
-            if (p["fiscal_code"] == fiscal_code and 
-                p["nre"] == nre):
-                
-                # Verifichiamo che ci siano informazioni del paziente valide
-                if patient_info and 'content' in patient_info and patient_info['content']:
-                    patient_details = patient_info['content'][0]
-                    
-                    # Creiamo un dizionario dettagliato e pulito
-                    patient_info_dict = {
-                        "firstName": patient_details.get("firstName", "N/A"),
-                        "lastName": patient_details.get("lastName", "N/A"),
-                        "birthDate": patient_details.get("birthDate", "N/A"),
-                        
-                        # Codice della tessera sanitaria con gestione più robusta
-                        "teamCard": {
-                            "code": patient_details.get("teamCard", {}).get("code", "N/A"),
-                            "validFrom": patient_details.get("teamCard", {}).get("startDate", "N/A"),
-                            "validTo": patient_details.get("teamCard", {}).get("endDate", "N/A")
-                        },
-                        
-                        # Residenza con gestione degli attributi mancanti
-                        "residence": " ".join(filter(bool, [
-                            patient_details.get('residence', {}).get('address', ''),
-                            patient_details.get('residence', {}).get('streetNumber', ''),
-                            patient_details.get('residence', {}).get('postalCode', ''),
-                            patient_details.get('residence', {}).get('town', {}).get('name', ''),
-                            patient_details.get('residence', {}).get('province', {}).get('id', '')
-                        ])).strip() or "N/A",
-                        
-                        # Domicilio con gestione degli attributi mancanti
-                        "domicile": " ".join(filter(bool, [
-                            patient_details.get('domicile', {}).get('address', ''),
-                            patient_details.get('domicile', {}).get('streetNumber', ''),
-                            patient_details.get('domicile', {}).get('postalCode', ''),
-                            patient_details.get('domicile', {}).get('town', {}).get('name', ''),
-                            patient_details.get('domicile', {}).get('province', {}).get('id', '')
-                        ])).strip() or "N/A",
-                        
-                        # Informazioni aggiuntive
-                        "birthPlace": f"{patient_details.get('birthPlace', {}).get('name', 'N/A')}, "
-                                      f"{patient_details.get('birthProvince', {}).get('id', 'N/A')}",
-                        
-                        "citizenship": patient_details.get('citizenship', {}).get('name', 'N/A')
-                    }
-                    
-                    cf_code = patient_details.get("teamCard", {}).get("code", "")
-                    
-                    # Aggiungiamo le informazioni del paziente
-                    p["patient_info"] = patient_info_dict
-                    
-                    # Logghiamo l'aggiornamento
-                    logger.info(f"Aggiornate informazioni paziente per prescrizione NRE: {nre}")
-                    
-                    # Impostiamo il flag di aggiornamento
-                    prescription_updated = True
-                
-                break  # Usciamo dal ciclo dopo aver trovato la prescrizione
+        # Creiamo un dizionario dettagliato e pulito
+        patient_info_dict = {
+            "firstName": patient_details.get("firstName", "N/A"),
+            "lastName": patient_details.get("lastName", "N/A"),
+            "birthDate": patient_details.get("birthDate", "N/A"),
+            
+            # Codice della tessera sanitaria con gestione più robusta
+            "teamCard": {
+                "code": patient_details.get("teamCard", {}).get("code", "N/A"),
+                "validFrom": patient_details.get("teamCard", {}).get("startDate", "N/A"),
+                "validTo": patient_details.get("teamCard", {}).get("endDate", "N/A")
+            },
+            
+            # Residenza con gestione degli attributi mancanti
+            "residence": " ".join(filter(bool, [
+                patient_details.get('residence', {}).get('address', ''),
+                patient_details.get('residence', {}).get('streetNumber', ''),
+                patient_details.get('residence', {}).get('postalCode', ''),
+                patient_details.get('residence', {}).get('town', {}).get('name', ''),
+                patient_details.get('residence', {}).get('province', {}).get('id', '')
+            ])).strip() or "N/A",
+            
+            # Domicilio con gestione degli attributi mancanti
+            "domicile": " ".join(filter(bool, [
+                patient_details.get('domicile', {}).get('address', ''),
+                patient_details.get('domicile', {}).get('streetNumber', ''),
+                patient_details.get('domicile', {}).get('postalCode', ''),
+                patient_details.get('domicile', {}).get('town', {}).get('name', ''),
+                patient_details.get('domicile', {}).get('province', {}).get('id', '')
+            ])).strip() or "N/A",
+            
+            # Informazioni aggiuntive
+            "birthPlace": f"{patient_details.get('birthPlace', {}).get('name', 'N/A')}, "
+                          f"{patient_details.get('birthProvince', {}).get('id', 'N/A')}",
+            
+            "citizenship": patient_details.get('citizenship', {}).get('name', 'N/A')
+        }
         
-        # Salviamo solo se abbiamo effettivamente aggiornato qualcosa
-        if prescription_updated:
-            save_input_data(all_prescriptions)
+        cf_code = patient_details.get("teamCard", {}).get("code", "")
+    
+        # Aggiorniamo le voci della prescrizione (una per chat), in memoria e
+        # nell'archivio: la scrittura avviene solo se i dati sono cambiati
+        for subscriber in subscribers or [prescription]:
+            subscriber["patient_info"] = patient_info_dict
+        if update_prescription_fields(fiscal_code, nre, {"patient_info": patient_info_dict}):
             logger.info(f"Salvate informazioni paziente per prescrizione NRE: {nre}")
-        else:
-            logger.warning(f"Nessuna prescrizione trovata per aggiornamento: {fiscal_code}, {nre}")
     
     except Exception as e:
         # Catturiamo e logghiamo eventuali errori durante l'aggiornamento
@@ -407,7 +435,7 @@ def process_prescription(prescription, previous_data, chat_id=None):
     if not doctor_info or 'id' not in doctor_info:
         error_msg = f"Impossibile trovare informazioni per il medico del paziente {fiscal_code}"
         logger.error(error_msg)
-        return False, error_msg
+        return handle_failure(prescription, STATE_INVALID, error_msg, doctor_info, doctor_key, chat_id, subscribers)
     
     process_id = doctor_info['id']
     
@@ -416,14 +444,16 @@ def process_prescription(prescription, previous_data, chat_id=None):
     if not check_prescription_result:
         error_msg = f"Impossibile verificare la prescrizione {nre}"
         logger.error(error_msg)
-        return False, error_msg
+        return handle_failure(prescription, STATE_INVALID, error_msg,
+                              check_prescription_result, nre_key, chat_id, subscribers)
     
     # Step 6: Get prescription details
     prescription_details = get_prescription_details(patient_id, nre)
     if not prescription_details or 'details' not in prescription_details or not prescription_details['details']:
         error_msg = f"Impossibile ottenere i dettagli della prescrizione {nre}"
         logger.error(error_msg)
-        return False, error_msg
+        return handle_failure(prescription, STATE_INVALID, error_msg,
+                              prescription_details, nre_key, chat_id, subscribers)
     
     order_ids = prescription_details['details'][0]['service']['id']
     
@@ -445,55 +475,131 @@ def process_prescription(prescription, previous_data, chat_id=None):
     if not availabilities or 'content' not in availabilities:
         error_msg = f"Impossibile ottenere le disponibilità per {nre}, sei sicuro che non sia già prenotata?"
         logger.error(error_msg)
-        return False, error_msg
+        # Una prescrizione che non restituisce più disponibilità è già prenotata o scaduta
+        return handle_failure(prescription, get_unavailable_state(prescription), error_msg,
+                              availabilities, nre_key, chat_id, subscribers)
+    
+    # Conserviamo solo i campi usati dal monitoraggio
+    current_availabilities = slots_from_api(availabilities['content'])
+    
+    # La prescrizione risponde correttamente: è attiva
+    clear_auth_failure()
+    record_success(prescription)
+    clear_cached_failures(patient_key, doctor_key, nre_key)
+    
+    return True, {
+        "name": prescription_name,
+        "cf_code": cf_code,
+        "availabilities": current_availabilities
+    }
+
+def notify_subscriber(prescription, previous_availabilities, result, chat_id=None, recently_seen=None):
+    """
+    Confronta le disponibilità con la configurazione di una voce e la avvisa dei cambiamenti.
+
+    Args:
+        prescription: La voce (prescrizione + chat) da avvisare
+        previous_availabilities: Lo snapshot precedente, condiviso tra le voci
+        result: Il risultato di fetch_prescription
+        chat_id: La chat da usare se la voce non ha telegram_chat_id
+        recently_seen: Le disponibilità viste di recente, per lo smorzamento
+
+    Returns:
+        bool: True se è stata inviata una notifica
+    """
+    prescription_key = f"{prescription['fiscal_code']}_{prescription['nre']}"
     
-    current_availabilities = availabilities['content']
+    # Otteniamo l'ID chat Telegram specifico per questa prescrizione, se presente
+    telegram_chat_id = prescription.get("telegram_chat_id", chat_id)
     
-    # Compare with previous data to detect changes
-    previous_availabilities = previous_data.get(prescription_key, [])
+    # Aggiorniamo il nome della prescrizione nei dati
+    prescription["description"] = result["name"]
     
-    # Confronta e genera un messaggio se ci sono cambiamenti significativi
-    changes_message = compare_availabilities(
-        previous_availabilities, 
-        current_availabilities,
-        fiscal_code,
-        nre,
-        prescription_name,
-        cf_code,
-        config
-    )
+    # Confronta e genera un messaggio se ci sono cambiamenti significativi,
+    # con la configurazione specifica per questa voce
+    config = prescription.get("config", {})
+    if config.get("notify_mode") == "earliest":
+        # Solo quando la prima disponibilità viene anticipata
+        changes_message = compare_earliest(
+            f"{prescription_key}_{telegram_chat_id}",
+            previous_availabilities,
+            result["availabilities"],
+            prescription["fiscal_code"],
+            prescription["nre"],
+            result["name"],
+            result["cf_code"],
+            config,
+            get_patient_origin(prescription),
+            recently_seen
+        )
+    else:
+        changes_message = compare_availabilities(
+            previous_availabilities, 
+            result["availabilities"],
+            prescription["fiscal_code"],
+            prescription["nre"],
+            result["name"],
+            result["cf_code"],
+            config,
+            get_patient_origin(prescription),
+            recently_seen
+        )
     
     # Se ci sono cambiamenti, invia una notifica
-    if changes_message:
-        logger.info(f"Rilevati cambiamenti significativi per {prescription_key}")
-        
-        # Controlliamo se le notifiche sono abilitate per questa prescrizione
-        notifications_enabled = prescription.get("notifications_enabled", True)  # Default a True
-        
-        if notifications_enabled:
-            try:
-                # Utilizziamo il metodo normale invece di quello asincrono per evitare problemi
-                import requests
-                
-                url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-                data = {
-                    "chat_id": telegram_chat_id,
-                    "text": changes_message,
-                    "parse_mode": "HTML"
-                }
-                
-                response = requests.post(url, data=data, timeout=10)
-                response.raise_for_status()
-                
-                logger.info(f"Notifica inviata al chat ID: {telegram_chat_id}")
-            except Exception as e:
-                logger.error(f"Errore nell'inviare notifica: {str(e)}")
-        else:
-            logger.info(f"Notifiche disabilitate per {prescription_key}, nessun messaggio inviato")
-    else:
-        logger.info(f"Nessun cambiamento significativo rilevato per {prescription_key}")
+    if not changes_message:
+        logger.info(f"Nessun cambiamento significativo rilevato per {prescription_key} (chat {telegram_chat_id})")
+        return False
     
-    # Update previous data for next comparison
+    logger.info(f"Rilevati cambiamenti significativi per {prescription_key} (chat {telegram_chat_id})")
+    
+    # Controlliamo se le notifiche sono abilitate per questa prescrizione
+    if not prescription.get("notifications_enabled", True):  # Default a True
+        logger.info(f"Notifiche disabilitate per {prescription_key}, nessun messaggio inviato")
+        return False
+    
+    return send_telegram_messages(telegram_chat_id, changes_message)
+
+def process_subscribers(subscribers, previous_data, chat_id=None, use_negative_cache=False):
+    """
+    Controlla una prescrizione una sola volta e avvisa tutte le voci che la monitorano.
+
+    Args:
+        subscribers: Le voci con lo stesso codice fiscale e NRE (una per chat)
+        previous_data: Gli snapshot delle disponibilità, aggiornati sul posto
+        chat_id: La chat da usare per le voci senza telegram_chat_id
+        use_negative_cache: Salta le prescrizioni fallite di recente in modo permanente
+
+    Returns:
+        tuple: (successo, nome della prescrizione o messaggio di errore)
+    """
+    prescription = subscribers[0]
+    prescription_key = f"{prescription['fiscal_code']}_{prescription['nre']}"
+    
+    success, result = fetch_prescription(prescription, chat_id, use_negative_cache, subscribers)
+    if not success:
+        return False, result
+    
+    # Gli snapshot salvati fanno riferimento al registro: salviamo prima le sedi nuove
+    save_registry()
+    
+    # Tutte le voci vengono confrontate con lo stesso snapshot precedente
+    previous_availabilities = previous_data.get(prescription_key, [])
+    recently_seen = get_recently_seen(prescription_key)
+    for subscriber in subscribers:
+        notify_subscriber(subscriber, previous_availabilities, result, chat_id, recently_seen)
+    
+    # Update previous data for next comparison, salvando subito solo la voce cambiata.
+    # In memoria restano tutte le disponibilità (es. per lo storico), su disco solo
+    # le PREVIOUS_DATA_MAX_SLOTS più vicine (vedi snapshot_horizon)
+    current_availabilities = result["availabilities"]
+    recently_seen.touch(current_availabilities)
+    stored_availabilities = keep_earliest(current_availabilities, PREVIOUS_DATA_MAX_SLOTS)
+    if keep_earliest(previous_availabilities, PREVIOUS_DATA_MAX_SLOTS) != stored_availabilities:
+        checkpoint_previous_data(prescription_key, stored_availabilities)
     previous_data[prescription_key] = current_availabilities
     
-    return True, prescription_name
\ No newline at end of file
+    return True, result["name"]
+
+def process_prescription(prescription, previous_data, chat_id=None, use_negative_cache=False):
+    """Process a single prescription and check for availability changes."""
+    return process_subscribers([prescription], previous_data, chat_id, use_negative_cache)
@@ -0,0 +1,326 @@
+import threading
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, PRESCRIPTION_FLUSH_DELAY
+from modules.data_utils import get_storage, get_entry_id, apply_entry_changes, get_changed_keys
+from modules.state_events import (
+    is_connected, subscribe, start_listener, publish, TOPIC_PRESCRIPTIONS
+)
+
+class PrescriptionRepository:
+    """
+    Le prescrizioni del processo, in memoria, con indici per chiave, chat e prenotazione.
+
+    Le letture non accedono all'archivio: controllano solo la sua firma e
+    ricaricano le voci quando un altro processo le ha modificate. Se il
+    processo riceve le notifiche di modifica (vedi modules.state_events),
+    la firma viene controllata solo dopo una notifica. Le modifiche
+    vengono applicate subito in memoria e salvate in gruppo da un thread,
+    al più flush_delay secondi dopo la prima modifica non salvata, scrivendo
+    solo le voci e i campi modificati (vedi apply_entry_changes).
+
+    Le voci restituite sono quelle in memoria: vanno modificate solo con
+    add, update, update_key e remove_key.
+    """
+
+    def __init__(self, storage=None, flush_delay=PRESCRIPTION_FLUSH_DELAY):
+        self._storage = storage or get_storage()
+        self._flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._signature = None
+        self._stale = True
+
+        # Identificativo (vedi get_entry_id) -> voce, nell'ordine dell'archivio
+        self._entries = {}
+        self._by_key = {}
+        self._by_chat = {}
+        self._by_booking = {}
+
+        # Modifiche non ancora salvate e quelle in corso di salvataggio
+        self._pending = self._empty_changes()
+        self._in_flight = None
+
+    @staticmethod
+    def _empty_changes():
+        return {"inserted": {}, "updated": {}, "deleted": set()}
+
+    # --- Indici ---
+
+    def _rebuild(self, prescriptions):
+        self._entries = {}
+        self._by_key = {}
+        self._by_chat = {}
+        self._by_booking = {}
+        for prescription in prescriptions:
+            self._index(prescription)
+
+    def _index(self, prescription):
+        entry_id = get_entry_id(prescription)
+        if entry_id in self._entries:
+            self._unindex(entry_id)
+        self._entries[entry_id] = prescription
+        self._by_key.setdefault(entry_id[:2], []).append(entry_id)
+        self._by_chat.setdefault(entry_id[2], []).append(entry_id)
+        self._index_bookings(entry_id, prescription)
+
+    def _index_bookings(self, entry_id, prescription, remove=False):
+        for booking in prescription.get("bookings") or []:
+            if remove:
+                self._by_booking.pop(str(booking.get("booking_id")), None)
+            else:
+                self._by_booking[str(booking.get("booking_id"))] = (entry_id, booking)
+
+    def _unindex(self, entry_id):
+        prescription = self._entries.pop(entry_id)
+        self._by_key[entry_id[:2]].remove(entry_id)
+        if not self._by_key[entry_id[:2]]:
+            del self._by_key[entry_id[:2]]
+        self._by_chat[entry_id[2]].remove(entry_id)
+        if not self._by_chat[entry_id[2]]:
+            del self._by_chat[entry_id[2]]
+        self._index_bookings(entry_id, prescription, remove=True)
+        return prescription
+
+    def on_change(self, topic, keys):
+        """Gestore delle notifiche di modifica: le voci vanno ricontrollate alla prossima lettura."""
+        if topic == TOPIC_PRESCRIPTIONS:
+            self._stale = True
+
+    def _refresh(self):
+        """Ricarica le voci se l'archivio è cambiato (da chiamare con _lock)."""
+        if not self._stale and is_connected():
+            return
+        # Il flag va azzerato prima di leggere la firma: una notifica
+        # successiva verrà gestita alla lettura seguente
+        self._stale = False
+
+        # La firma va letta prima del contenuto, come in load_input_data_if_changed
+        signature = self._storage.prescriptions_signature()
+        if signature is not None and signature == self._signature:
+            return
+
+        prescriptions = self._storage.load_prescriptions()
+        if prescriptions is None:
+            # Archivio non leggibile: continuiamo con le voci in memoria e riproviamo alla prossima lettura
+            self._stale = True
+            return
+        # Le modifiche non ancora salvate restano valide sulle voci ricaricate
+        for changes in (self._in_flight, self._pending):
+            if changes:
+                apply_entry_changes(prescriptions, changes["inserted"].values(),
+                                    changes["updated"].items(), changes["deleted"])
+        self._rebuild(prescriptions)
+        self._signature = signature
+
+    # --- Letture ---
+
+    def all(self):
+        """Restituisce tutte le voci."""
+        with self._lock:
+            self._refresh()
+            return list(self._entries.values())
+
+    def for_chat(self, chat_id):
+        """Restituisce le voci monitorate da una chat."""
+        with self._lock:
+            self._refresh()
+            return [self._entries[entry_id] for entry_id in self._by_chat.get(str(chat_id), [])]
+
+    def for_key(self, fiscal_code, nre):
+        """Restituisce le voci di una prescrizione (una per chat)."""
+        with self._lock:
+            self._refresh()
+            return [self._entries[entry_id] for entry_id in self._by_key.get((fiscal_code, nre), [])]
+
+    def get(self, fiscal_code, nre, chat_id=None):
+        """
+        Restituisce una voce della prescrizione.
+
+        Args:
+            chat_id: La chat della voce (None = la prima voce della prescrizione)
+
+        Returns:
+            dict: La voce, None se non esiste
+        """
+        with self._lock:
+            self._refresh()
+            if chat_id is not None:
+                return self._entries.get((fiscal_code, nre, str(chat_id)))
+            entry_ids = self._by_key.get((fiscal_code, nre))
+            return self._entries[entry_ids[0]] if entry_ids else None
+
+    def find_booking(self, booking_id):
+        """Restituisce (voce, prenotazione) con l'id indicato, (None, None) se non esiste."""
+        with self._lock:
+            self._refresh()
+            entry_id, booking = self._by_booking.get(str(booking_id), (None, None))
+            if entry_id is None:
+                return None, None
+            return self._entries[entry_id], booking
+
+    # --- Modifiche ---
+
+    def add(self, prescription):
+        """Aggiunge una voce (o sostituisce quella con lo stesso identificativo)."""
+        entry_id = get_entry_id(prescription)
+        with self._lock:
+            self._refresh()
+            self._index(prescription)
+            self._pending["inserted"][entry_id] = prescription
+            self._pending["updated"].pop(entry_id, None)
+            self._pending["deleted"].discard(entry_id)
+            self._schedule_flush()
+
+    def update(self, prescription, fields):
+        """
+        Aggiorna alcuni campi di una voce.
+
+        Returns:
+            bool: True se la voce esiste, False altrimenti
+        """
+        entry_id = get_entry_id(prescription)
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return False
+            if "bookings" in fields:
+                self._index_bookings(entry_id, entry, remove=True)
+            entry.update(fields)
+            if "bookings" in fields:
+                self._index_bookings(entry_id, entry)
+            # Le voci nuove vengono salvate per intero
+            if entry_id not in self._pending["inserted"]:
+                self._pending["updated"].setdefault(entry_id, {}).update(fields)
+            self._schedule_flush()
+            return True
+
+    def update_key(self, fiscal_code, nre, fields):
+        """
+        Aggiorna alcuni campi di tutte le voci di una prescrizione.
+
+        Returns:
+            int: Il numero di voci aggiornate
+        """
+        with self._lock:
+            return sum(self.update(entry, fields) for entry in self.for_key(fiscal_code, nre))
+
+    def remove_key(self, fiscal_code, nre):
+        """
+        Rimuove tutte le voci di una prescrizione.
+
+        Returns:
+            list: Le voci rimosse
+        """
+        with self._lock:
+            self._refresh()
+            removed = []
+            for entry_id in list(self._by_key.get((fiscal_code, nre), [])):
+                removed.append(self._unindex(entry_id))
+                self._pending["updated"].pop(entry_id, None)
+                # Una voce mai salvata non va rimossa dall'archivio
+                if self._pending["inserted"].pop(entry_id, None) is None:
+                    self._pending["deleted"].add(entry_id)
+            if removed:
+                self._schedule_flush()
+            return removed
+
+    # --- Salvataggio ---
+
+    def _schedule_flush(self):
+        """Pianifica il salvataggio delle modifiche (da chiamare con _lock)."""
+        if self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _has_changes(self, changes):
+        return any(changes[name] for name in ("inserted", "updated", "deleted"))
+
+    def flush(self):
+        """
+        Salva subito le modifiche in attesa, con una sola scrittura.
+
+        Returns:
+            bool: True se non restano modifiche da salvare
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._has_changes(self._pending):
+                    return True
+                changes = self._in_flight = self._pending
+                self._pending = self._empty_changes()
+
+            # La scrittura avviene senza _lock: le letture non la attendono
+            try:
+                result = self._storage.apply_prescription_changes(
+                    list(changes["inserted"].values()), list(changes["updated"].items()), changes["deleted"]
+                )
+            except Exception as e:
+                logger.error(f"Errore nel salvare le modifiche alle prescrizioni: {str(e)}")
+                result = None
+
+            with self._lock:
+                self._in_flight = None
+                if result is None:
+                    # Rimettiamo in attesa le modifiche, sotto a quelle più recenti
+                    self._merge_back(changes)
+                    self._schedule_flush()
+                    return False
+
+                before, after = result
+                # Se nessun altro ha modificato l'archivio, le voci in memoria
+                # corrispondono già al suo contenuto: non serve ricaricarle
+                if before == self._signature:
+                    self._signature = after
+
+            logger.info(f"Modifiche alle prescrizioni salvate: {len(changes['inserted'])} aggiunte, "
+                        f"{len(changes['updated'])} aggiornate, {len(changes['deleted'])} rimosse")
+            publish(TOPIC_PRESCRIPTIONS, get_changed_keys(
+                changes["inserted"].values(), changes["updated"].items(), changes["deleted"]
+            ))
+            return True
+
+    def _merge_back(self, changes):
+        """Rimette in attesa modifiche non salvate (da chiamare con _lock)."""
+        pending = self._pending
+        for entry_id, prescription in changes["inserted"].items():
+            if entry_id not in pending["deleted"] and entry_id not in pending["inserted"]:
+                # Gli aggiornamenti successivi sono già nella voce
+                pending["updated"].pop(entry_id, None)
+                pending["inserted"][entry_id] = prescription
+        for entry_id, fields in changes["updated"].items():
+            if entry_id in pending["deleted"] or entry_id in pending["inserted"]:
+                continue
+            pending["updated"][entry_id] = dict(fields, **pending["updated"].get(entry_id, {}))
+        for entry_id in changes["deleted"]:
+            if entry_id not in pending["inserted"]:
+                pending["deleted"].add(entry_id)
+
+_repository = None
+_repository_lock = threading.Lock()
+
+def get_repository():
+    """Restituisce il repository delle prescrizioni del processo (creato al primo uso)."""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                repository = PrescriptionRepository()
+                # Le modifiche fatte nel processo senza il repository (es. set_state)
+                # e quelle degli altri processi
+                subscribe(repository.on_change)
+                start_listener(repository.on_change)
+                _repository = repository
+    return _repository
+
+def flush_prescriptions():
+    """Salva le modifiche in attesa (da chiamare prima di terminare il processo)."""
+    if _repository is not None:
+        _repository.flush()
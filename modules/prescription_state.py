@@ -0,0 +1,137 @@
+import time
+import logging
+from datetime import datetime
+
+# Importa costanti e configurazioni dal modulo config
+from config import (
+    logger, STATE_PENDING, STATE_ACTIVE, STATE_BOOKED, STATE_EXPIRED,
+    STATE_INVALID, STATE_PAUSED, MAX_CONSECUTIVE_FAILURES
+)
+from modules.data_utils import update_prescription_fields
+from modules.failure_tracking import compute_backoff
+from modules.prescription_repository import get_repository
+
+# Stati per cui la prescrizione viene controllata dal monitoraggio
+MONITORED_STATES = (STATE_PENDING, STATE_ACTIVE)
+
+# Etichette da mostrare nel bot
+STATE_LABELS = {
+    STATE_PENDING: "⏳ in verifica",
+    STATE_ACTIVE: "🟢 attiva",
+    STATE_BOOKED: "✅ prenotata",
+    STATE_EXPIRED: "⌛ scaduta",
+    STATE_INVALID: "⛔ non valida",
+    STATE_PAUSED: "⏸ sospesa"
+}
+
+def get_state(prescription):
+    """Restituisce lo stato della prescrizione (le voci senza stato sono attive)."""
+    return prescription.get("state", STATE_ACTIVE)
+
+def get_state_label(prescription):
+    """Restituisce l'etichetta leggibile dello stato della prescrizione."""
+    state = get_state(prescription)
+    return STATE_LABELS.get(state, state)
+
+def is_monitored(prescription):
+    """Verifica se la prescrizione deve essere controllata dal monitoraggio."""
+    return get_state(prescription) in MONITORED_STATES
+
+# Stati scelti dall'utente di una chat (sospensione, prenotazione): valgono
+# solo per la sua voce e non vengono modificati dagli esiti dei controlli
+USER_STATES = (STATE_PAUSED, STATE_BOOKED)
+
+def _state_fields(prescription, state, reason):
+    """I campi da salvare per il nuovo stato (registrando il cambiamento)."""
+    previous_state = get_state(prescription)
+    fields = {
+        "state": state,
+        "state_reason": reason,
+        "failure_count": 0,
+        "permanent_failures": 0,
+        "retry_after": None
+    }
+    if previous_state != state:
+        fields["state_changed_at"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        logger.info(f"Prescrizione {prescription['fiscal_code']}_{prescription['nre']}: "
+                    f"stato {previous_state} -> {state}" + (f" ({reason})" if reason else ""))
+    return fields
+
+def set_state(prescription, state, reason=None):
+    """
+    Imposta lo stato deciso dal servizio (attiva, non valida, scaduta...) e lo salva.
+
+    Lo stato viene applicato a tutte le voci con lo stesso codice fiscale e NRE,
+    perché dipende dalla prescrizione e non dalla chat che la monitora; le voci
+    sospese o prenotate da una chat (USER_STATES) restano come sono.
+    """
+    fields = _state_fields(prescription, state, reason)
+    prescription.update(fields)
+    update_prescription_fields(prescription["fiscal_code"], prescription["nre"], fields, skip_states=USER_STATES)
+
+def set_entry_state(prescription, state, reason=None, extra_fields=None):
+    """
+    Imposta lo stato scelto dall'utente (sospesa, prenotata, riattivata, disdetta) sulla sola voce della sua chat.
+
+    Args:
+        prescription: La voce della chat
+        extra_fields: Altri campi da salvare insieme allo stato (es. le prenotazioni)
+    """
+    fields = _state_fields(prescription, state, reason)
+    fields.update(extra_fields or {})
+    if not get_repository().update(prescription, fields):
+        logger.warning(f"Voce {prescription['fiscal_code']}_{prescription['nre']} non trovata: stato non salvato")
+    prescription.update(fields)
+
+def record_success(prescription):
+    """Registra un controllo riuscito: la prescrizione diventa (o resta) attiva."""
+    if get_state(prescription) != STATE_ACTIVE or prescription.get("failure_count"):
+        set_state(prescription, STATE_ACTIVE)
+
+def record_failure(prescription, failed_state, reason, permanent=True):
+    """
+    Registra un controllo fallito e pianifica il nuovo tentativo con backoff esponenziale.
+
+    Solo i fallimenti permanenti cambiano lo stato: una prescrizione in verifica
+    passa subito allo stato indicato, mentre una prescrizione attiva ci passa solo
+    dopo MAX_CONSECUTIVE_FAILURES fallimenti permanenti consecutivi, per non
+    scartarla a causa di un errore occasionale.
+
+    Args:
+        prescription: La prescrizione controllata
+        failed_state: Lo stato da assegnare se il fallimento è definitivo
+        reason: Il messaggio di errore
+        permanent: True se il servizio ha rifiutato la richiesta, False se l'errore è transitorio
+
+    Returns:
+        int: Il numero di fallimenti permanenti consecutivi
+    """
+    failure_count = prescription.get("failure_count", 0) + 1
+    permanent_failures = prescription.get("permanent_failures", 0) + (1 if permanent else 0)
+
+    if permanent and (get_state(prescription) == STATE_PENDING or
+                      permanent_failures >= MAX_CONSECUTIVE_FAILURES):
+        set_state(prescription, failed_state, reason)
+        return permanent_failures
+
+    fields = {
+        "failure_count": failure_count,
+        "permanent_failures": permanent_failures,
+        "retry_after": time.time() + compute_backoff(failure_count)
+    }
+    prescription.update(fields)
+    update_prescription_fields(prescription["fiscal_code"], prescription["nre"], fields, skip_states=USER_STATES)
+    return permanent_failures
+
+def get_retry_delay(prescription, now=None):
+    """Restituisce i secondi di attesa prima del prossimo tentativo (0 se nessun backoff)."""
+    retry_after = prescription.get("retry_after")
+    if not retry_after:
+        return 0
+    if now is None:
+        now = time.time()
+    return max(retry_after - now, 0)
+
+def get_unavailable_state(prescription):
+    """Stato da assegnare quando le disponibilità non sono più ottenibili."""
+    return STATE_BOOKED if prescription.get("bookings") else STATE_EXPIRED
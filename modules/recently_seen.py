@@ -0,0 +1,80 @@
+import time
+import logging
+from collections import OrderedDict
+
+# Importa costanti e configurazioni dal modulo config
+from config import RECENTLY_SEEN_TTL, RECENTLY_SEEN_MAX_SLOTS
+
+# Disponibilità viste di recente per ogni prescrizione: chiave -> RecentlySeen.
+# Le prescrizioni non più monitorate vengono eliminate con drop.
+_recent = {}
+
+class RecentlySeen:
+    """
+    Insieme limitato delle disponibilità viste di recente, con scadenza.
+
+    Le voci sono in ordine di ultima visione (LRU): quelle scadute o in
+    eccesso rispetto a max_size vengono eliminate dall'inizio.
+    """
+    __slots__ = ("ttl", "max_size", "_entries")
+
+    def __init__(self, ttl=RECENTLY_SEEN_TTL, max_size=RECENTLY_SEEN_MAX_SLOTS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def touch(self, slots, now=None):
+        """Segna come viste adesso le disponibilità indicate."""
+        if now is None:
+            now = time.time()
+        entries = self._entries
+        for slot in slots:
+            key = (slot.hospital_id, slot.epoch)
+            if key in entries:
+                entries.move_to_end(key)
+            entries[key] = now
+        self.expire(now)
+
+    def expire(self, now=None):
+        """Elimina le voci scadute e quelle oltre max_size."""
+        if now is None:
+            now = time.time()
+        entries = self._entries
+        while entries and (len(entries) > self.max_size or now - next(iter(entries.values())) > self.ttl):
+            entries.popitem(last=False)
+
+    def seen_within(self, slot, window, now=None):
+        """Verifica se la disponibilità è stata vista negli ultimi window secondi."""
+        seen_at = self._entries.get((slot.hospital_id, slot.epoch))
+        if seen_at is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - seen_at <= window
+
+    def __len__(self):
+        return len(self._entries)
+
+def get_recently_seen(prescription_key):
+    """Restituisce (creandolo se serve) l'insieme delle disponibilità viste per una prescrizione."""
+    recent = _recent.get(prescription_key)
+    if recent is None:
+        recent = _recent.setdefault(prescription_key, RecentlySeen())
+    return recent
+
+def drop(prescription_key):
+    """Elimina le disponibilità viste di una prescrizione non più monitorata."""
+    _recent.pop(prescription_key, None)
+
+def drop_recently_seen(slots, recently_seen, window, now=None):
+    """
+    Esclude le disponibilità viste negli ultimi window secondi.
+
+    Returns:
+        list: Le disponibilità non viste di recente (tutte se recently_seen è None)
+    """
+    if recently_seen is None or not window:
+        return slots
+    if now is None:
+        now = time.time()
+    return [slot for slot in slots if not recently_seen.seen_within(slot, window, now)]
@@ -0,0 +1,174 @@
+import logging
+from datetime import datetime, date, time, timedelta
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, POLLING_SCHEDULE, MONITORING_INTERVAL
+
+def get_schedule(prescription=None):
+    """
+    Restituisce la pianificazione del polling per una prescrizione.
+
+    La configurazione globale viene sovrascritta dalle chiavi presenti
+    in config["schedule"] della prescrizione.
+    """
+    schedule = dict(POLLING_SCHEDULE)
+    if prescription:
+        override = prescription.get("config", {}).get("schedule")
+        if override:
+            schedule.update(override)
+    return schedule
+
+def easter_sunday(year):
+    """Calcola la data di Pasqua (algoritmo gregoriano anonimo)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month = (h + l - 7 * m + 114) // 31
+    day = ((h + l - 7 * m + 114) % 31) + 1
+    return date(year, month, day)
+
+def is_holiday(day, schedule):
+    """Verifica se un giorno è festivo secondo la pianificazione."""
+    if day.strftime("%m-%d") in schedule.get("holidays", []):
+        return True
+    if schedule.get("easter_monday", False):
+        return day == easter_sunday(day.year) + timedelta(days=1)
+    return False
+
+def _parse_time(value):
+    """Converte una stringa "HH:MM" in un oggetto time."""
+    hours, minutes = value.split(":")
+    return time(int(hours), int(minutes))
+
+def _parse_end(value):
+    """Converte la fine di una finestra: None (o "24:00") indica la fine della giornata."""
+    if value is None or value == "24:00":
+        return None
+    return _parse_time(value)
+
+def is_within_active_window(schedule, now=None):
+    """
+    Verifica se l'istante indicato ricade in una finestra di attività.
+
+    Args:
+        schedule: La pianificazione (vedi get_schedule)
+        now: L'istante da verificare. Se None, usa l'ora corrente
+
+    Returns:
+        bool: True se il monitoraggio è attivo, False altrimenti
+    """
+    if now is None:
+        now = datetime.now()
+
+    windows = schedule.get("windows")
+    if not windows:
+        return True  # Nessuna finestra configurata: sempre attivo
+
+    try:
+        if is_holiday(now.date(), schedule):
+            return False
+
+        current = now.time()
+        for window in windows:
+            start = _parse_time(window.get("start", "00:00"))
+            end = _parse_end(window.get("end"))
+
+            if end is None or start <= end:
+                # Finestra nella stessa giornata (fino a mezzanotte inclusa se end è None)
+                in_hours = start <= current and (end is None or current < end)
+                if now.weekday() in window.get("days", range(7)) and in_hours:
+                    return True
+            else:
+                # Finestra a cavallo della mezzanotte: la parte dopo mezzanotte
+                # appartiene al giorno in cui la finestra è iniziata
+                if now.weekday() in window.get("days", range(7)) and current >= start:
+                    return True
+                yesterday = (now - timedelta(days=1)).weekday()
+                if yesterday in window.get("days", range(7)) and current < end:
+                    return True
+        return False
+    except Exception as e:
+        logger.warning(f"Errore nella verifica della finestra di attività: {str(e)}")
+        return True  # In caso di errore, non sospendiamo il monitoraggio
+
+def seconds_until_next_window(schedule, now=None, horizon_days=8):
+    """
+    Calcola i secondi mancanti all'apertura della prossima finestra di attività.
+
+    Returns:
+        float: 0 se siamo già in una finestra, None se nessuna finestra
+               si apre entro horizon_days giorni
+    """
+    if now is None:
+        now = datetime.now()
+
+    if is_within_active_window(schedule, now):
+        return 0
+
+    # Candidati: gli orari di inizio di ogni finestra nei prossimi giorni
+    candidates = []
+    for offset in range(horizon_days):
+        day = now.date() + timedelta(days=offset)
+        if is_holiday(day, schedule):
+            continue
+        for window in schedule.get("windows", []):
+            if day.weekday() not in window.get("days", range(7)):
+                continue
+            start = datetime.combine(day, _parse_time(window.get("start", "00:00")))
+            if start > now:
+                candidates.append(start)
+        if candidates:
+            break
+
+    if not candidates:
+        return None
+    return (min(candidates) - now).total_seconds()
+
+def get_poll_delay(schedule, last_poll, was_active, now=None):
+    """
+    Calcola tra quanti secondi una prescrizione deve essere controllata.
+
+    Args:
+        schedule: La pianificazione della prescrizione
+        last_poll: Timestamp dell'ultimo controllo (None se mai controllata)
+        was_active: Stato della finestra al controllo precedente
+        now: L'istante corrente. Se None, usa l'ora corrente
+
+    Returns:
+        tuple: (secondi di attesa, None se mai dovuta; finestra attiva)
+    """
+    if now is None:
+        now = datetime.now()
+
+    active = is_within_active_window(schedule, now)
+    timestamp = now.timestamp()
+
+    if last_poll is None:
+        return 0, active
+
+    elapsed = timestamp - last_poll
+
+    if active:
+        # Controllo immediato di recupero all'apertura della finestra
+        if not was_active:
+            return 0, active
+        return max(MONITORING_INTERVAL - elapsed, 0), active
+
+    # Fuori finestra: polling ridotto (se configurato) o attesa dell'apertura
+    delays = []
+    off_hours_interval = schedule.get("off_hours_interval")
+    if off_hours_interval:
+        delays.append(max(off_hours_interval - elapsed, 0))
+    next_window = seconds_until_next_window(schedule, now)
+    if next_window is not None:
+        delays.append(next_window)
+
+    if not delays:
+        return None, active
+    return min(delays), active
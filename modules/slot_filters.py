@@ -0,0 +1,136 @@
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger
+from modules.slots import slot_from_api
+from modules.time_utils import get_range_bounds
+from modules.geo import make_distance_fn
+
+# Filtri disponibili nella configurazione di una prescrizione:
+# - months_limit: solo appuntamenti entro X mesi (da 30 giorni)
+# - weekdays: giorni della settimana ammessi (0 = lunedì)
+# - time_ranges: fasce orarie ammesse, es. [["08:00", "13:00"], ["15:00", "18:00"]]
+# - max_price: prezzo massimo in euro
+# - include_hospitals / exclude_hospitals: id o parti del nome degli ospedali
+# - max_distance_km: distanza massima della sede dal domicilio (o dalla
+#   residenza, vedi config["distance_from"]) del paziente
+
+def _parse_minutes(value):
+    """Converte "HH:MM" in minuti dalla mezzanotte."""
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def _to_number(value):
+    """Converte un prezzo o una distanza in numero (None se non è un numero)."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _hospital_matcher(terms):
+    """
+    Restituisce una funzione che verifica se un ospedale corrisponde a uno dei termini.
+
+    Un termine corrisponde all'id dell'ospedale o a una parte del suo nome
+    (senza distinzione tra maiuscole e minuscole). Il risultato viene
+    memorizzato per ospedale, così il nome viene letto una sola volta.
+    """
+    terms = [str(term).strip().lower() for term in terms if str(term).strip()]
+    cache = {}
+
+    def matches(slot):
+        result = cache.get(slot.hospital_id)
+        if result is None:
+            hospital_id = str(slot.hospital_id).lower()
+            name = slot.hospital_name.lower()
+            result = cache[slot.hospital_id] = any(term == hospital_id or term in name for term in terms)
+        return result
+
+    return matches
+
+def compile_slot_filter(config, now=None, origin=None):
+    """
+    Compila i filtri della configurazione in un'unica funzione.
+
+    I valori che non dipendono dalla disponibilità (intervallo di date, fasce
+    orarie, insiemi di giorni) vengono calcolati qui una sola volta.
+
+    Args:
+        config: La configurazione della prescrizione
+        now: L'istante di riferimento per months_limit (default: adesso)
+        origin: Le coordinate del paziente per max_distance_km (vedi
+            modules.geo.get_patient_origin); senza, il filtro viene ignorato
+
+    Returns:
+        function: Riceve una lista di Slot e restituisce quelli che superano
+        tutti i filtri, in un solo passaggio
+    """
+    config = config or {}
+    predicates = []
+
+    bounds = get_range_bounds(config.get("months_limit"), now)
+    if bounds is not None:
+        start, end = bounds
+        predicates.append(lambda slot: start <= slot.epoch <= end)
+
+    try:
+        weekdays = config.get("weekdays")
+        if weekdays:
+            allowed_days = frozenset(int(day) for day in weekdays)
+            # Il 1° gennaio 1970 era un giovedì (3)
+            predicates.append(lambda slot: (slot.epoch // 86400 + 3) % 7 in allowed_days)
+
+        time_ranges = config.get("time_ranges")
+        if time_ranges:
+            ranges = [(_parse_minutes(start), _parse_minutes(end)) for start, end in time_ranges]
+            predicates.append(lambda slot: any(
+                start <= (slot.epoch % 86400) // 60 <= end for start, end in ranges
+            ))
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Filtri su giorni o orari non validi, ignorati: {str(e)}")
+
+    max_price = _to_number(config.get("max_price"))
+    if max_price is not None:
+        # Le disponibilità senza prezzo numerico non vengono scartate
+        predicates.append(lambda slot: (_to_number(slot.price) or 0) <= max_price)
+
+    if config.get("include_hospitals"):
+        predicates.append(_hospital_matcher(config["include_hospitals"]))
+
+    if config.get("exclude_hospitals"):
+        excluded = _hospital_matcher(config["exclude_hospitals"])
+        predicates.append(lambda slot: not excluded(slot))
+
+    max_distance = _to_number(config.get("max_distance_km"))
+    distance = make_distance_fn(origin) if max_distance is not None else None
+    if distance is not None:
+        # Le sedi non localizzate non vengono scartate
+        predicates.append(lambda slot: (distance(slot) or 0) <= max_distance)
+
+    if not predicates:
+        return list
+
+    if len(predicates) == 1:
+        predicate = predicates[0]
+        return lambda slots: [slot for slot in slots if predicate(slot)]
+
+    return lambda slots: [slot for slot in slots if all(predicate(slot) for predicate in predicates)]
+
+def filter_availabilities(availabilities, config, now=None, origin=None):
+    """
+    Applica i filtri della prescrizione alle disponibilità complete del servizio.
+
+    Usato dove servono i dati originali (ad esempio per prenotare).
+
+    Returns:
+        list: Le disponibilità che superano i filtri, nell'ordine originale
+    """
+    slot_filter = compile_slot_filter(config, now, origin)
+    pairs = []
+    for availability in availabilities:
+        slot = slot_from_api(availability)
+        if slot is not None:
+            pairs.append((slot, availability))
+
+    kept = {id(slot) for slot in slot_filter([slot for slot, _ in pairs])}
+    return [availability for slot, availability in pairs if id(slot) in kept]
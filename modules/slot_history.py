@@ -0,0 +1,262 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import argparse
+import threading
+import logging
+from datetime import datetime
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, HISTORY_DIR, HISTORY_CHUNK_ROWS, HISTORY_FLUSH_INTERVAL
+from modules.data_utils import file_lock, write_file_atomic, read_json_file
+from modules.time_utils import to_epoch, format_iso
+
+# Storico append-only delle disponibilità osservate. Ogni riga è un intervallo
+# di osservazione di una disponibilità, chiuso quando la disponibilità
+# scompare: (prescrizione, ospedale, sede, orario, prezzo, prima e ultima
+# osservazione). Gli orari usano la stessa convenzione degli Slot (vedi
+# modules.time_utils), quindi l'anticipo è semplicemente orario - prima osservazione.
+#
+# Le righe vengono scritte a blocchi in HISTORY_DIR, un file gzip per blocco
+# con i valori organizzati per colonna. L'indice (index.json) riporta per ogni
+# blocco l'intervallo di tempo e le prescrizioni contenute, così le ricerche
+# leggono solo i blocchi che servono, uno alla volta.
+COLUMNS = ("prescription", "hospital_id", "site_id", "slot_epoch", "price", "first_seen", "last_seen")
+CHUNK_VERSION = 1
+INDEX_FILE = os.path.join(HISTORY_DIR, "index.json")
+
+# Disponibilità ancora presenti: chiave prescrizione -> {(ospedale, orario): [prima, ultima, sede, prezzo]}
+_open = {}
+# Righe chiuse non ancora scritte, per colonna
+_buffer = {column: [] for column in COLUMNS}
+_buffer_since = None
+_lock = threading.Lock()
+
+def _now():
+    return to_epoch(datetime.now())
+
+def _close(prescription_key, key, entry):
+    """Sposta un intervallo chiuso nel buffer (da chiamare con _lock)."""
+    global _buffer_since
+    first_seen, last_seen, site_id, price = entry
+    hospital_id, slot_epoch = key
+    for column, value in zip(COLUMNS, (prescription_key, hospital_id, site_id, slot_epoch, price,
+                                       first_seen, last_seen)):
+        _buffer[column].append(value)
+    if _buffer_since is None:
+        _buffer_since = time.time()
+
+def record_observations(prescription_key, slots, now=None):
+    """
+    Registra le disponibilità osservate in un controllo di una prescrizione.
+
+    Le disponibilità nuove aprono un intervallo, quelle ancora presenti ne
+    aggiornano l'ultima osservazione e quelle scomparse (o con il prezzo
+    cambiato) lo chiudono, aggiungendolo allo storico.
+
+    Args:
+        prescription_key: La chiave della prescrizione (codice fiscale_NRE)
+        slots: Tutte le disponibilità attuali (lista di Slot)
+        now: L'istante dell'osservazione (default: adesso)
+    """
+    if now is None:
+        now = _now()
+    with _lock:
+        observed = _open.setdefault(prescription_key, {})
+        current = set()
+        for slot in slots:
+            key = (slot.hospital_id, slot.epoch)
+            current.add(key)
+            entry = observed.get(key)
+            if entry is not None and entry[3] != slot.price:
+                _close(prescription_key, key, entry)
+                entry = None
+            if entry is None:
+                observed[key] = [now, now, slot.site_id, slot.price]
+            else:
+                entry[1] = now
+
+        for key in [key for key in observed if key not in current]:
+            _close(prescription_key, key, observed.pop(key))
+
+def close_observations(prescription_key):
+    """Chiude gli intervalli di una prescrizione non più monitorata."""
+    with _lock:
+        for key, entry in _open.pop(prescription_key, {}).items():
+            _close(prescription_key, key, entry)
+
+def close_all_observations():
+    """Chiude gli intervalli di tutte le prescrizioni (alla chiusura del monitoraggio)."""
+    with _lock:
+        for prescription_key, observed in _open.items():
+            for key, entry in observed.items():
+                _close(prescription_key, key, entry)
+        _open.clear()
+
+def _read_index(strict=False):
+    """
+    Legge l'indice dei blocchi (vuoto se non esiste).
+
+    Args:
+        strict: Solleva l'eccezione se l'indice non è leggibile, invece di restituirlo vuoto
+    """
+    try:
+        return read_json_file(INDEX_FILE, {"chunks": []})
+    except Exception as e:
+        if strict:
+            raise
+        logger.error(f"Errore nel leggere l'indice dello storico: {str(e)}")
+        return {"chunks": []}
+
+def _write_chunk(columns):
+    """Scrive un blocco e lo aggiunge all'indice."""
+    prescriptions = sorted(set(columns["prescription"]))
+    positions = {key: i for i, key in enumerate(prescriptions)}
+    chunk = {
+        "v": CHUNK_VERSION,
+        "prescriptions": prescriptions,
+        # Le prescrizioni sono salvate come indice nella lista precedente
+        "columns": dict(columns, prescription=[positions[key] for key in columns["prescription"]])
+    }
+
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with file_lock(INDEX_FILE):
+        # Con un indice vuoto i blocchi esistenti verrebbero sovrascritti
+        index = _read_index(strict=True)
+        chunk_id = max((entry["id"] for entry in index["chunks"]), default=0) + 1
+        file_name = f"chunk-{chunk_id:06d}.json.gz"
+        path = os.path.join(HISTORY_DIR, file_name)
+        content = json.dumps(chunk, separators=(",", ":")).encode()
+        write_file_atomic(path, lambda f: f.write(gzip.compress(content)), mode='wb', backup=False)
+
+        index["chunks"].append({
+            "id": chunk_id,
+            "file": file_name,
+            "rows": len(columns["prescription"]),
+            "start": min(columns["first_seen"]),
+            "end": max(columns["last_seen"]),
+            "prescriptions": prescriptions
+        })
+        write_file_atomic(INDEX_FILE, lambda f: json.dump(index, f))
+    return file_name
+
+def flush_history(force=False):
+    """
+    Scrive le righe in attesa in un nuovo blocco, se sono abbastanza o da abbastanza tempo.
+
+    Args:
+        force: Scrive il blocco anche se piccolo
+
+    Returns:
+        int: Il numero di righe scritte
+    """
+    global _buffer, _buffer_since
+    with _lock:
+        rows = len(_buffer["prescription"])
+        if not rows:
+            return 0
+        if not force and rows < HISTORY_CHUNK_ROWS and time.time() - _buffer_since < HISTORY_FLUSH_INTERVAL:
+            return 0
+        columns = _buffer
+        _buffer = {column: [] for column in COLUMNS}
+        _buffer_since = None
+
+    try:
+        file_name = _write_chunk(columns)
+        logger.info(f"Storico delle disponibilità: scritte {rows} righe in {file_name}")
+        return rows
+    except Exception as e:
+        logger.error(f"Errore nello scrivere lo storico delle disponibilità: {str(e)}")
+        # Rimettiamo le righe nel buffer per riprovare al prossimo ciclo
+        with _lock:
+            for column in COLUMNS:
+                _buffer[column][:0] = columns[column]
+            if _buffer_since is None:
+                _buffer_since = time.time()
+        return 0
+
+def _read_chunk(file_name):
+    """Legge le colonne di un blocco, con le chiavi delle prescrizioni."""
+    with gzip.open(os.path.join(HISTORY_DIR, file_name), 'rt') as f:
+        chunk = json.load(f)
+    columns = chunk["columns"]
+    prescriptions = chunk["prescriptions"]
+    columns["prescription"] = [prescriptions[i] for i in columns["prescription"]]
+    return columns
+
+def query_history(prescription_key=None, start=None, end=None):
+    """
+    Restituisce le righe dello storico già scritte su disco, un blocco alla volta.
+
+    Args:
+        prescription_key: Solo le righe di questa prescrizione (None = tutte)
+        start: Solo gli intervalli osservati dopo questo istante (secondi dall'epoca)
+        end: Solo gli intervalli osservati prima di questo istante
+
+    Yields:
+        dict: Una riga, con le chiavi di COLUMNS
+    """
+    for entry in _read_index()["chunks"]:
+        if prescription_key is not None and prescription_key not in entry["prescriptions"]:
+            continue
+        if (start is not None and entry["end"] < start) or (end is not None and entry["start"] > end):
+            continue
+
+        try:
+            columns = _read_chunk(entry["file"])
+        except Exception as e:
+            logger.error(f"Errore nel leggere il blocco {entry['file']} dello storico: {str(e)}")
+            continue
+
+        for values in zip(*(columns[column] for column in COLUMNS)):
+            row = dict(zip(COLUMNS, values))
+            if prescription_key is not None and row["prescription"] != prescription_key:
+                continue
+            if (start is not None and row["last_seen"] < start) or (end is not None and row["first_seen"] > end):
+                continue
+            yield row
+
+def export_csv(output, prescription_key=None, start=None, end=None):
+    """
+    Esporta lo storico in CSV riga per riga, senza caricarlo tutto in memoria.
+
+    Gli orari sono nel formato del servizio; lead_days è l'anticipo, in
+    giorni, tra la prima osservazione e l'appuntamento.
+
+    Returns:
+        int: Il numero di righe esportate
+    """
+    writer = csv.writer(output)
+    writer.writerow(["prescription", "hospital_id", "site_id", "slot_date", "price",
+                     "first_seen", "last_seen", "lead_days"])
+    count = 0
+    for row in query_history(prescription_key, start, end):
+        writer.writerow([
+            row["prescription"], row["hospital_id"], row["site_id"], format_iso(row["slot_epoch"]),
+            row["price"], format_iso(row["first_seen"]), format_iso(row["last_seen"]),
+            round((row["slot_epoch"] - row["first_seen"]) / 86400, 2)
+        ])
+        count += 1
+    return count
+
+def _parse_day(value):
+    return to_epoch(datetime.strptime(value, "%Y-%m-%d"))
+
+if __name__ == "__main__":
+    # Esempio: python -m modules.slot_history --prescription CF_NRE --start 2026-01-01 > storico.csv
+    parser = argparse.ArgumentParser(description="Esporta lo storico delle disponibilità in CSV")
+    parser.add_argument("--prescription", help="Chiave della prescrizione (codice fiscale_NRE)")
+    parser.add_argument("--start", type=_parse_day, help="Data iniziale (YYYY-MM-DD)")
+    parser.add_argument("--end", type=_parse_day, help="Data finale (YYYY-MM-DD)")
+    parser.add_argument("--output", help="File CSV di destinazione (default: standard output)")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            exported = export_csv(f, args.prescription, args.start, args.end)
+    else:
+        exported = export_csv(sys.stdout, args.prescription, args.start, args.end)
+    logger.info(f"Esportate {exported} righe dello storico")
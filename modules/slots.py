@@ -0,0 +1,169 @@
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger
+from modules.hospital_registry import register, get_hospital_name, get_site_address
+from modules.time_utils import parse_epoch, format_iso
+
+# Versione del formato compatto salvato in previous_data
+# (1: tabella delle sedi per prescrizione, 2: sedi nel registro condiviso)
+STORAGE_VERSION = 2
+
+class Slot:
+    """
+    Una disponibilità, con i soli campi usati dal monitoraggio.
+
+    Nome dell'ospedale e indirizzo della sede non sono copiati in ogni
+    disponibilità: vengono letti dal registro condiviso (modules.hospital_registry).
+    """
+    __slots__ = ("epoch", "hospital_id", "site_id", "diary_id", "price")
+
+    def __init__(self, epoch, hospital_id, site_id, diary_id, price):
+        self.epoch = epoch
+        self.hospital_id = hospital_id
+        self.site_id = site_id
+        self.diary_id = diary_id
+        self.price = price
+
+    @property
+    def hospital_name(self):
+        """Il nome dell'ospedale, dal registro."""
+        return get_hospital_name(self.hospital_id)
+
+    @property
+    def site_address(self):
+        """L'indirizzo della sede, dal registro."""
+        return get_site_address(self.site_id)
+
+    @property
+    def date(self):
+        """La data nel formato del servizio."""
+        return format_iso(self.epoch)
+
+    def _key(self):
+        return (self.epoch, self.hospital_id, self.site_id, self.diary_id, self.price)
+
+    def __eq__(self, other):
+        return isinstance(other, Slot) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"Slot({self.date}, {self.hospital_name!r}, {self.price})"
+
+def slot_from_api(availability):
+    """
+    Converte una disponibilità restituita dal servizio, registrandone ospedale e sede.
+
+    Returns:
+        Slot: La disponibilità compatta, None se la data non è valida
+    """
+    epoch = parse_epoch(availability.get('date'))
+    if epoch is None:
+        logger.warning(f"Disponibilità ignorata, data non valida: {availability.get('date')}")
+        return None
+
+    hospital = availability.get('hospital') or {}
+    site = availability.get('site') or {}
+    hospital_id = hospital.get('id', 'unknown')
+    site_id = register(hospital_id, hospital.get('name'), site.get('id'), site.get('address'))
+    return Slot(
+        epoch,
+        hospital_id,
+        site_id,
+        (availability.get('diary') or {}).get('id'),
+        availability.get('price')
+    )
+
+def slots_from_api(availabilities):
+    """Converte le disponibilità del servizio in Slot, ignorando quelle non valide."""
+    slots = []
+    for availability in availabilities:
+        slot = slot_from_api(availability)
+        if slot is not None:
+            slots.append(slot)
+    return slots
+
+def encode_slots(slots):
+    """
+    Converte una lista di Slot nel formato compatto da salvare su file.
+
+    Ogni disponibilità è [epoch, id ospedale, id sede, id agenda, prezzo];
+    nomi e indirizzi sono salvati una sola volta nel registro degli ospedali.
+    """
+    rows = [[slot.epoch, slot.hospital_id, slot.site_id, slot.diary_id, slot.price] for slot in slots]
+    return {"v": STORAGE_VERSION, "slots": rows}
+
+def decode_slots(value):
+    """
+    Converte i dati salvati in una lista di Slot.
+
+    Accetta anche i formati precedenti: la lista delle disponibilità complete
+    restituite dal servizio e il formato compatto con la tabella delle sedi
+    (versione 1); in entrambi i casi ospedali e sedi vengono registrati.
+    """
+    if not value:
+        return []
+    if isinstance(value, list):
+        return slots_from_api(value)
+
+    if value.get("v", 1) == 1:
+        site_ids = [register(hospital_id, name, None, address) for hospital_id, name, address in value["sites"]]
+        return [
+            Slot(epoch, value["sites"][index][0], site_ids[index], diary_id, price)
+            for epoch, index, diary_id, price in value["slots"]
+        ]
+
+    return [Slot(*row) for row in value["slots"]]
+
+def is_legacy_format(value):
+    """Verifica se i dati salvati sono in un formato precedente."""
+    if isinstance(value, list):
+        return len(value) > 0
+    return value.get("v", 1) != STORAGE_VERSION
+
+def keep_earliest(items, limit, epoch=lambda slot: slot.epoch):
+    """
+    Conserva solo le `limit` disponibilità più vicine, nell'ordine originale.
+
+    Args:
+        items: Le disponibilità (Slot, o righe del formato compatto con epoch)
+        limit: Il numero massimo di disponibilità (None = tutte)
+        epoch: Funzione che restituisce l'orario di una disponibilità
+
+    Returns:
+        list: Le disponibilità conservate (la lista stessa se sono già entro il limite)
+    """
+    if limit is None or len(items) <= limit:
+        return items
+    kept = sorted(range(len(items)), key=lambda index: epoch(items[index]))[:limit]
+    return [items[index] for index in sorted(kept)]
+
+def snapshot_horizon(slots, limit):
+    """
+    L'ultimo orario coperto da uno snapshot ridotto a `limit` disponibilità.
+
+    Uno snapshot salvato con esattamente `limit` disponibilità può essere
+    stato ridotto; quelli in memoria contengono tutte le disponibilità lette.
+
+    Returns:
+        int: L'epoch dell'ultima disponibilità conservata, None se lo snapshot
+            non è stato ridotto (copre tutte le disponibilità)
+    """
+    if limit is None or len(slots) != limit:
+        return None
+    return max(slot.epoch for slot in slots)
+
+def trim_encoded_slots(value, limit):
+    """
+    Riduce i dati salvati (nel formato compatto) alle `limit` disponibilità più vicine.
+
+    Returns:
+        dict: I dati ridotti, None se sono già entro il limite
+    """
+    rows = value.get("slots") or []
+    kept = keep_earliest(rows, limit, epoch=lambda row: row[0])
+    if kept is rows:
+        return None
+    return dict(value, slots=kept)
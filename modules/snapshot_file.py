@@ -0,0 +1,137 @@
+import sys
+import json
+import mmap
+import struct
+import argparse
+import logging
+
+# Formato binario dello snapshot dei dati precedenti (PREVIOUS_DATA_FORMAT = "binary").
+#
+#   intestazione  MAGIC, versione (uint16), numero di chiavi (uint32)
+#   indice        per ogni chiave: lunghezza (uint16), chiave UTF-8,
+#                 posizione (uint64) e lunghezza (uint32) del valore
+#   valori        ogni valore in JSON compatto (vedi modules.slots.encode_slots)
+#
+# Il file viene letto con mmap: si legge solo l'indice e poi, per ogni chiave
+# richiesta, solo il suo valore, senza decodificare le altre prescrizioni.
+MAGIC = b"RCSN"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+KEY_LENGTH = struct.Struct("<H")
+LOCATION = struct.Struct("<QI")
+
+def pack_snapshot(data):
+    """
+    Converte i dati precedenti (chiave -> valore già codificato) nel formato binario.
+
+    Returns:
+        bytes: Il contenuto del file
+    """
+    keys = sorted(data)
+    encoded_keys = [key.encode("utf-8") for key in keys]
+    values = [json.dumps(data[key], separators=(",", ":")).encode("utf-8") for key in keys]
+
+    offset = HEADER.size + sum(KEY_LENGTH.size + len(key) + LOCATION.size for key in encoded_keys)
+    parts = [HEADER.pack(MAGIC, VERSION, len(keys))]
+    for key, value in zip(encoded_keys, values):
+        parts.append(KEY_LENGTH.pack(len(key)) + key + LOCATION.pack(offset, len(value)))
+        offset += len(value)
+    parts.extend(values)
+    return b"".join(parts)
+
+class SnapshotReader:
+    """
+    Lettura di uno snapshot binario tramite mmap (da usare con with).
+
+    Solleva ValueError se il file non è uno snapshot valido (es. troncato).
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Un file vuoto non può essere mappato
+            self._file.close()
+            raise ValueError(f"snapshot vuoto: {path}")
+        try:
+            self._index = self._read_index()
+        except struct.error as e:
+            self.close()
+            raise ValueError(f"indice dello snapshot troncato: {str(e)}")
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self):
+        size = len(self._map)
+        if size < HEADER.size:
+            raise ValueError("intestazione dello snapshot troncata")
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("formato dello snapshot non riconosciuto")
+
+        index = {}
+        position = HEADER.size
+        for _ in range(count):
+            (key_length,) = KEY_LENGTH.unpack_from(self._map, position)
+            position += KEY_LENGTH.size
+            key = self._map[position:position + key_length].decode("utf-8")
+            position += key_length
+            offset, length = LOCATION.unpack_from(self._map, position)
+            position += LOCATION.size
+            if offset + length > size:
+                raise ValueError("snapshot troncato")
+            index[key] = (offset, length)
+        return index
+
+    def keys(self):
+        """Le chiavi delle prescrizioni nello snapshot."""
+        return self._index.keys()
+
+    def get(self, key, default=None):
+        """Decodifica il solo valore della chiave indicata."""
+        location = self._index.get(key)
+        if location is None:
+            return default
+        offset, length = location
+        return json.loads(self._map[offset:offset + length])
+
+    def read(self, keys=None):
+        """
+        Decodifica i valori delle chiavi indicate (None = tutte).
+
+        Returns:
+            dict: Chiave -> valore, solo per le chiavi presenti
+        """
+        if keys is None:
+            keys = self._index
+        return {key: self.get(key) for key in keys if key in self._index}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_snapshot(path, keys=None):
+    """Legge (tutti o alcuni) valori di uno snapshot binario."""
+    with SnapshotReader(path) as reader:
+        return reader.read(keys)
+
+def export_json(path, output, keys=None):
+    """Esporta uno snapshot binario in JSON, per il debug."""
+    json.dump(read_snapshot(path, keys), output, indent=2, sort_keys=True)
+    output.write("\n")
+
+if __name__ == "__main__":
+    # Esempio: python -m modules.snapshot_file previous_data.snap --key CF_NRE
+    parser = argparse.ArgumentParser(description="Esporta in JSON uno snapshot binario dei dati precedenti")
+    parser.add_argument("path", help="Il file dello snapshot")
+    parser.add_argument("--key", action="append", help="Solo questa prescrizione (ripetibile)")
+    args = parser.parse_args()
+    export_json(args.path, sys.stdout, args.key)
@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+import logging
+from contextlib import contextmanager
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, SQLITE_FILE, FSYNC_MODE
+from modules.data_utils import convert_legacy_previous_data, prune_stored_previous_data, get_entry_id
+
+# Ogni voce è salvata per intero (JSON) nella colonna data; le colonne
+# fiscal_code, nre e telegram_chat_id ne sono copie indicizzate per le ricerche.
+# Le prenotazioni registrate dal bot sono copiate in bookings, per id.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prescriptions (
+    id INTEGER PRIMARY KEY,
+    fiscal_code TEXT NOT NULL,
+    nre TEXT NOT NULL,
+    telegram_chat_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prescriptions_key ON prescriptions (fiscal_code, nre);
+CREATE INDEX IF NOT EXISTS prescriptions_chat ON prescriptions (telegram_chat_id);
+
+CREATE TABLE IF NOT EXISTS bookings (
+    booking_id TEXT PRIMARY KEY,
+    prescription_id INTEGER NOT NULL REFERENCES prescriptions (id) ON DELETE CASCADE,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookings_prescription ON bookings (prescription_id);
+
+CREATE TABLE IF NOT EXISTS previous_data (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    position INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+class SqliteStorage:
+    """
+    Archivio SQLite in modalità WAL: letture e scritture per chiave.
+
+    Stessi metodi di modules.data_utils.JsonStorage. Ogni thread (e ogni
+    processo) usa una propria connessione; le scritture avvengono in
+    transazioni BEGIN IMMEDIATE, quindi bot e monitoraggio possono
+    modificare l'archivio insieme.
+    """
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """La connessione del thread corrente (ricreata dopo un fork)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # In modalità WAL anche NORMAL è sicuro in caso di crash (si perdono al più
+            # le ultime transazioni); FULL sincronizza su disco ogni transazione
+            connection.execute("PRAGMA synchronous=" + ("FULL" if FSYNC_MODE == "always" else "NORMAL"))
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Transazione in scrittura: annullata se si verifica un errore."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    # --- Utenti autorizzati ---
+
+    def load_users(self):
+        """Restituisce gli utenti autorizzati (None in caso di errore)."""
+        try:
+            rows = self._connection().execute("SELECT user_id FROM users ORDER BY position")
+            return [user_id for (user_id,) in rows]
+        except Exception as e:
+            logger.error(f"Errore nel caricare gli utenti autorizzati: {str(e)}")
+            return None
+
+    def save_users(self, users):
+        """Salva gli utenti autorizzati, nello stesso ordine (il primo è l'amministratore)."""
+        try:
+            with self._transaction() as connection:
+                connection.execute("DELETE FROM users")
+                connection.executemany("INSERT INTO users (position, user_id) VALUES (?, ?)",
+                                       [(position, str(user_id)) for position, user_id in enumerate(users)])
+                self._bump_revision(connection, "users_revision")
+            logger.info("Utenti autorizzati salvati con successo")
+            return True
+        except Exception as e:
+            logger.error(f"Errore nel salvare gli utenti autorizzati: {str(e)}")
+            return False
+
+    def users_signature(self):
+        """La revisione degli utenti autorizzati, incrementata a ogni modifica."""
+        try:
+            return self._revision(self._connection(), "users_revision")
+        except Exception as e:
+            logger.error(f"Errore nel leggere la revisione degli utenti autorizzati: {str(e)}")
+            return None
+
+    # --- Prescrizioni ---
+
+    def _bump_revision(self, connection, name="prescriptions_revision"):
+        """Incrementa una revisione (la firma di prescrizioni o utenti)."""
+        connection.execute(
+            "INSERT INTO meta (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def _insert_prescription(self, connection, prescription):
+        cursor = connection.execute(
+            "INSERT INTO prescriptions (fiscal_code, nre, telegram_chat_id, data) VALUES (?, ?, ?, ?)",
+            (prescription["fiscal_code"], prescription["nre"],
+             self._chat_key(prescription), _dumps(prescription))
+        )
+        self._write_bookings(connection, cursor.lastrowid, prescription)
+
+    def _write_bookings(self, connection, prescription_id, prescription):
+        connection.execute("DELETE FROM bookings WHERE prescription_id = ?", (prescription_id,))
+        connection.executemany(
+            "INSERT OR REPLACE INTO bookings (booking_id, prescription_id, data) VALUES (?, ?, ?)",
+            [(str(booking["booking_id"]), prescription_id, _dumps(booking))
+             for booking in prescription.get("bookings") or [] if booking.get("booking_id") is not None]
+        )
+
+    @staticmethod
+    def _chat_key(prescription):
+        chat_id = prescription.get("telegram_chat_id")
+        return str(chat_id) if chat_id is not None else None
+
+    def load_prescriptions(self):
+        """Restituisce tutte le voci, nell'ordine di inserimento (None in caso di errore)."""
+        try:
+            rows = self._connection().execute("SELECT data FROM prescriptions ORDER BY id")
+            return [json.loads(data) for (data,) in rows]
+        except Exception as e:
+            logger.error(f"Errore nel caricare i dati di input: {str(e)}")
+            return None
+
+    def prescriptions_signature(self):
+        """La revisione delle prescrizioni, incrementata a ogni modifica."""
+        try:
+            return self._revision(self._connection())
+        except Exception as e:
+            logger.error(f"Errore nel leggere la revisione delle prescrizioni: {str(e)}")
+            return None
+
+    def save_prescriptions(self, data):
+        """Sostituisce tutte le voci (True se il salvataggio è riuscito)."""
+        try:
+            with self._transaction() as connection:
+                connection.execute("DELETE FROM bookings")
+                connection.execute("DELETE FROM prescriptions")
+                for prescription in data:
+                    self._insert_prescription(connection, prescription)
+                self._bump_revision(connection)
+            logger.info(f"Dati delle prescrizioni salvati con successo ({len(data)} prescrizioni)")
+            return True
+        except Exception as e:
+            logger.error(f"Errore nel salvare i dati delle prescrizioni: {str(e)}")
+            return False
+
+    def find_prescriptions(self, fiscal_code=None, nre=None, chat_id=None):
+        """Restituisce le voci che corrispondono ai criteri, usando gli indici."""
+        conditions = []
+        params = []
+        for column, value in (("fiscal_code", fiscal_code), ("nre", nre),
+                              ("telegram_chat_id", None if chat_id is None else str(chat_id))):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        query = "SELECT data FROM prescriptions"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        try:
+            rows = self._connection().execute(query + " ORDER BY id", params)
+            return [json.loads(data) for (data,) in rows]
+        except Exception as e:
+            logger.error(f"Errore nel cercare le prescrizioni: {str(e)}")
+            return []
+
+    def update_prescription_fields(self, fiscal_code, nre, fields, skip_states=()):
+        """Aggiorna alcuni campi delle sole voci con lo stesso codice fiscale e NRE (tranne quelle negli stati skip_states)."""
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, data FROM prescriptions WHERE fiscal_code = ? AND nre = ?", (fiscal_code, nre)
+            ).fetchall()
+            updated = False
+            for prescription_id, data in rows:
+                prescription = json.loads(data)
+                if prescription.get("state") in skip_states:
+                    continue
+                changed = {key: value for key, value in fields.items() if prescription.get(key) != value}
+                if not changed:
+                    continue
+                prescription.update(changed)
+                connection.execute("UPDATE prescriptions SET telegram_chat_id = ?, data = ? WHERE id = ?",
+                                   (self._chat_key(prescription), _dumps(prescription), prescription_id))
+                if "bookings" in changed:
+                    self._write_bookings(connection, prescription_id, prescription)
+                updated = True
+            if updated:
+                self._bump_revision(connection)
+        return updated
+
+    def _revision(self, connection, name="prescriptions_revision"):
+        row = connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return ("sqlite", row[0] if row else 0)
+
+    def _find_entry(self, connection, entry_id):
+        """Restituisce (id della riga, voce) della voce indicata, (None, None) se non esiste."""
+        fiscal_code, nre, _ = entry_id
+        rows = connection.execute(
+            "SELECT id, data FROM prescriptions WHERE fiscal_code = ? AND nre = ?", (fiscal_code, nre)
+        ).fetchall()
+        for prescription_id, data in rows:
+            prescription = json.loads(data)
+            if get_entry_id(prescription) == entry_id:
+                return prescription_id, prescription
+        return None, None
+
+    def apply_prescription_changes(self, inserted=(), updated=(), deleted=()):
+        """
+        Applica un gruppo di modifiche per voce (vedi apply_entry_changes) in una sola transazione.
+
+        Returns:
+            tuple: (firma prima delle modifiche, firma dopo le modifiche)
+        """
+        with self._transaction() as connection:
+            before = self._revision(connection)
+            changed = False
+            for prescription in inserted:
+                prescription_id, _ = self._find_entry(connection, get_entry_id(prescription))
+                if prescription_id is not None:
+                    connection.execute("DELETE FROM prescriptions WHERE id = ?", (prescription_id,))
+                self._insert_prescription(connection, prescription)
+                changed = True
+            for entry_id, fields in updated:
+                prescription_id, prescription = self._find_entry(connection, entry_id)
+                if prescription_id is None:
+                    continue
+                prescription.update(fields)
+                connection.execute("UPDATE prescriptions SET telegram_chat_id = ?, data = ? WHERE id = ?",
+                                   (self._chat_key(prescription), _dumps(prescription), prescription_id))
+                if "bookings" in fields:
+                    self._write_bookings(connection, prescription_id, prescription)
+                changed = True
+            for entry_id in deleted:
+                prescription_id, _ = self._find_entry(connection, entry_id)
+                if prescription_id is not None:
+                    connection.execute("DELETE FROM prescriptions WHERE id = ?", (prescription_id,))
+                    changed = True
+            if changed:
+                self._bump_revision(connection)
+            return before, self._revision(connection)
+
+    def find_booking(self, booking_id):
+        """Restituisce (voce, prenotazione) con l'id indicato, (None, None) se non esiste."""
+        try:
+            row = self._connection().execute(
+                "SELECT p.data, b.data FROM bookings b JOIN prescriptions p ON p.id = b.prescription_id "
+                "WHERE b.booking_id = ?", (str(booking_id),)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Errore nel cercare la prenotazione {booking_id}: {str(e)}")
+            return None, None
+        if row is None:
+            return None, None
+        return json.loads(row[0]), json.loads(row[1])
+
+    # --- Dati precedenti ---
+
+    def load_previous_data(self):
+        """Restituisce tutti gli snapshot salvati."""
+        rows = self._connection().execute("SELECT key, value FROM previous_data")
+        return {key: json.loads(value) for key, value in rows}
+
+    def load_previous_entries(self, keys):
+        """Restituisce gli snapshot delle sole chiavi indicate (quelle presenti)."""
+        keys = list(keys)
+        connection = self._connection()
+        data = {}
+        # SQLite limita il numero di parametri di una query
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = connection.execute(
+                f"SELECT key, value FROM previous_data WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            data.update((key, json.loads(value)) for key, value in rows)
+        return data
+
+    def save_previous_data(self, data):
+        """Sostituisce tutti gli snapshot."""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM previous_data")
+            connection.executemany("INSERT INTO previous_data (key, value) VALUES (?, ?)",
+                                   [(key, _dumps(value)) for key, value in data.items()])
+
+    def checkpoint_previous_data(self, key, value=None, deleted=False):
+        """Aggiorna (o elimina) lo snapshot di una sola prescrizione."""
+        with self._transaction() as connection:
+            if deleted:
+                connection.execute("DELETE FROM previous_data WHERE key = ?", (key,))
+            else:
+                connection.execute("INSERT OR REPLACE INTO previous_data (key, value) VALUES (?, ?)",
+                                   (key, _dumps(value)))
+
+    def compact_previous_data(self, force=False):
+        """
+        Con force, converte le voci nel formato precedente e riporta il WAL nel database.
+
+        Senza force non fa nulla: SQLite riporta periodicamente il WAL nel database da solo.
+        """
+        if not force:
+            return False
+        stored = self.load_previous_data()
+        converted = convert_legacy_previous_data(stored)
+        if converted:
+            self.save_previous_data(stored)
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(f"Database compattato ({converted} voci convertite nel formato compatto)")
+        return True
+
+    def prune_previous_data(self, live_keys, max_slots=None, removable=None):
+        """
+        Rimuove le chiavi orfane e riduce le disponibilità di ogni prescrizione (vedi prune_stored_previous_data).
+
+        I byte recuperati sono quelli dei valori salvati: le pagine liberate
+        restano nel database e vengono riutilizzate da SQLite.
+        """
+        with self._transaction() as connection:
+            rows = dict(connection.execute("SELECT key, value FROM previous_data"))
+            stored = {key: json.loads(value) for key, value in rows.items()}
+            result = prune_stored_previous_data(stored, live_keys, max_slots, removable)
+
+            connection.executemany("DELETE FROM previous_data WHERE key = ?", [(key,) for key in result["removed"]])
+            changed = {key: _dumps(value) for key, value in stored.items()}
+            connection.executemany("UPDATE previous_data SET value = ? WHERE key = ?",
+                                   [(value, key) for key, value in changed.items() if value != rows[key]])
+
+        size_before = sum(len(key) + len(value) for key, value in rows.items())
+        result["bytes"] = size_before - sum(len(key) + len(value) for key, value in changed.items())
+        return result
+
+def migrate(source, target):
+    """
+    Copia prescrizioni, prenotazioni, utenti e dati precedenti da un archivio all'altro.
+
+    I dati precedenti nel formato precedente vengono convertiti in quello compatto.
+    La migrazione si interrompe al primo dato non leggibile nell'origine (prima
+    di scrivere nella destinazione) o non salvato nella destinazione.
+
+    Returns:
+        dict: Il numero di voci copiate per tipo, None se la migrazione non è riuscita
+    """
+    prescriptions = source.load_prescriptions()
+    if prescriptions is None:
+        logger.error("Prescrizioni di origine non leggibili: migrazione annullata")
+        return None
+    # Senza utenti la destinazione perderebbe anche l'amministratore
+    users = source.load_users()
+    if users is None:
+        logger.error("Utenti di origine non leggibili: migrazione annullata")
+        return None
+    try:
+        previous_data = source.load_previous_data()
+    except Exception as e:
+        logger.error(f"Dati precedenti di origine non leggibili: migrazione annullata ({str(e)})")
+        return None
+    convert_legacy_previous_data(previous_data)
+
+    if not target.save_prescriptions(prescriptions):
+        logger.error("Prescrizioni non salvate nella destinazione: migrazione interrotta")
+        return None
+    if not target.save_users(users):
+        logger.error("Utenti non salvati nella destinazione: migrazione interrotta")
+        return None
+    try:
+        target.save_previous_data(previous_data)
+    except Exception as e:
+        logger.error(f"Dati precedenti non salvati nella destinazione: migrazione interrotta ({str(e)})")
+        return None
+    return {"prescriptions": len(prescriptions), "users": len(users), "previous_data": len(previous_data)}
+
+if __name__ == "__main__":
+    # Migrazione una tantum, es.: python -m modules.sqlite_storage --from json --to sqlite
+    # Dopo la migrazione impostare STORAGE_BACKEND in config.py
+    from modules.data_utils import get_storage
+
+    parser = argparse.ArgumentParser(description="Copia i dati da un archivio all'altro")
+    parser.add_argument("--from", dest="source", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--to", dest="target", choices=["json", "sqlite"], default="sqlite")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("Gli archivi di origine e destinazione coincidono")
+
+    counts = migrate(get_storage(args.source), get_storage(args.target))
+    if counts is None:
+        sys.exit(1)
+    logger.info(f"Migrazione {args.source} -> {args.target} completata: {counts['prescriptions']} prescrizioni, "
+                f"{counts['users']} utenti, {counts['previous_data']} snapshot")
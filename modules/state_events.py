@@ -0,0 +1,110 @@
+import queue
+import threading
+import multiprocessing
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger
+
+# Notifiche di modifica tra i processi avviati da recup_monitor.main.
+# Ogni processo ha una coda, creata dal processo principale prima dell'avvio
+# (create_channels), su cui riceve le notifiche degli argomenti a cui è
+# interessato; ogni scrittura nell'archivio viene notificata agli altri
+# processi (e ai gestori registrati nel processo stesso) con publish.
+# Una notifica è una coppia (argomento, chiavi) con le chiavi delle
+# prescrizioni modificate (codice fiscale_NRE), vuota se sono cambiate tutte.
+TOPIC_PRESCRIPTIONS = "prescriptions"
+TOPIC_PREVIOUS_DATA = "previous_data"
+
+# Nome processo -> (argomenti, coda)
+_channels = {}
+_name = None
+# Gestori delle notifiche generate nel processo stesso
+_local_handlers = []
+
+def create_channels(subscriptions):
+    """
+    Crea le code dei processi (da chiamare nel processo principale, prima di avviarli).
+
+    Args:
+        subscriptions: Dizionario nome processo -> argomenti a cui è interessato
+
+    Returns:
+        dict: Le code, da passare a connect in ogni processo
+    """
+    return {name: (tuple(topics), multiprocessing.Queue()) for name, topics in subscriptions.items()}
+
+def connect(channels, name):
+    """Collega il processo corrente alle code create da create_channels."""
+    global _channels, _name
+    _channels = channels
+    _name = name
+    logger.info(f"Processo {name} collegato alle notifiche di modifica")
+
+def is_connected():
+    """Verifica se il processo riceve le notifiche degli altri processi."""
+    return _name is not None
+
+def subscribe(handler):
+    """Registra un gestore handler(argomento, chiavi) per le modifiche fatte nel processo stesso."""
+    _local_handlers.append(handler)
+
+def publish(topic, keys=()):
+    """Notifica una modifica dell'archivio agli altri processi e ai gestori locali."""
+    keys = list(keys)
+    for handler in _local_handlers:
+        try:
+            handler(topic, keys)
+        except Exception as e:
+            logger.error(f"Errore nel gestire la notifica {topic}: {str(e)}")
+
+    for name, (topics, channel) in _channels.items():
+        if name != _name and topic in topics:
+            channel.put_nowait((topic, keys))
+
+def get_events(timeout=None):
+    """
+    Attende le notifiche per il processo corrente e restituisce tutte quelle in coda.
+
+    Args:
+        timeout: Secondi di attesa massima (None = senza limite)
+
+    Returns:
+        dict: Argomento -> chiavi modificate (None se sono cambiate tutte), vuoto allo scadere del timeout
+    """
+    _, channel = _channels[_name]
+    try:
+        events = [channel.get(timeout=timeout)]
+        while True:
+            events.append(channel.get_nowait())
+    except queue.Empty:
+        pass
+
+    changes = {}
+    for topic, keys in events:
+        if not keys or (topic in changes and changes[topic] is None):
+            changes[topic] = None
+        else:
+            changes.setdefault(topic, set()).update(keys)
+    return changes
+
+def start_listener(handler):
+    """
+    Avvia un thread che passa a handler(argomento, chiavi) le notifiche degli altri processi.
+
+    Returns:
+        bool: True se il thread è stato avviato (il processo è collegato)
+    """
+    if not is_connected():
+        return False
+
+    def listen():
+        while True:
+            try:
+                for topic, keys in get_events().items():
+                    handler(topic, keys)
+            except Exception as e:
+                logger.error(f"Errore nel gestire le notifiche di modifica: {str(e)}")
+
+    threading.Thread(target=listen, name="state-events", daemon=True).start()
+    return True
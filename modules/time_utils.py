@@ -0,0 +1,93 @@
+import time
+import calendar
+import logging
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+# Formato delle date restituite dal servizio: "YYYY-MM-DDTHH:MM:SSZ"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DATE_LENGTH = 20
+
+# Formato breve usato nei pulsanti e nei riepiloghi del bot
+SHORT_FORMAT = "%d/%m/%Y %H:%M"
+
+# Dimensione delle cache di conversione e formattazione
+CACHE_SIZE = 8192
+
+WEEKDAYS = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
+MONTHS = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+          "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+# Gli orari sono rappresentati in secondi dall'epoca calcolati sui campi della
+# data così come sono scritti (calendar.timegm), quindi confrontabili tra loro
+# e con datetime.now() convertito allo stesso modo (vedi to_epoch).
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_epoch(date_str):
+    """
+    Converte una data del servizio in secondi dall'epoca.
+
+    Il formato fisso viene letto per posizione; per le altre stringhe si
+    ricorre a strptime.
+
+    Returns:
+        int: I secondi dall'epoca, None se la data non è valida
+    """
+    try:
+        if len(date_str) == DATE_LENGTH and date_str[10] == "T" and date_str[19] == "Z":
+            return calendar.timegm((
+                int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+                int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]),
+                0, 0, 0
+            ))
+        return to_epoch(datetime.strptime(date_str, DATE_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+def to_epoch(dt):
+    """Converte un datetime (senza fuso orario) in secondi dall'epoca."""
+    return calendar.timegm(dt.timetuple())
+
+def format_iso(epoch):
+    """Restituisce la data nel formato del servizio."""
+    return time.strftime(DATE_FORMAT, time.gmtime(epoch))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_epoch(epoch):
+    """Formatta un orario in italiano, es. "Lunedì 2 Novembre 2026, ore 09:00"."""
+    t = time.gmtime(epoch)
+    return (f"{WEEKDAYS[t.tm_wday]} {t.tm_mday} {MONTHS[t.tm_mon - 1]} {t.tm_year}, "
+            f"ore {t.tm_hour:02d}:{t.tm_min:02d}")
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_short(date_str):
+    """Formatta una data del servizio come "02/11/2026 09:00" (la stringa originale se non valida)."""
+    epoch = parse_epoch(date_str)
+    if epoch is None:
+        return date_str
+    return time.strftime(SHORT_FORMAT, time.gmtime(epoch))
+
+def get_range_bounds(months_limit, now=None):
+    """
+    Restituisce l'intervallo da adesso a months_limit mesi (da 30 giorni).
+
+    Returns:
+        tuple: (inizio, fine) in secondi dall'epoca, None se non c'è limite
+    """
+    if months_limit is None:
+        return None
+    if now is None:
+        now = datetime.now()
+    return to_epoch(now), to_epoch(now + timedelta(days=30 * months_limit))
+
+def filter_within_range(slots, months_limit, now=None):
+    """
+    Filtra una lista di Slot tenendo quelli entro months_limit mesi.
+
+    L'intervallo viene calcolato una sola volta per tutta la lista.
+    """
+    bounds = get_range_bounds(months_limit, now)
+    if bounds is None:
+        return slots
+    start, end = bounds
+    return [slot for slot in slots if start <= slot.epoch <= end]
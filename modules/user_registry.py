@@ -0,0 +1,159 @@
+import time
+import threading
+import logging
+
+# Importa costanti e configurazioni dal modulo config
+from config import logger, USERS_FILE, USERS_RELOAD_INTERVAL
+from modules.data_utils import get_storage, file_lock
+
+# Ruoli degli utenti autorizzati. L'archivio conserva solo la lista degli
+# utenti: l'amministratore è il primo (come nella lista originale)
+ROLE_ADMIN = "admin"
+ROLE_USER = "user"
+
+class UserRegistry:
+    """
+    Gli utenti autorizzati del processo, in memoria, con il ruolo di ognuno.
+
+    I controlli di autorizzazione non accedono all'archivio: un thread
+    (start_reloader) ne controlla la firma ogni reload_interval secondi e
+    ricarica gli utenti quando un altro processo li ha modificati.
+    Le prescrizioni di ogni utente sono indicizzate per chat dal repository
+    delle prescrizioni (vedi PrescriptionRepository.for_chat).
+    """
+
+    def __init__(self, storage=None, reload_interval=USERS_RELOAD_INTERVAL):
+        self._storage = storage or get_storage()
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._signature = None
+
+        # Gli id nell'ordine dell'archivio e id -> ruolo. Vengono sostituiti
+        # (mai modificati) a ogni aggiornamento: le letture non usano _lock
+        self._order = []
+        self._roles = {}
+
+    def _set(self, users):
+        order = [str(user_id) for user_id in users]
+        roles = {user_id: ROLE_USER for user_id in order}
+        if order:
+            roles[order[0]] = ROLE_ADMIN
+        self._order, self._roles = order, roles
+
+    def reload(self, force=False):
+        """
+        Ricarica gli utenti se sono cambiati nell'archivio.
+
+        Returns:
+            bool: True se gli utenti sono stati ricaricati
+        """
+        with self._lock:
+            # La firma va letta prima del contenuto, come per le prescrizioni
+            signature = self._storage.users_signature()
+            if not force and signature is not None and signature == self._signature:
+                return False
+            # load_users crea il file se manca: anche la lettura usa il lock del file
+            with file_lock(USERS_FILE):
+                users = self._storage.load_users()
+            if users is None:
+                # Archivio non leggibile: continuiamo con gli utenti in memoria
+                return False
+            self._set(users)
+            self._signature = signature
+        logger.info(f"Caricati {len(users)} utenti autorizzati")
+        return True
+
+    def start_reloader(self):
+        """Avvia il thread che ricarica gli utenti modificati nell'archivio."""
+        def run():
+            while True:
+                time.sleep(self._reload_interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Errore nel ricaricare gli utenti autorizzati: {str(e)}")
+
+        threading.Thread(target=run, name="user-registry", daemon=True).start()
+
+    # --- Letture ---
+
+    def is_authorized(self, user_id):
+        """Verifica se l'utente è autorizzato."""
+        return str(user_id) in self._roles
+
+    def role(self, user_id):
+        """Il ruolo dell'utente, None se non è autorizzato."""
+        return self._roles.get(str(user_id))
+
+    def is_admin(self, user_id):
+        """Verifica se l'utente è l'amministratore."""
+        return self._roles.get(str(user_id)) == ROLE_ADMIN
+
+    @property
+    def admin_id(self):
+        """L'id dell'amministratore, None se non ci sono utenti."""
+        order = self._order
+        return order[0] if order else None
+
+    def __len__(self):
+        return len(self._order)
+
+    # --- Modifiche ---
+
+    def _append(self, user_id, only_first=False):
+        """Aggiunge l'utente agli utenti salvati (solo se non ce ne sono, con only_first)."""
+        user_id = str(user_id)
+        # Il lock sul file rende la lettura, la modifica e il salvataggio atomici
+        # anche rispetto all'altro processo (bot o monitoraggio)
+        with self._lock, file_lock(USERS_FILE):
+            # Partiamo dagli utenti salvati, che un altro processo potrebbe aver modificato
+            users = self._storage.load_users()
+            if users is None:
+                return False
+            users = [str(existing) for existing in users]
+            if user_id in users or (only_first and users):
+                self._set(users)
+                return False
+            users.append(user_id)
+            if not self._storage.save_users(users):
+                return False
+            self._set(users)
+            self._signature = self._storage.users_signature()
+        logger.info(f"Utente {user_id} autorizzato ({self.role(user_id)})")
+        return True
+
+    def add(self, user_id):
+        """
+        Autorizza un utente e lo salva nell'archivio.
+
+        Returns:
+            bool: True se l'utente è stato aggiunto, False se era già autorizzato
+                o se il salvataggio non è riuscito
+        """
+        return self._append(user_id)
+
+    def claim_admin(self, user_id):
+        """
+        Imposta l'utente come amministratore, se non ci sono ancora utenti autorizzati.
+
+        Returns:
+            bool: True se l'utente è diventato l'amministratore
+        """
+        if self._order:
+            return False
+        return self._append(user_id, only_first=True)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_user_registry():
+    """Restituisce gli utenti autorizzati del processo (caricati al primo uso)."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = UserRegistry()
+                registry.reload(force=True)
+                registry.start_reloader()
+                _registry = registry
+    return _registry
@@ -1,12 +1,13 @@
 import multiprocessing
 import logging
 import os
+import signal
 import asyncio
 import time
 from datetime import datetime
 
 # Importiamo le configurazioni dal modulo config
-from config import logger, TELEGRAM_TOKEN, authorized_users
+from config import logger, TELEGRAM_TOKEN
 
 # Configurazione del logging
 logging.basicConfig(
@@ -16,10 +17,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger("RecupMultiprocess")
 
-def run_telegram_bot():
+def run_telegram_bot(channels=None):
     """Funzione che esegue il bot Telegram in un processo separato."""
     logger.info("Avvio del processo per il bot Telegram")
     try:
+        if channels is not None:
+            from modules.state_events import connect
+            connect(channels, "bot")
+        
         from telegram.ext import Application
         from modules.bot_handlers import setup_handlers
         
@@ -32,26 +37,47 @@ def run_telegram_bot():
         # Avviamo il bot
         logger.info("Bot Telegram in avvio...")
         application.run_polling(allowed_updates=["message", "callback_query"])
+        
+        # Salviamo le modifiche alle prescrizioni non ancora scritte
+        from modules.prescription_repository import flush_prescriptions
+        flush_prescriptions()
     except Exception as e:
         logger.error(f"Errore nel processo del bot Telegram: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
 
-def run_monitoring():
+def run_monitoring(channels=None):
     """Funzione che esegue il monitoraggio in un processo separato."""
     logger.info("Avvio del processo per il monitoraggio")
     try:
         import asyncio
         
+        if channels is not None:
+            from modules.state_events import connect
+            connect(channels, "monitor")
+        
         # Creiamo un nuovo loop per questo processo
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        from modules.monitoring import run_monitoring_loop
+        from modules.monitoring import run_monitoring_loop, shutdown_monitoring
+        
+        # main() termina i processi con SIGTERM: lo trasformiamo in SystemExit
+        # così lo storico viene salvato nel blocco finally
+        def handle_sigterm(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, handle_sigterm)
         
         # Avviamo il loop di monitoraggio
         logger.info("Monitoraggio prescrizioni in avvio...")
-        loop.run_until_complete(run_monitoring_loop())
+        try:
+            loop.run_until_complete(run_monitoring_loop())
+        finally:
+            # Un secondo segnale non deve interrompere il salvataggio
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            logger.info("Chiusura del monitoraggio: salvataggio dello storico delle disponibilità")
+            shutdown_monitoring()
     except Exception as e:
         logger.error(f"Errore nel processo di monitoraggio: {str(e)}")
         import traceback
@@ -61,16 +87,22 @@ def main():
     """Funzione principale che avvia i processi separati."""
     logger.info("Avvio del sistema multi-processo")
     
-    # Caricamento configurazioni e dati comuni
-    from modules.data_utils import load_authorized_users
-    load_authorized_users()
+    # Gli utenti autorizzati vengono caricati da ogni processo (vedi modules.user_registry)
+    
+    # Code per le notifiche di modifica dell'archivio tra i due processi:
+    # il bot ricarica le prescrizioni, il monitoraggio anche i dati precedenti
+    from modules.state_events import create_channels, TOPIC_PRESCRIPTIONS, TOPIC_PREVIOUS_DATA
+    channels = create_channels({
+        "bot": [TOPIC_PRESCRIPTIONS],
+        "monitor": [TOPIC_PRESCRIPTIONS, TOPIC_PREVIOUS_DATA]
+    })
     
     # Creiamo e avviamo il processo per il bot Telegram
-    bot_process = multiprocessing.Process(target=run_telegram_bot)
+    bot_process = multiprocessing.Process(target=run_telegram_bot, args=(channels,))
     bot_process.start()
     
     # Creiamo e avviamo il processo per il monitoraggio
-    monitoring_process = multiprocessing.Process(target=run_monitoring)
+    monitoring_process = multiprocessing.Process(target=run_monitoring, args=(channels,))
     monitoring_process.start()
     
     # Attendiamo che i processi terminino (non dovrebbe mai accadere a meno di errori)